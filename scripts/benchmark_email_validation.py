@@ -0,0 +1,51 @@
+import argparse
+import re
+import timeit
+
+import pandas as pd
+
+from src.transformation.lambda_function import EMAIL_REGEX, is_valid_email
+
+
+# The row by row check staff_schema used before is_valid_email
+def is_valid_email_apply(emails):
+    def is_valid(email):
+        return (
+            bool(re.match(EMAIL_REGEX.pattern, email)) if pd.notnull(email) else False
+        )
+
+    return emails.apply(is_valid)
+
+
+def make_staff_emails(rows):
+    samples = [
+        "jeremie.franey@terrifictotes.com",
+        "irving.o'keefe@terrifictotes.com",
+        None,
+        "not-an-email",
+        "meda.cremin@terrifictotes.co.uk",
+    ]
+    return pd.Series((samples * (rows // len(samples) + 1))[:rows])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark email validation")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    emails = make_staff_emails(args.rows)
+    assert is_valid_email(emails).equals(is_valid_email_apply(emails))
+
+    for name, validate in [
+        ["apply + re.match", is_valid_email_apply],
+        ["vectorised str.match", is_valid_email],
+    ]:
+        seconds = min(
+            timeit.repeat(lambda: validate(emails), number=1, repeat=args.repeat)
+        )
+        print(f"{name:22} {args.rows} rows {seconds:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
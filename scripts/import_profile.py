@@ -0,0 +1,94 @@
+import argparse
+import os
+import subprocess
+import sys
+
+# Each lambda's entry module, how long importing it may take and the
+# libraries it must not pull in at import time
+LAMBDAS = {
+    "extract": {
+        "module": "src.extract_lambda.extract_lambda",
+        "budget_ms": 1000,
+        "forbidden": ["awswrangler", "pandas", "numpy", "pyarrow"],
+    },
+    "transformation": {
+        "module": "src.transformation.lambda_function",
+        "budget_ms": 2000,
+        "forbidden": ["awswrangler", "boto3"],
+    },
+    "load": {
+        "module": "src.load_lambda.lambda_function",
+        "budget_ms": 500,
+        "forbidden": ["awswrangler", "pandas", "numpy", "pyarrow", "boto3"],
+    },
+}
+
+
+# Imports module in a fresh interpreter with `python -X importtime` and
+# returns [[module name, self us, cumulative us, depth]] in import order
+def profile_imports(module):
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        timeout=120,
+    )
+    if res.returncode != 0:
+        raise RuntimeError(f"Unable to import {module}:\n{res.stderr}")
+
+    profile = []
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "| imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        profile.append([name.strip(), int(self_us), int(cumulative_us), depth])
+    return profile
+
+
+def get_total_ms(profile, module):
+    return next(row[2] for row in profile if row[0] == module) / 1000
+
+
+def get_top_level_packages(profile):
+    return {row[0].split(".")[0] for row in profile}
+
+
+def check_lambda(name, top=10):
+    details = LAMBDAS[name]
+    profile = profile_imports(details["module"])
+    total_ms = get_total_ms(profile, details["module"])
+    forbidden = sorted(set(details["forbidden"]) & get_top_level_packages(profile))
+
+    print(f"{name}: {details['module']} {total_ms:.0f}ms", end=" ")
+    print(f"(budget {details['budget_ms']}ms)")
+    for module, _, cumulative_us, _ in sorted(profile, key=lambda row: -row[2])[
+        1 : top + 1
+    ]:
+        print(f"  {cumulative_us / 1000:8.1f}ms  {module}")
+
+    errors = []
+    if total_ms > details["budget_ms"]:
+        errors.append(f"{name} import took {total_ms:.0f}ms")
+    if forbidden:
+        errors.append(f"{name} imports {', '.join(forbidden)}")
+    return errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Profile lambda import times")
+    parser.add_argument("lambdas", nargs="*", default=list(LAMBDAS))
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    errors = []
+    for name in args.lambdas:
+        errors += check_lambda(name, args.top)
+    for error in errors:
+        print(f"FAIL: {error}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,24 +1,63 @@
 # from get_secrets_extract import get_secret_db
 from pg8000.native import Connection
-from pg8000 import InterfaceError
+from pg8000 import InterfaceError, DatabaseError
 import boto3
 import json
+import os
+import threading
+import time
+from contextlib import contextmanager
 from botocore.exceptions import ClientError
 import logging
 
 # ssm_client = boto3.client("ssm", region_name="eu-west-2")
 secretsmanager_client = boto3.client("secretsmanager", region_name="eu-west-2")
 
+# One connection per warm Lambda container, shared across tables and invocations
+_connection = None
+
+# Idle connections kept for the parallel extract workers, one per worker
+_idle_connections = []
+_pool_lock = threading.Lock()
+
+# Secrets are cached for SECRET_CACHE_TTL seconds and refreshed in the
+# background once SECRET_REFRESH_RATIO of the TTL has elapsed
+SECRET_CACHE_TTL = float(os.environ.get("SECRET_CACHE_TTL", 300))
+SECRET_REFRESH_RATIO = float(os.environ.get("SECRET_REFRESH_RATIO", 0.8))
+
+_secret_cache = {}
+_secret_cache_lock = threading.Lock()
+_secrets_refreshing = set()
+
+# invalid_password / invalid_authorization_specification
+AUTH_ERROR_CODES = ("28P01", "28000")
+
 
 def connect_to_extract_db_cloud(secretsmanager_client=secretsmanager_client):
     try:
-        db_info = get_secret_db(
+        db_info = get_cached_secret(
             "totesysinfo", secretsmanager_client=secretsmanager_client
         )
     except ClientError as e:
         logging.error(f"Data base creadentials are incorrect {e}")
         raise e
 
+    try:
+        return open_connection(db_info)
+    except DatabaseError as e:
+        if not is_auth_error(e):
+            raise e
+        # the password may have been rotated since it was cached
+        logging.info("Database authentication failed, refreshing credentials")
+        db_info = get_cached_secret(
+            "totesysinfo",
+            secretsmanager_client=secretsmanager_client,
+            force_refresh=True,
+        )
+        return open_connection(db_info)
+
+
+def open_connection(db_info):
     return Connection(
         user=db_info["username"],
         password=db_info["password"],
@@ -28,6 +67,143 @@ def connect_to_extract_db_cloud(secretsmanager_client=secretsmanager_client):
     )
 
 
+def is_auth_error(error):
+    details = error.args[0] if error.args else None
+    return isinstance(details, dict) and details.get("C") in AUTH_ERROR_CODES
+
+
+def is_connection_alive(conn):
+    try:
+        conn.run("select 1;")
+    except (InterfaceError, DatabaseError):
+        return False
+    return True
+
+
+def get_connection(secretsmanager_client=secretsmanager_client):
+    global _connection
+    if _connection is not None and is_connection_alive(_connection):
+        return _connection
+
+    if _connection is not None:
+        logging.info("Database connection has gone stale, reconnecting")
+        close_connection()
+
+    _connection = connect_to_extract_db_cloud(secretsmanager_client)
+    return _connection
+
+
+def close_connection():
+    global _connection
+    if _connection is None:
+        return
+    close_quietly(_connection)
+    _connection = None
+
+
+def close_quietly(conn):
+    try:
+        conn.close()
+    except (InterfaceError, DatabaseError):
+        # the socket is already gone, nothing left to clean up
+        pass
+
+
+def acquire_connection(secretsmanager_client=secretsmanager_client):
+    while True:
+        with _pool_lock:
+            conn = _idle_connections.pop() if _idle_connections else None
+        if conn is None:
+            return connect_to_extract_db_cloud(secretsmanager_client)
+        if is_connection_alive(conn):
+            return conn
+        logging.info("Pooled database connection has gone stale, dropping it")
+        close_quietly(conn)
+
+
+def release_connection(conn):
+    with _pool_lock:
+        _idle_connections.append(conn)
+
+
+@contextmanager
+def pooled_connection(secretsmanager_client=secretsmanager_client):
+    conn = acquire_connection(secretsmanager_client)
+    try:
+        yield conn
+    except InterfaceError:
+        # network errors leave the connection unusable
+        close_quietly(conn)
+        raise
+    except Exception:
+        release_connection(conn)
+        raise
+    else:
+        release_connection(conn)
+
+
+def close_pool():
+    with _pool_lock:
+        connections = list(_idle_connections)
+        _idle_connections.clear()
+    for conn in connections:
+        close_quietly(conn)
+
+
+def get_cached_secret(
+    secret,
+    secretsmanager_client=secretsmanager_client,
+    ttl=None,
+    force_refresh=False,
+):
+    ttl = SECRET_CACHE_TTL if ttl is None else ttl
+    with _secret_cache_lock:
+        cached = _secret_cache.get(secret)
+
+    if force_refresh or cached is None:
+        return refresh_secret(secret, secretsmanager_client)
+
+    age = time.monotonic() - cached["fetched_at"]
+    if age >= ttl:
+        return refresh_secret(secret, secretsmanager_client)
+    if age >= ttl * SECRET_REFRESH_RATIO:
+        refresh_secret_in_background(secret, secretsmanager_client)
+    return cached["value"]
+
+
+def refresh_secret(secret, secretsmanager_client=secretsmanager_client):
+    value = get_secret_db(secret, secretsmanager_client=secretsmanager_client)
+    with _secret_cache_lock:
+        _secret_cache[secret] = {"value": value, "fetched_at": time.monotonic()}
+    return value
+
+
+def refresh_secret_in_background(secret, secretsmanager_client=secretsmanager_client):
+    with _secret_cache_lock:
+        if secret in _secrets_refreshing:
+            return
+        _secrets_refreshing.add(secret)
+
+    def refresh():
+        try:
+            refresh_secret(secret, secretsmanager_client)
+        except ClientError as e:
+            # keep serving the cached value until it expires
+            logging.warning(f"Background refresh of secret {secret} failed {e}")
+        finally:
+            with _secret_cache_lock:
+                _secrets_refreshing.discard(secret)
+
+    thread = threading.Thread(target=refresh, daemon=True)
+    thread.start()
+    return thread
+
+
+def clear_secret_cache():
+    with _secret_cache_lock:
+        _secret_cache.clear()
+
+
 def get_secret_db(secret, secretsmanager_client=secretsmanager_client):
     # Create a Secrets Manager client
     # session = boto3.session.Session()
@@ -3,14 +3,50 @@ import json
 import os
 import boto3
 import logging
+import time
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import NoCredentialsError, ClientError
-from .connection_extract import connect_to_extract_db_cloud as db_conn
-from pg8000 import DatabaseError
+from .connection_extract import get_connection as db_conn
+from .connection_extract import pooled_connection, close_connection
+from .s3_upload import S3MultipartWriter
+from .output_formats import OUTPUT_FORMATS, get_upload_args
+from .output_formats import write_batches, write_json_batches
+from pg8000 import DatabaseError, InterfaceError
+from pg8000.native import identifier, literal
 
 
 ssm_client = boto3.client("ssm", region_name="eu-west-2")
 s3_client = boto3.client("s3", region_name="eu-west-2")
 
+EXTRACTION_BUCKET = "extraction-bucket-sorceress"
+# "json_agg" builds each delta in one query, "stream" fetches it in batches
+# and "copy" streams COPY ... TO STDOUT straight into S3
+EXTRACT_MODE = os.environ.get("EXTRACT_MODE", "json_agg")
+EXTRACT_BATCH_SIZE = int(os.environ.get("EXTRACT_BATCH_SIZE", 5000))
+EXTRACT_COPY_FORMAT = os.environ.get("EXTRACT_COPY_FORMAT", "csv")
+# tables extracted at once, each worker holding its own pooled connection
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", 1))
+# "multipart" streams JSON straight into S3, "tmp" writes it to /tmp first
+UPLOAD_MODE = os.environ.get("UPLOAD_MODE", "multipart")
+# json, jsonl, jsonl.gz, jsonl.zst or parquet, used by the multipart upload
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "json")
+# rows per keyset page, and time left (ms) at which a backfill checkpoints
+# and stops so the next invocation can resume it
+BACKFILL_PAGE_SIZE = int(os.environ.get("BACKFILL_PAGE_SIZE", 10000))
+BACKFILL_TIME_MARGIN = int(os.environ.get("BACKFILL_TIME_MARGIN", 60000))
+
+# the transform reads csv extracts, binary COPY output is only meant for bulk
+# loading elsewhere so it is kept under copy/ and out of the extract index
+COPY_FORMATS = {
+    "csv": {"extension": "csv", "content_type": "text/csv", "prefix": ""},
+    "binary": {
+        "extension": "pgcopy",
+        "content_type": "application/octet-stream",
+        "prefix": "copy/",
+    },
+}
+
 
 def get_table_names(conn):
     data = conn.run(
@@ -23,15 +59,40 @@ def get_table_names(conn):
     return [i for i in data[0] if i not in unwanted_tables]
 
 
-def get_latest_date(conn, tables):
-    newest = datetime.datetime(1990, 11, 3, 14, 20, 49, 962000)
-    for table in tables:
-        newest_table_time = conn.run(
-            f"select last_updated from {table} " f"order by last_updated desc limit 1;"
-        )[0][0]
-        if newest_table_time > newest:
-            newest = newest_table_time
-    return newest
+def get_column_types(conn, table):
+    rows = conn.run(
+        """SELECT column_name, data_type
+            FROM information_schema.columns
+            WHERE table_schema = 'public'
+            AND table_name = :table
+            ORDER BY ordinal_position;""",
+        table=table,
+    )
+    return [[name, data_type] for name, data_type in rows]
+
+
+def get_output_columns(conn, table, output_format=OUTPUT_FORMAT):
+    # parquet needs the column types up front, a column can be all null in
+    # the first batch
+    if output_format != "parquet":
+        return None
+    return get_column_types(conn, table)
+
+
+def get_latest_dates(conn, tables):
+    # one round trip for every table's high-water mark
+    query = " union all ".join(
+        f"select {literal(table)}, max(last_updated) from {identifier(table)}"
+        for table in tables
+    )
+    if not query:
+        return {}
+    return {table: latest for table, latest in conn.run(f"{query};")}
+
+
+def has_new_data(table, latest_dates, where_date):
+    latest = latest_dates.get(table)
+    return latest is not None and latest > where_date
 
 
 def get_latest_date_parameter(ssm_client=ssm_client):
@@ -49,6 +110,54 @@ def get_latest_date_parameter(ssm_client=ssm_client):
     return datetime_str
 
 
+def get_stored_table_dates(ssm_client=ssm_client):
+    try:
+        parameter_latest_dates = ssm_client.get_parameter(Name="latest_dates")
+        stored_dates = json.loads(parameter_latest_dates["Parameter"]["Value"])
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ParameterNotFound":
+            raise
+        stored_dates = {}
+    return {
+        table: datetime.datetime.strptime(latest, "%Y-%m-%d %H:%M:%S.%f")
+        for table, latest in stored_dates.items()
+    }
+
+
+def get_table_date_parameters(tables, ssm_client=ssm_client):
+    stored_dates = get_stored_table_dates(ssm_client)
+    # tables without their own watermark share one lookup of the fallback
+    default_date = None
+    if any(table not in stored_dates for table in tables):
+        default_date = get_default_date(ssm_client)
+    return {table: stored_dates.get(table, default_date) for table in tables}
+
+
+def get_default_date(ssm_client=ssm_client):
+    # tables without their own watermark carry on from the old global one
+    try:
+        return get_latest_date_parameter(ssm_client=ssm_client)
+    except ClientError:
+        return datetime.datetime(1990, 11, 3, 14, 20, 49, 962000)
+
+
+def update_table_date_parameters(table_dates, ssm_client=ssm_client):
+    # a watermark never moves backwards, another run may have moved it on
+    # since these dates were read
+    merged = get_stored_table_dates(ssm_client)
+    for table, latest in table_dates.items():
+        merged[table] = max(latest, merged.get(table, latest))
+    value = json.dumps(
+        {
+            table: latest.strftime("%Y-%m-%d %H:%M:%S.%f")
+            for table, latest in merged.items()
+        }
+    )
+    ssm_client.put_parameter(
+        Name="latest_dates", Value=value, Type="String", Overwrite=True
+    )
+
+
 def table_to_json(conn, table, where_date):
     try:
         res = conn.run(
@@ -61,38 +170,64 @@ def table_to_json(conn, table, where_date):
         raise
 
 
-def update_date_parameter(newest):
-    # if parameter store empty
-    ssm_client = boto3.client("ssm")
-    ssm_client.put_parameter(
-        Name="latest_date", Value=f"{newest}", Type="String", Overwrite=True
+def get_object_key(table, latest_update, extension="json"):
+    return (
+        f"{table}/{latest_update.year}-{latest_update.strftime('%B')}/"
+        f"{table}-{latest_update}.{extension}"
     )
 
 
-def save_json_to_folder(table, latest_update, data, s3_client=s3_client):
-    tmp_path = "/tmp/"
-    table_path = f"{tmp_path}data/{table}/"
-    month_year_path = f"{table_path}{latest_update.year}\
-        -{latest_update.strftime('%B')}/"
-
-    if not os.path.exists(tmp_path):
-        os.mkdir(tmp_path)
-    if not os.path.exists(table_path):
-        os.mkdir(table_path)
-    if not os.path.exists(month_year_path):
-        os.mkdir(month_year_path)
-
-    file_name = f"{month_year_path}{table}-{latest_update}.json"
-    with open(file_name, "w") as f:
-        f.write(json.dumps(data))
+def get_copy_object_key(table, latest_update, copy_format=EXTRACT_COPY_FORMAT):
+    details = COPY_FORMATS[copy_format]
+    return details["prefix"] + get_object_key(
+        table, latest_update, details["extension"]
+    )
+
 
+def get_index_key(table):
+    return f"manifests/{table}.json"
+
+
+def get_extract_index(table, s3_client=s3_client):
     try:
-        s3_client.upload_file(
-            file_name,
-            "extraction-bucket-sorceress",
-            f"{table}/{latest_update.year}-\
-                {latest_update.strftime('%B')}/{table}-{latest_update}.json",
-        )
+        res = s3_client.get_object(Bucket=EXTRACTION_BUCKET, Key=get_index_key(table))
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            raise
+        return {}
+    return json.load(res["Body"])
+
+
+def update_extract_index(table, latest_update, key, s3_client=s3_client):
+    # maps each extract timestamp to its object so the transform can find
+    # new files with one small GET instead of listing the whole prefix. A
+    # timestamp with several objects (a backfill) maps to a list of keys.
+    index = get_extract_index(table, s3_client)
+
+    timestamp = latest_update.strftime("%Y-%m-%d %H:%M:%S.%f")
+    keys = index.get(timestamp, [])
+    keys = keys if isinstance(keys, list) else [keys]
+    for new_key in key if isinstance(key, list) else [key]:
+        if new_key not in keys:
+            keys.append(new_key)
+    index[timestamp] = keys[0] if len(keys) == 1 else keys
+    s3_client.put_object(
+        Bucket=EXTRACTION_BUCKET,
+        Key=get_index_key(table),
+        Body=json.dumps(index, sort_keys=True),
+        ContentType="application/json",
+    )
+
+
+def get_tmp_file_name(table, latest_update, extension="json"):
+    file_name = f"/tmp/data/{get_object_key(table, latest_update, extension)}"
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    return file_name
+
+
+def upload_to_s3(file_name, key, s3_client=s3_client):
+    try:
+        s3_client.upload_file(file_name, EXTRACTION_BUCKET, key)
     except FileNotFoundError as e:
         logging.error(f"File {file_name} not found")
         raise e
@@ -104,35 +239,421 @@ def save_json_to_folder(table, latest_update, data, s3_client=s3_client):
         raise e
 
 
-def lambda_handler(event, context):
+def save_json_to_folder(table, latest_update, data, s3_client=s3_client):
+    file_name = get_tmp_file_name(table, latest_update)
+    with open(file_name, "w") as f:
+        f.write(json.dumps(data))
+
+    upload_to_s3(file_name, get_object_key(table, latest_update), s3_client)
+
+
+def stream_table_rows(conn, table, where_date, batch_size=EXTRACT_BATCH_SIZE):
+    # a server-side cursor keeps only one batch of rows in memory at a time
+    cursor = identifier(f"{table}_extract")
+    conn.run("begin;")
+    try:
+        conn.run(
+            f"declare {cursor} no scroll cursor for "
+            f"select row_to_json(t) from {identifier(table)} t "
+            f"where last_updated > {literal(where_date)};"
+        )
+        while True:
+            rows = conn.run(f"fetch forward {int(batch_size)} from {cursor};")
+            if not rows:
+                break
+            yield [row[0] for row in rows]
+    finally:
+        # ending the transaction also closes the cursor
+        conn.run("rollback;")
+
+
+def save_json_batches_to_folder(table, latest_update, batches, s3_client=s3_client):
+    file_name = get_tmp_file_name(table, latest_update)
+    with open(file_name, "w") as f:
+        row_count = write_json_batches(batches, f)
+
+    if row_count:
+        upload_to_s3(file_name, get_object_key(table, latest_update), s3_client)
+    os.remove(file_name)
+    return row_count
+
+
+def stream_batches_to_s3(
+    table,
+    latest_update,
+    batches,
+    s3_client=s3_client,
+    output_format=OUTPUT_FORMAT,
+    columns=None,
+):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format {output_format}")
+    key = get_object_key(
+        table, latest_update, OUTPUT_FORMATS[output_format]["extension"]
+    )
+    return upload_batches(key, batches, s3_client, output_format, columns)
+
+
+def upload_batches(
+    key, batches, s3_client=s3_client, output_format=OUTPUT_FORMAT, columns=None
+):
+    writer = S3MultipartWriter(
+        EXTRACTION_BUCKET, key, s3_client, **get_upload_args(output_format)
+    )
     try:
-        table_names = get_table_names(db_conn())
-        # print(f"==>> table_names: {table_names}")
-
-        latest_date_from_db = get_latest_date(db_conn(), table_names)
-        # print(f"==>> latest_date_from_db: {latest_date_from_db}")
-
-        parameter_date = get_latest_date_parameter()
-        # print(f"==>> parameter_date: {parameter_date}")
-        if latest_date_from_db > parameter_date:
-            for table in table_names:
-                json_table = table_to_json(db_conn(), table, parameter_date)
-
-                if json_table:
-                    save_json_to_folder(table, latest_date_from_db, json_table)
-                    logging.info(f"Table {table} saved")
-                else:
-                    logging.info(f"There is no new data in {table}")
+        row_count = write_batches(batches, writer, output_format, columns)
+    except Exception:
+        writer.abort()
+        raise
+
+    if not row_count:
+        writer.abort()
+        return 0
+    writer.close()
+    return row_count
+
+
+def copy_table_to_s3(
+    conn,
+    table,
+    where_date,
+    latest_update,
+    copy_format=EXTRACT_COPY_FORMAT,
+    s3_client=s3_client,
+):
+    if copy_format not in COPY_FORMATS:
+        raise ValueError(f"Unsupported COPY format {copy_format}")
+    options = "format csv, header" if copy_format == "csv" else "format binary"
+    query = (
+        f"copy (select * from {identifier(table)} "
+        f"where last_updated > {literal(where_date)}) to stdout ({options});"
+    )
+
+    writer = S3MultipartWriter(
+        EXTRACTION_BUCKET,
+        get_copy_object_key(table, latest_update, copy_format),
+        s3_client,
+        ContentType=COPY_FORMATS[copy_format]["content_type"],
+    )
+    try:
+        conn.run(query, stream=writer)
+    except Exception:
+        writer.abort()
+        raise
+
+    if not conn.row_count:
+        writer.abort()
+        return 0
+    writer.close()
+    return conn.row_count
+
+
+def extract_table(conn, table, where_date, latest_update):
+    if EXTRACT_MODE == "copy":
+        saved = copy_table_to_s3(conn, table, where_date, latest_update) > 0
+        extension = COPY_FORMATS[EXTRACT_COPY_FORMAT]["extension"]
+        if COPY_FORMATS[EXTRACT_COPY_FORMAT]["prefix"]:
+            return saved
+    elif EXTRACT_MODE == "stream":
+        columns = None if UPLOAD_MODE == "tmp" else get_output_columns(conn, table)
+        # closing the generator rolls back its cursor straight away when the
+        # upload fails, before the connection goes back to the pool
+        with closing(stream_table_rows(conn, table, where_date)) as batches:
+            if UPLOAD_MODE == "tmp":
+                saved = save_json_batches_to_folder(table, latest_update, batches)
+                extension = "json"
+            else:
+                saved = stream_batches_to_s3(
+                    table, latest_update, batches, columns=columns
+                )
+                extension = OUTPUT_FORMATS[OUTPUT_FORMAT]["extension"]
+        saved = saved > 0
+    else:
+        json_table = table_to_json(conn, table, where_date)
+        saved = bool(json_table)
+        if saved and UPLOAD_MODE == "tmp":
+            save_json_to_folder(table, latest_update, json_table)
+            extension = "json"
+        elif saved:
+            stream_batches_to_s3(
+                table,
+                latest_update,
+                [json_table],
+                columns=get_output_columns(conn, table),
+            )
+            extension = OUTPUT_FORMATS[OUTPUT_FORMAT]["extension"]
+
+    if saved:
+        update_extract_index(
+            table, latest_update, get_object_key(table, latest_update, extension)
+        )
+    return saved
+
+
+def extract_one_table(table, where_date, latest_update, conn=None):
+    start = time.monotonic()
+    try:
+        if conn is None:
+            with pooled_connection() as worker_conn:
+                saved = extract_table(worker_conn, table, where_date, latest_update)
         else:
-            logging.info(f"No new data from {latest_date_from_db}")
+            saved = extract_table(conn, table, where_date, latest_update)
+    except Exception as e:
+        logging.error(f"Unable to extract table {table} {e}", exc_info=True)
+        result = {
+            "table": table,
+            "status": "failed",
+            "error": str(e),
+            "seconds": time.monotonic() - start,
+        }
+        if conn is not None:
+            # pooled connections are dropped by pooled_connection itself
+            result["reconnect"] = is_connection_broken(e)
+        return result
+
+    if saved:
+        logging.info(f"Table {table} saved")
+    else:
+        logging.info(f"There is no new data in {table}")
+    return {
+        "table": table,
+        "status": "saved" if saved else "no_data",
+        "seconds": time.monotonic() - start,
+    }
+
+
+def is_connection_broken(error):
+    # network errors, and a COPY abandoned part way through leaves the rest
+    # of its output unread on the socket
+    return isinstance(error, InterfaceError) or EXTRACT_MODE == "copy"
+
+
+def extract_tables(conn, tables, table_dates, latest_dates, workers=EXTRACT_WORKERS):
+    if workers <= 1:
+        results = []
+        for table in tables:
+            if conn is None:
+                conn = db_conn()
+            result = extract_one_table(
+                table, table_dates[table], latest_dates[table], conn
+            )
+            if result.pop("reconnect", False):
+                # otherwise every table after this one fails on it too
+                close_connection()
+                conn = None
+            results.append(result)
+        return results
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                extract_one_table, table, table_dates[table], latest_dates[table]
+            )
+            for table in tables
+        ]
+        return [future.result() for future in futures]
+
+
+def get_primary_key(conn, table):
+    rows = conn.run(
+        """SELECT kcu.column_name
+            FROM information_schema.table_constraints tc
+            JOIN information_schema.key_column_usage kcu
+            ON tc.constraint_name = kcu.constraint_name
+            AND tc.table_schema = kcu.table_schema
+            WHERE tc.constraint_type = 'PRIMARY KEY'
+            AND tc.table_schema = 'public'
+            AND tc.table_name = :table;""",
+        table=table,
+    )
+    if len(rows) != 1:
+        raise ValueError(f"Table {table} needs a single column primary key")
+    return rows[0][0]
+
+
+def fetch_keyset_page(conn, table, key, after, page_size=BACKFILL_PAGE_SIZE):
+    params = {"page_size": page_size}
+    where = ""
+    if after is not None:
+        where = f" where {identifier(key)} > :after"
+        params["after"] = after
+    return conn.run(
+        f"select {identifier(key)}, row_to_json(t) from {identifier(table)} t"
+        f"{where} order by {identifier(key)} limit :page_size;",
+        **params,
+    )
+
+
+def get_backfill_part_key(run, table, part, output_format=OUTPUT_FORMAT):
+    extension = OUTPUT_FORMATS[output_format]["extension"]
+    return f"backfill/{run}/{table}/{table}-part-{part:05d}.{extension}"
+
+
+def get_backfill_checkpoint(ssm_client=ssm_client):
+    try:
+        parameter = ssm_client.get_parameter(Name="backfill_checkpoint")
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ParameterNotFound":
+            return None
+        raise
+    return json.loads(parameter["Parameter"]["Value"])
+
+
+def save_backfill_checkpoint(checkpoint, ssm_client=ssm_client):
+    ssm_client.put_parameter(
+        Name="backfill_checkpoint",
+        Value=json.dumps(checkpoint),
+        Type="String",
+        Overwrite=True,
+    )
+
+
+def delete_backfill_checkpoint(ssm_client=ssm_client):
+    ssm_client.delete_parameter(Name="backfill_checkpoint")
+
+
+def is_running_out_of_time(context, margin=BACKFILL_TIME_MARGIN):
+    if not hasattr(context, "get_remaining_time_in_millis"):
+        return False
+    return context.get_remaining_time_in_millis() < margin
+
+
+def register_backfill_parts(checkpoint, table, s3_client=s3_client):
+    # the transform reads the parts as one extract. Its timestamp is just
+    # after the table's watermark and every extract already indexed, so no
+    # consumer has passed it yet. Incremental runs are paused until the
+    # backfill completes, so any extract made after it sorts later.
+    parts = checkpoint["tables"][table]["part"]
+    if not parts or table not in checkpoint["latest_dates"]:
+        return
+    keys = [
+        get_backfill_part_key(checkpoint["run"], table, part)
+        for part in range(1, parts + 1)
+    ]
+    index = get_extract_index(table, s3_client)
+    for entry in index.values():
+        if keys[0] in (entry if isinstance(entry, list) else [entry]):
+            # registered before the checkpoint was saved
+            return
+
+    newest = max([checkpoint["latest_dates"][table]] + list(index))
+    latest_update = datetime.datetime.strptime(
+        newest, "%Y-%m-%d %H:%M:%S.%f"
+    ) + datetime.timedelta(microseconds=1)
+    update_extract_index(table, latest_update, keys, s3_client)
+
+
+def backfill_tables(
+    conn,
+    tables,
+    context=None,
+    page_size=BACKFILL_PAGE_SIZE,
+    s3_client=s3_client,
+    ssm_client=ssm_client,
+):
+    checkpoint = get_backfill_checkpoint(ssm_client)
+    if checkpoint is None:
+        # incremental runs carry on from the watermarks seen when we started
+        latest_dates = get_latest_dates(conn, tables)
+        checkpoint = {
+            "run": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
+            "latest_dates": {
+                table: latest.strftime("%Y-%m-%d %H:%M:%S.%f")
+                for table, latest in latest_dates.items()
+                if latest is not None
+            },
+            "tables": {},
+        }
+    else:
+        logging.info(f"Resuming backfill {checkpoint['run']}")
+
+    for table in tables:
+        state = checkpoint["tables"].setdefault(
+            table, {"last_key": None, "part": 0, "done": False}
+        )
+        if state["done"]:
+            continue
+        key = get_primary_key(conn, table)
+        columns = get_output_columns(conn, table)
+
+        while True:
+            if is_running_out_of_time(context):
+                save_backfill_checkpoint(checkpoint, ssm_client)
+                logging.info(f"Backfill stopped at {table} part {state['part']}")
+                return {"status": "incomplete", "tables": checkpoint["tables"]}
+
+            rows = fetch_keyset_page(conn, table, key, state["last_key"], page_size)
+            if not rows:
+                register_backfill_parts(checkpoint, table, s3_client)
+                state["done"] = True
+                save_backfill_checkpoint(checkpoint, ssm_client)
+                logging.info(f"Backfill of {table} complete")
+                break
+
+            part = state["part"] + 1
+            upload_batches(
+                get_backfill_part_key(checkpoint["run"], table, part),
+                [[row[1] for row in rows]],
+                s3_client,
+                columns=columns,
+            )
+            state["part"] = part
+            state["last_key"] = rows[-1][0]
+            save_backfill_checkpoint(checkpoint, ssm_client)
+
+    update_table_date_parameters(
+        {
+            table: datetime.datetime.strptime(latest, "%Y-%m-%d %H:%M:%S.%f")
+            for table, latest in checkpoint["latest_dates"].items()
+        },
+        ssm_client,
+    )
+    delete_backfill_checkpoint(ssm_client)
+    return {"status": "complete", "tables": checkpoint["tables"]}
+
+
+def lambda_handler(event, context):
+    try:
+        conn = db_conn()
+        table_names = get_table_names(conn)
+        if isinstance(event, dict) and event.get("mode") == "backfill":
+            return backfill_tables(conn, table_names, context)
+        if get_backfill_checkpoint() is not None:
+            # the backfill moves the watermarks on when it completes
+            logging.info("Backfill in progress, skipping incremental extraction")
+            return {"status": "backfill_in_progress", "tables": []}
+
+        latest_dates = get_latest_dates(conn, table_names)
+
+        table_dates = get_table_date_parameters(table_names)
+        tables_to_extract = []
+        for table in table_names:
+            if has_new_data(table, latest_dates, table_dates[table]):
+                tables_to_extract.append(table)
+            else:
+                logging.info(f"There is no new data in {table}")
+
+        results = extract_tables(conn, tables_to_extract, table_dates, latest_dates)
+        failed_tables = []
+        for result in results:
+            if result["status"] == "failed":
+                # leave this table's cursor where it was so it is retried
+                failed_tables.append(result["table"])
+            else:
+                table_dates[result["table"]] = latest_dates[result["table"]]
 
-        update_date_parameter(latest_date_from_db)
+        if table_dates:
+            update_table_date_parameters(table_dates)
+        if failed_tables:
+            raise RuntimeError(f"Unable to extract tables {failed_tables}")
+        return {"tables": results}
     except Exception as e:
         logging.error(f"Unable to complete database extraction{e}", exc_info=True)
         raise e
-    # Whenever initially running this function, you need to uncomment these two lines, run it twice, obtain the data, and then commit those lines again.
-    # newest = datetime.datetime(1990, 11, 3, 14, 20, 49, 962000)
-    # update_date_parameter(newest)
+    # For an initial load invoke this function with {"mode": "backfill"} until
+    # it reports "complete", it resumes from its checkpoint after a timeout.
+    # Incremental runs are skipped until then. Each finished table is added
+    # to the extract index, the next scheduled transformation run picks it up.
 
 
 # lambda_handler(1, 2)
@@ -0,0 +1,135 @@
+import codecs
+import gzip
+import json
+
+# How each extract output format is named and described on S3. The format is
+# also stored in the object metadata so readers can pick a streaming decoder.
+OUTPUT_FORMATS = {
+    "json": {"extension": "json", "content_type": "application/json"},
+    "jsonl": {"extension": "jsonl", "content_type": "application/x-ndjson"},
+    "jsonl.gz": {
+        "extension": "jsonl.gz",
+        "content_type": "application/x-ndjson",
+        "content_encoding": "gzip",
+    },
+    "jsonl.zst": {
+        "extension": "jsonl.zst",
+        "content_type": "application/x-ndjson",
+        "content_encoding": "zstd",
+    },
+    "parquet": {
+        "extension": "parquet",
+        "content_type": "application/vnd.apache.parquet",
+    },
+}
+
+# arrow type of each postgres column type, row_to_json renders dates and
+# timestamps as ISO strings so everything else is written as a string
+ARROW_TYPES = {
+    "smallint": "int64",
+    "integer": "int64",
+    "bigint": "int64",
+    "numeric": "float64",
+    "real": "float64",
+    "double precision": "float64",
+    "boolean": "bool",
+}
+
+
+def get_upload_args(output_format):
+    details = OUTPUT_FORMATS[output_format]
+    upload_args = {
+        "ContentType": details["content_type"],
+        "Metadata": {"format": output_format},
+    }
+    if "content_encoding" in details:
+        upload_args["ContentEncoding"] = details["content_encoding"]
+    return upload_args
+
+
+def write_json_batches(batches, f):
+    row_count = 0
+    f.write("[")
+    for batch in batches:
+        for row in batch:
+            if row_count:
+                f.write(",")
+            f.write(json.dumps(row))
+            row_count += 1
+    f.write("]")
+    return row_count
+
+
+def write_json_lines_batches(batches, f):
+    row_count = 0
+    for batch in batches:
+        for row in batch:
+            f.write(json.dumps(row))
+            f.write("\n")
+            row_count += 1
+    return row_count
+
+
+def write_batches(batches, stream, output_format, columns=None):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format {output_format}")
+
+    if output_format == "parquet":
+        return write_parquet_batches(batches, stream, columns)
+
+    if output_format == "json":
+        return write_json_batches(batches, codecs.getwriter("utf-8")(stream))
+
+    if output_format == "jsonl":
+        return write_json_lines_batches(batches, codecs.getwriter("utf-8")(stream))
+
+    if output_format == "jsonl.gz":
+        compressed = gzip.GzipFile(fileobj=stream, mode="wb")
+    else:
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("jsonl.zst output needs the zstandard package") from e
+        compressed = zstandard.ZstdCompressor().stream_writer(stream, closefd=False)
+
+    # closing the compressor flushes it without closing the S3 stream
+    with compressed:
+        return write_json_lines_batches(batches, codecs.getwriter("utf-8")(compressed))
+
+
+def get_parquet_schema(columns):
+    import pyarrow as pa
+
+    # columns are [[name, postgres type], ...] in table order
+    return pa.schema(
+        [
+            pa.field(name, ARROW_TYPES.get(data_type, "string"))
+            for name, data_type in columns
+        ]
+    )
+
+
+def write_parquet_batches(batches, stream, columns=None):
+    # pyarrow is only needed for this format, keep it off the import path
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # without the source columns the schema is inferred from the first
+    # batch, which only works when none of its columns are all null
+    schema = get_parquet_schema(columns) if columns else None
+    row_count = 0
+    writer = None
+    try:
+        for batch in batches:
+            if not batch:
+                continue
+            table = pa.Table.from_pylist(batch, schema=schema)
+            if writer is None:
+                schema = table.schema
+                writer = pq.ParquetWriter(stream, schema)
+            writer.write_table(table)
+            row_count += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    return row_count
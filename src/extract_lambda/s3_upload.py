@@ -0,0 +1,140 @@
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# S3 rejects multipart parts smaller than 5MiB, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS_IN_FLIGHT = 4
+
+
+# Binary file-like object that uploads to S3 as it is written to. Bytes are
+# buffered until a whole part is available, objects smaller than one part are
+# sent with a single put_object on close. Up to max_in_flight parts upload
+# concurrently, so memory is bounded to (max_in_flight + 1) * part_size.
+class S3MultipartWriter(io.RawIOBase):
+    def __init__(
+        self,
+        bucket,
+        key,
+        s3_client,
+        part_size=MIN_PART_SIZE,
+        max_in_flight=MAX_PARTS_IN_FLIGHT,
+        **upload_args,
+    ):
+        super().__init__()
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {MIN_PART_SIZE} bytes")
+        self.bucket = bucket
+        self.key = key
+        self.s3_client = s3_client
+        self.part_size = part_size
+        self.max_in_flight = max(1, max_in_flight)
+        self.upload_args = upload_args
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.part_count = 0
+        self.parts = []
+        self.pending = []
+        self.executor = None
+        self.bytes_written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed S3MultipartWriter")
+        self.buffer.extend(data)
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[: self.part_size])
+            del self.buffer[: self.part_size]
+            self.upload_part(part)
+        return len(data)
+
+    def upload_part(self, body):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.upload_args
+            )["UploadId"]
+        self.part_count += 1
+
+        if self.max_in_flight == 1:
+            self.parts.append(self.send_part(self.part_count, body))
+            return
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        # wait for the oldest part before queueing another one
+        while len(self.pending) >= self.max_in_flight:
+            self.parts.append(self.pending.pop(0).result())
+        self.pending.append(self.executor.submit(self.send_part, self.part_count, body))
+
+    def send_part(self, part_number, body):
+        res = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        return {"ETag": res["ETag"], "PartNumber": part_number}
+
+    def wait_for_parts(self):
+        while self.pending:
+            self.parts.append(self.pending.pop(0).result())
+        self.parts.sort(key=lambda part: part["PartNumber"])
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                self.s3_client.put_object(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    Body=bytes(self.buffer),
+                    **self.upload_args,
+                )
+            else:
+                if self.buffer:
+                    self.upload_part(bytes(self.buffer))
+                self.wait_for_parts()
+                self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self.upload_id,
+                    MultipartUpload={"Parts": self.parts},
+                )
+        except Exception:
+            self.abort()
+            raise
+        self.shutdown()
+        self.buffer.clear()
+        super().close()
+
+    def abort(self):
+        if self.closed:
+            return
+        self.shutdown()
+        self.pending.clear()
+        if self.upload_id is not None:
+            try:
+                self.s3_client.abort_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+                )
+            except Exception as e:
+                logging.error(f"Unable to abort upload of {self.key} {e}")
+        self.buffer.clear()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
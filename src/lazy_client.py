@@ -0,0 +1,22 @@
+import threading
+
+
+# boto3 client that is only created when first used, so importing a lambda
+# module (and every cold start) doesn't pay for it up front. Task graph
+# threads can all reach for it at once, and creating clients concurrently on
+# boto3's default session isn't thread safe, so only one thread creates it.
+class LazyClient:
+    def __init__(self, service_name, **kwargs):
+        self._service_name = service_name
+        self._kwargs = kwargs
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+
+                    self._client = boto3.client(self._service_name, **self._kwargs)
+        return getattr(self._client, name)
@@ -1,9 +1,7 @@
-import pandas as pd
-import awswrangler
 import pg8000
-import boto3
+from src.lazy_client import LazyClient
 
-s3_client = boto3.client("s3", region_name="eu-west-2")
+s3_client = LazyClient("s3", region_name="eu-west-2")
 
 # con = pg8000.connect(
 #     "filipe", database="fake_facts_sales_order", password="mysecretword123"
@@ -36,6 +34,9 @@ def get_paquet_from(table):
 
 
 def get_data_frame_from_parquet(path):
+    # awswrangler (and pandas with it) is only loaded once there is a file
+    import awswrangler
+
     if "dim_transaction/" in path:
         df = awswrangler.s3.read_parquet(
             path=f"s3://transformation-bucket-sorceress/{path}"
@@ -109,7 +110,10 @@ def dim_staff_query():
 
 def put_df_into_warehouse(df, query, con):
     cursor = con.cursor()
-    values = [tuple(row) for row in df.to_numpy()]
+    # nullable and categorical columns hold pd.NA / NaN, pg8000 needs None
+    values = [
+        tuple(row) for row in df.astype(object).where(df.notna(), None).to_numpy()
+    ]
 
     chunck_size = 100000
 
@@ -1,11 +1,15 @@
-import boto3
 import json
-import pandas as pd
+import logging
 
-s3_client = boto3.client("s3", region_name="eu-west-2")
 
+def get_json_from_s3(table: str, s3_client=None) -> list:
+    # loaded here so importing this module has no cost or side effects
+    import boto3
+    import pandas as pd
+
+    if s3_client is None:
+        s3_client = boto3.client("s3", region_name="eu-west-2")
 
-def get_json_from_s3(table: str, s3_client=s3_client) -> list:
     extraction_bucket = s3_client.list_objects_v2(
         Bucket="extraction-bucket-sorceress",
         Prefix=table,
@@ -80,4 +84,5 @@ def get_json_from_s3(table: str, s3_client=s3_client) -> list:
     #         )
 
 
-get_json_from_s3("payment", s3_client)
+if __name__ == "__main__":
+    get_json_from_s3("payment")
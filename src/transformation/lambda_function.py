@@ -1,17 +1,303 @@
 import pandas as pd
 import logging
+import os
 import sys
 import re
 import json
-import boto3
-from datetime import datetime, timedelta
-import awswrangler
+import csv
+from urllib.parse import unquote_plus
+from botocore.exceptions import ClientError
+import time
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from src.lazy_client import LazyClient
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
 
-s3_client = boto3.client("s3", region_name="eu-west-2")
-ssm_client = boto3.client("ssm", region_name="eu-west-2")
+
+s3_client = LazyClient("s3", region_name="eu-west-2")
+ssm_client = LazyClient("ssm", region_name="eu-west-2")
+
+# calendar range covered by dim_date, DIM_DATE_END overrides DIM_DATE_DAYS
+DIM_DATE_START = os.environ.get("DIM_DATE_START", "2022-11-01")
+DIM_DATE_DAYS = int(os.environ.get("DIM_DATE_DAYS", 1000))
+DIM_DATE_END = os.environ.get("DIM_DATE_END")
+
+# extract objects downloaded at once by get_json_from_s3
+MAX_CONCURRENT_FETCHES = int(os.environ.get("MAX_CONCURRENT_FETCHES", 8))
+# decoded extract frames kept in memory during a run, and the directory they
+# are also written to so warm containers can reuse them (off when unset)
+FRAME_CACHE_MAX_BYTES = int(os.environ.get("FRAME_CACHE_MAX_BYTES", 256 * 1024**2))
+FRAME_CACHE_DIR = os.environ.get("FRAME_CACHE_DIR")
+# size of that directory, least recently used files are deleted above it
+FRAME_CACHE_SPILL_MAX_BYTES = int(
+    os.environ.get("FRAME_CACHE_SPILL_MAX_BYTES", 256 * 1024**2)
+)
+
+# primary keys stored in each parquet partition of the source state
+STATE_PARTITION_ROWS = int(os.environ.get("STATE_PARTITION_ROWS", 10000))
+
+# tasks (source fetches and dimension builds) lambda_handler runs at once
+MAX_CONCURRENT_TASKS = int(os.environ.get("MAX_CONCURRENT_TASKS", 4))
+
+# the dimension or fact table each extracted table feeds
+convert = {
+    "address": "dim_location",
+    "counterparty": "dim_counterparty",
+    "currency": "dim_currency",
+    "department": "dim_staff",
+    "design": "dim_design",
+    "payment_type": "",
+    "payment": "",
+    "purchase_order": "",
+    "sales_order": "facts_sales_order",
+    "staff": "dim_staff",
+    "transaction": "dim_transaction",
+}
+
+# pandas dtypes of every extracted table (applied when its JSON is read) and
+# every dim/fact table (applied before it is written to parquet). Columns
+# with only a handful of distinct values are stored as categoricals, ids
+# that can be missing use the nullable Int64.
+TABLE_SCHEMAS = {
+    "address": {
+        "address_id": "int64",
+        "address_line_1": "string",
+        "address_line_2": "string",
+        "district": "string",
+        "city": "string",
+        "postal_code": "string",
+        "country": "category",
+        "phone": "string",
+    },
+    "counterparty": {
+        "counterparty_id": "int64",
+        "counterparty_legal_name": "string",
+        "legal_address_id": "int64",
+        "commercial_contact": "string",
+        "delivery_contact": "string",
+    },
+    "currency": {"currency_id": "int64", "currency_code": "category"},
+    "department": {
+        "department_id": "int64",
+        "department_name": "category",
+        "location": "category",
+        "manager": "string",
+    },
+    "design": {
+        "design_id": "int64",
+        "design_name": "string",
+        "file_location": "string",
+        "file_name": "string",
+    },
+    "staff": {
+        "staff_id": "int64",
+        "first_name": "string",
+        "last_name": "string",
+        "department_id": "int64",
+        "email_address": "string",
+    },
+    "sales_order": {
+        "sales_order_id": "int64",
+        "design_id": "int64",
+        "staff_id": "int64",
+        "counterparty_id": "int64",
+        "units_sold": "int64",
+        "unit_price": "float64",
+        "currency_id": "int64",
+        "agreed_delivery_date": "string",
+        "agreed_payment_date": "string",
+        "agreed_delivery_location_id": "int64",
+    },
+    "transaction": {
+        "transaction_id": "int64",
+        "transaction_type": "category",
+        "sales_order_id": "Int64",
+        "purchase_order_id": "Int64",
+    },
+    "dim_currency": {
+        "currency_id": "int64",
+        "currency_code": "category",
+        "currency_name": "category",
+    },
+    "dim_design": {
+        "design_id": "Int64",
+        "design_name": "string",
+        "file_location": "string",
+        "file_name": "string",
+    },
+    "dim_location": {
+        "location_id": "int64",
+        "address_line_1": "string",
+        "address_line_2": "string",
+        "district": "string",
+        "city": "string",
+        "postal_code": "string",
+        "country": "category",
+        "phone": "string",
+    },
+    "dim_counterparty": {
+        "counterparty_id": "int64",
+        "counterparty_legal_name": "string",
+        "counterparty_legal_address_line_1": "string",
+        "counterparty_legal_address_line_2": "string",
+        "counterparty_legal_district": "string",
+        "counterparty_legal_city": "string",
+        "counterparty_legal_postal_code": "string",
+        "counterparty_legal_country": "category",
+        "counterparty_legal_phone_number": "string",
+    },
+    "dim_staff": {
+        "staff_id": "int64",
+        "first_name": "string",
+        "last_name": "string",
+        "email_address": "string",
+        "department_name": "category",
+        "location": "category",
+    },
+    "dim_date": {
+        "date_id": "datetime64[ns]",
+        "year": "string",
+        "month": "string",
+        "day": "string",
+        "day_of_week": "int64",
+        "day_name": "category",
+        "month_name": "category",
+        "quarter": "int64",
+    },
+    "dim_transaction": {
+        "transaction_id": "int64",
+        "transaction_type": "category",
+        "sales_order_id": "Int64",
+        "purchase_order_id": "Int64",
+    },
+    "facts_sales_order": {
+        "sales_order_id": "int64",
+        "design_id": "int64",
+        "sales_staff_id": "int64",
+        "counterparty_id": "int64",
+        "units_sold": "int64",
+        "unit_price": "float64",
+        "currency_id": "int64",
+        "agreed_delivery_date": "string",
+        "agreed_payment_date": "string",
+        "agreed_delivery_location_id": "int64",
+    },
+}
+
+
+def apply_schema(df: pd.DataFrame, table: str) -> pd.DataFrame:
+    # only converts the columns that are present and not already typed
+    dtypes = {
+        column: dtype
+        for column, dtype in TABLE_SCHEMAS.get(table, {}).items()
+        if column in df.columns and str(df[column].dtype) != dtype
+    }
+    return df.astype(dtypes) if dtypes else df
+
+
+def json_to_frame(table: str, json_object: list) -> pd.DataFrame:
+    return apply_schema(pd.DataFrame(json_object), table)
+
+
+# extract file formats written by the extract lambda, longest suffix first
+EXTRACT_FORMATS = ["jsonl.gz", "jsonl.zst", "jsonl", "parquet", "json", "csv"]
+
+
+def get_extract_format(key: str, metadata: dict = None) -> str:
+    if metadata and metadata.get("format") in EXTRACT_FORMATS:
+        return metadata["format"]
+    for extract_format in EXTRACT_FORMATS:
+        if key.endswith(f".{extract_format}"):
+            return extract_format
+    raise ValueError(f"Unknown extract format for {key}")
+
+
+def get_arrow_schema(table: str, columns: list):
+    import pyarrow as pa
+
+    arrow_types = {
+        "int64": pa.int64(),
+        "Int64": pa.int64(),
+        "float64": pa.float64(),
+        "string": pa.string(),
+        "category": pa.string(),
+        "datetime64[ns]": pa.timestamp("ns"),
+    }
+    # timestamps stay strings, parse_timestamps handles them in one pass
+    dtypes = {"created_at": "string", "last_updated": "string"}
+    dtypes.update(TABLE_SCHEMAS.get(table, {}))
+    # only the columns in the file, the reader would add the others as nulls
+    return pa.schema(
+        [
+            pa.field(column, arrow_types[dtype])
+            for column, dtype in dtypes.items()
+            if column in columns
+        ]
+    )
+
+
+def read_extract_frame(table: str, body: bytes, extract_format: str) -> pd.DataFrame:
+    if extract_format == "json":
+        return json_to_frame(table, json.loads(body))
+    if not body:
+        return pd.DataFrame()
+
+    # decode straight into arrow columns instead of a list of row dicts
+    import pyarrow as pa
+
+    if extract_format == "parquet":
+        import pyarrow.parquet as pq
+
+        arrow_table = pq.read_table(pa.BufferReader(body))
+    elif extract_format == "csv":
+        import pyarrow.csv as pa_csv
+
+        # COPY ... (format csv, header): unquoted empty fields are nulls,
+        # quoted ones are empty strings and booleans are t/f
+        columns = next(csv.reader([body.split(b"\n", 1)[0].decode()]))
+        convert_options = pa_csv.ConvertOptions(
+            column_types=get_arrow_schema(table, columns),
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False,
+            true_values=["t"],
+            false_values=["f"],
+        )
+        arrow_table = pa_csv.read_csv(
+            pa.BufferReader(body), convert_options=convert_options
+        )
+    else:
+        import pyarrow.json as pa_json
+
+        if extract_format != "jsonl":
+            compression = "gzip" if extract_format == "jsonl.gz" else "zstd"
+            body = pa.CompressedInputStream(pa.BufferReader(body), compression).read()
+        first_line_end = body.find(b"\n")
+        first_row = body if first_line_end == -1 else body[:first_line_end]
+        if not first_row.strip():
+            return pd.DataFrame()
+        columns = list(json.loads(first_row))
+        parse_options = pa_json.ParseOptions(
+            explicit_schema=get_arrow_schema(table, columns),
+            unexpected_field_behavior="infer",
+        )
+        arrow_table = pa_json.read_json(
+            pa.BufferReader(body), parse_options=parse_options
+        )
+        # explicitly typed columns come first, put them back in file order
+        arrow_table = arrow_table.select(
+            columns + [c for c in arrow_table.column_names if c not in columns]
+        )
+
+    df = arrow_table.to_pandas(split_blocks=True, self_destruct=True)
+    return apply_schema(df, table)
+
 
 # ---dimension design----------
 file_path = "data/test_design_data.json"
@@ -29,58 +315,307 @@ def get_latest_date_parameter(ssm_client=ssm_client):
 # ------new json fx
 
 
-def get_json_from_s3(table: str, s3_client=s3_client) -> list:
-    extraction_bucket = s3_client.list_objects_v2(
-        Bucket="extraction-bucket-sorceress",
-        Prefix=table,
+def list_keys(bucket: str, prefix: str, s3_client=s3_client) -> list:
+    paginator = s3_client.get_paginator("list_objects_v2")
+    return [
+        object["Key"]
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for object in page.get("Contents", [])
+    ]
+
+
+# LRU cache of decoded extract frames keyed by (table, extract key). Extract
+# keys are never overwritten, so a cached frame never goes stale. Frames are
+# shared between builders, which must not modify them in place.
+class FrameCache:
+    def __init__(
+        self,
+        max_bytes=FRAME_CACHE_MAX_BYTES,
+        spill_dir=FRAME_CACHE_DIR,
+        spill_max_bytes=FRAME_CACHE_SPILL_MAX_BYTES,
+    ):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.frames = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_spill_path(self, table, key):
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.spill_dir, table, f"{name}.feather")
+
+    def get(self, table, key):
+        with self.lock:
+            if (table, key) in self.frames:
+                self.frames.move_to_end((table, key))
+                self.hits += 1
+                return self.frames[(table, key)][0]
+
+        if self.spill_dir and os.path.exists(self.get_spill_path(table, key)):
+            path = self.get_spill_path(table, key)
+            df = pd.read_feather(path)
+            # the modification time orders spilled files for eviction
+            os.utime(path)
+            self.put(table, key, df, spill=False)
+            with self.lock:
+                self.hits += 1
+            return df
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, table, key, df, spill=True):
+        size = int(df.memory_usage(deep=True).sum())
+        with self.lock:
+            if (table, key) in self.frames:
+                self.size -= self.frames.pop((table, key))[1]
+            if size <= self.max_bytes:
+                self.frames[(table, key)] = [df, size]
+                self.size += size
+            while self.size > self.max_bytes:
+                _, [_, evicted_size] = self.frames.popitem(last=False)
+                self.size -= evicted_size
+
+        if spill and self.spill_dir:
+            try:
+                path = self.get_spill_path(table, key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # write then rename so a concurrent reader never sees half a file
+                df.reset_index(drop=True).to_feather(f"{path}.tmp")
+                os.replace(f"{path}.tmp", path)
+            except Exception as e:
+                logging.warning(f"Unable to spill {key} to {self.spill_dir}: {e}")
+            self.evict_spilled()
+
+    def evict_spilled(self):
+        # the directory outlives the cache in a warm container, so it is
+        # scanned rather than tracked in memory
+        files = []
+        for root, _, names in os.walk(self.spill_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append([stat.st_mtime_ns, stat.st_size, path])
+
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, path in sorted(files):
+            if size <= self.spill_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.size = 0
+
+
+def fetch_extract_frames(
+    table: str,
+    keys: list,
+    s3_client=s3_client,
+    max_workers: int = MAX_CONCURRENT_FETCHES,
+    cache: FrameCache = None,
+) -> list:
+    def fetch(key):
+        if cache is not None:
+            df = cache.get(table, key)
+            if df is not None:
+                return df
+        res = s3_client.get_object(Bucket="extraction-bucket-sorceress", Key=key)
+        extract_format = get_extract_format(key, res.get("Metadata"))
+        df = read_extract_frame(table, res["Body"].read(), extract_format)
+        if cache is not None:
+            cache.put(table, key, df)
+        return df
+
+    if not keys:
+        return []
+    # map keeps the results in the same order as the keys
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(fetch, keys))
+
+
+def read_json_object(bucket: str, key: str, s3_client=s3_client):
+    try:
+        return json.load(s3_client.get_object(Bucket=bucket, Key=key)["Body"])
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None
+        raise
+
+
+def get_manifest_key(table: str) -> str:
+    return f"manifests/{table}.json"
+
+
+def get_index_entries(index: dict) -> list:
+    # [[extract timestamp, key], ...] oldest first, a backfill registers all
+    # of its parts under one timestamp
+    return [
+        [latest_update, key]
+        for latest_update, keys in sorted(index.items())
+        for key in (keys if isinstance(keys, list) else [keys])
+    ]
+
+
+def get_listed_entries(table: str, s3_client=s3_client) -> list:
+    # [[extract timestamp, key], ...] for every extract under <table>/, the
+    # listing sorts by month name so they are put back in extract order
+    keys = list_keys("extraction-bucket-sorceress", f"{table}/", s3_client)
+    return sorted(
+        [get_latest_update_from_key(key), key]
+        for key in keys
+        if EXTRACT_KEY_REGEX.search(key)
     )
-    if "Contents" in extraction_bucket:
-        extraction_bucket = [object["Key"] for object in extraction_bucket["Contents"]]
 
-    transformation_bucket = s3_client.list_objects_v2(
-        Bucket="transformation-bucket-sorceress", Prefix=table
+
+def merge_entries(*entry_lists) -> list:
+    # union of [[extract timestamp, key], ...] lists, each key once
+    entries = {}
+    for entry_list in entry_lists:
+        for latest_update, key in entry_list:
+            entries.setdefault(key, latest_update)
+    return sorted(
+        [[latest_update, key] for key, latest_update in entries.items()],
+        key=lambda entry: entry[0],
     )
-    if "Contents" in transformation_bucket:
-        transformation_bucket = [
-            object["Key"] for object in transformation_bucket["Contents"]
-        ]
 
-    convert = {
-        "address": "dim_location",
-        "counterparty": "dim_counterparty",
-        "currency": "dim_currency",
-        "department": "dim_staff",
-        "design": "dim_design",
-        "payment_type": "",
-        "payment": "",
-        "purchase_order": "",
-        "sales_order": "facts_sales_order",
-        "staff": "dim_staff",
-        "transaction": "",
-    }
 
-    if table == "payment":
-        extraction_bucket = [i for i in extraction_bucket if "payment_type" not in i]
-        transformation_bucket = [
-            i for i in transformation_bucket if "payment_type" not in i
-        ]
+def get_pending_from_manifest(table: str, consumer: str, s3_client=s3_client):
+    # the extract lambda keeps {extract timestamp: key} for every table, and
+    # we keep the last timestamp each consumer has processed
+    index = read_json_object(
+        "extraction-bucket-sorceress", get_manifest_key(table), s3_client
+    )
+    if index is None:
+        return None
+    manifest = (
+        read_json_object(
+            "transformation-bucket-sorceress", get_manifest_key(table), s3_client
+        )
+        or {}
+    )
+    if consumer not in manifest:
+        # the index only has extracts written since it was introduced, older
+        # ones this consumer hasn't processed are found by listing
+        return merge_entries(
+            get_index_entries(index),
+            get_pending_from_listing(table, consumer, s3_client),
+        )
+    return [
+        [latest_update, key]
+        for latest_update, key in get_index_entries(index)
+        if latest_update > manifest[consumer]
+    ]
 
-    json_to_parquet = [
-        [
-            extract_ojb[-31:-5],
-            pd.DataFrame(
-                json.load(
-                    s3_client.get_object(
-                        Bucket="extraction-bucket-sorceress", Key=extract_ojb
-                    )["Body"]
-                )
-            ),
+
+def get_pending_from_listing(
+    table: str, consumer: str = None, s3_client=s3_client
+) -> list:
+    consumer = consumer or convert[table]
+    pending = get_listed_entries(table, s3_client)
+    manifest = (
+        read_json_object(
+            "transformation-bucket-sorceress", get_manifest_key(table), s3_client
+        )
+        or {}
+    )
+    if consumer in manifest:
+        return [
+            [latest_update, key]
+            for latest_update, key in pending
+            if latest_update > manifest[consumer]
         ]
-        for extract_ojb in extraction_bucket
-        if extract_ojb.replace(table, convert[table]).replace("json", "parquet")
+
+    # consumers that ran before the manifest existed, a file is done once
+    # its parquet file has been written
+    transformation_bucket = set(
+        list_keys("transformation-bucket-sorceress", consumer, s3_client)
+    )
+    return [
+        [latest_update, key]
+        for latest_update, key in pending
+        if key.replace(table, consumer).replace("json", "parquet")
         not in transformation_bucket
     ]
 
+
+# consumers of the same table run concurrently in the task graph, each
+# manifest is read, updated and written back by one thread at a time
+manifest_locks = {}
+manifest_locks_lock = threading.Lock()
+
+
+def get_manifest_lock(table: str) -> threading.Lock:
+    with manifest_locks_lock:
+        return manifest_locks.setdefault(table, threading.Lock())
+
+
+def mark_processed(table: str, consumer: str, latest_update: str, s3_client=s3_client):
+    with get_manifest_lock(table):
+        manifest = (
+            read_json_object(
+                "transformation-bucket-sorceress", get_manifest_key(table), s3_client
+            )
+            or {}
+        )
+        if latest_update <= manifest.get(consumer, ""):
+            return
+        manifest[consumer] = latest_update
+        s3_client.put_object(
+            Bucket="transformation-bucket-sorceress",
+            Key=get_manifest_key(table),
+            Body=json.dumps(manifest, sort_keys=True),
+        )
+
+
+def get_source_frames(
+    table: str, consumers: list, s3_client=s3_client, cache: FrameCache = None
+) -> dict:
+    # every consumer has its own pending files, each file is only fetched
+    # once even when several consumers need it
+    pending = {}
+    for consumer in consumers:
+        consumer_pending = get_pending_from_manifest(table, consumer, s3_client)
+        if consumer_pending is None:
+            # tables extracted before the manifest existed
+            consumer_pending = get_pending_from_listing(table, consumer, s3_client)
+        pending[consumer] = consumer_pending
+
+    keys = list(dict.fromkeys(key for p in pending.values() for _, key in p))
+    frames = dict(zip(keys, fetch_extract_frames(table, keys, s3_client, cache=cache)))
+
+    sources = {}
+    for consumer, p in pending.items():
+        # the parts of a backfill share a timestamp and become one frame
+        grouped = {}
+        for latest_update, key in p:
+            grouped.setdefault(latest_update, []).append(frames[key])
+        sources[consumer] = [
+            [
+                latest_update,
+                (group[0] if len(group) == 1 else pd.concat(group, ignore_index=True)),
+            ]
+            for latest_update, group in grouped.items()
+        ]
+    return sources
+
+
+def get_json_from_s3(table: str, s3_client=s3_client, consumer: str = None) -> list:
+    consumer = consumer or convert[table]
+    json_to_parquet = get_source_frames(table, [consumer], s3_client)[consumer]
+
     if json_to_parquet:
         logging.info(f"There is new data in {table}")
         return json_to_parquet
@@ -104,22 +639,11 @@ def remove_null_values(df, col):
 
 
 def design_schema(df):
-    dim_design_schema = {
-        "design_id": pd.Int64Dtype(),
-        "design_name": pd.StringDtype(),
-        "file_location": pd.StringDtype(),
-        "file_name": pd.StringDtype(),
-    }
-
-    dim_design_df = pd.DataFrame(
-        {
-            column: pd.Series(dtype=column_type)
-            for column, column_type in dim_design_schema.items()
-        }
-    )
-
-    dim_design_df = pd.concat([dim_design_df, df], ignore_index="True")
-    dim_design_df = dim_design_df.dropna()
+    schema = TABLE_SCHEMAS["dim_design"]
+    # schema columns first, like the rest of the dimension tables
+    columns = list(schema) + [column for column in df.columns if column not in schema]
+    dim_design_df = apply_schema(df.reindex(columns=columns), "dim_design")
+    dim_design_df = dim_design_df.reset_index(drop=True).dropna()
     return dim_design_df
 
 
@@ -225,6 +749,15 @@ def dim_counterparty(counterparty_df, address_df):
 
 
 # -----DIMENSION TABLE: STAFF
+
+EMAIL_REGEX = re.compile(r"^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$")
+
+
+def is_valid_email(emails: pd.Series) -> pd.Series:
+    # one regex pass over the whole column, missing emails are invalid
+    return emails.astype("string").str.match(EMAIL_REGEX).fillna(False).astype(bool)
+
+
 def staff_schema(staff_df: pd.DataFrame, department_df: pd.DataFrame):
     df = pd.merge(
         staff_df,
@@ -256,16 +789,11 @@ def staff_schema(staff_df: pd.DataFrame, department_df: pd.DataFrame):
         how="any",
     )
 
-    # Define a regular expression for email validation
-    email_regex = r"^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$"
-
-    # Function to validate email using regex
-    def is_valid_email(email):
-        return bool(re.match(email_regex, email)) if pd.notnull(email) else False
-
-    # Apply email validation with vectorized approach (efficient)
-    df = df[df["email_address"].apply(is_valid_email)]
-    return df
+    valid_email = is_valid_email(df["email_address"])
+    rejected = int((~valid_email).sum())
+    if rejected:
+        logging.warning(f"Rejected {rejected} staff rows with an invalid email address")
+    return df[valid_email]
 
 
 def dim_staff(staff_df, departments_df):
@@ -317,45 +845,60 @@ def dim_currency(df):
 
 
 # -----DIMENSION TABLE: DATE
-def dim_date():
-    # if there is a file in dim date do not run this code
-
-    day_dict = {
-        "date_id": [],
-        "year": [],
-        "month": [],
-        "day": [],
-        "day_of_week": [],
-        "day_name": [],
-        "month_name": [],
-        "quarter": [],
-    }
+def get_dim_date_range():
+    start_date = pd.Timestamp(DIM_DATE_START)
+    if DIM_DATE_END:
+        return start_date, pd.Timestamp(DIM_DATE_END)
+    return start_date, start_date + pd.Timedelta(days=DIM_DATE_DAYS - 1)
 
-    # 2022-11-01
-    start_date = datetime(2022, 11, 1)
-    # end_date = datateime_str
-    # days_to_create = (end_date - start_date).days
-
-    for i in range(1000):
-        date = start_date + timedelta(days=i)
-        day_dict["date_id"].append(
-            datetime(
-                int(date.strftime("%Y")),
-                int(date.strftime("%m")),
-                int(date.strftime("%d")),
-            )
-        )
-        day_dict["year"].append(date.strftime("%Y"))
-        day_dict["month"].append(date.strftime("%m"))
-        day_dict["day"].append(date.strftime("%d"))
-        day_dict["day_of_week"].append(int(date.strftime("%w")) + 1)
-        day_dict["day_name"].append(date.strftime("%A"))
-        day_dict["month_name"].append(date.strftime("%B"))
-        day_dict["quarter"].append((int(date.strftime("%m")) - 1) // 3 + 1)
 
-    dim_date_data = pd.DataFrame(day_dict)
+def dim_date(start_date=None, end_date=None):
+    if start_date is None or end_date is None:
+        default_start, default_end = get_dim_date_range()
+        start_date = default_start if start_date is None else start_date
+        end_date = default_end if end_date is None else end_date
 
-    return dim_date_data
+    dates = pd.Series(pd.date_range(start_date, end_date, freq="D").normalize())
+
+    return pd.DataFrame(
+        {
+            "date_id": dates,
+            "year": dates.dt.strftime("%Y"),
+            "month": dates.dt.strftime("%m"),
+            "day": dates.dt.strftime("%d"),
+            # strftime %w + 1, so Sunday is 1 and Saturday is 7
+            "day_of_week": ((dates.dt.dayofweek + 1) % 7 + 1).astype("int64"),
+            "day_name": dates.dt.strftime("%A"),
+            "month_name": dates.dt.strftime("%B"),
+            "quarter": dates.dt.quarter.astype("int64"),
+        }
+    )
+
+
+def get_last_dim_date(s3_client=s3_client):
+    # dim_date files are named after the last day they contain
+    keys = list_keys("transformation-bucket-sorceress", "dim_date/", s3_client)
+    last_dates = [
+        pd.Timestamp(get_latest_update_from_key(key))
+        for key in keys
+        if EXTRACT_KEY_REGEX.search(key)
+    ]
+    return max(last_dates, default=None)
+
+
+def update_dim_date(s3_client=s3_client):
+    start_date, end_date = get_dim_date_range()
+    last_date = get_last_dim_date(s3_client)
+    if last_date is not None:
+        if last_date >= end_date:
+            logging.info(f"dim_date already covers up to {end_date.date()}")
+            return None
+        # only the days added since the last run
+        start_date = max(start_date, last_date + pd.Timedelta(days=1))
+
+    date_df = dim_date(start_date, end_date)
+    save_parquet_to_s3("dim_date", f"{end_date}.000000", date_df)
+    return date_df
 
 
 #     # transformation-bucket-sorceress
@@ -380,19 +923,23 @@ def dim_transaction(df):
         if df.empty:
             raise ValueError("Dataframe is empty")
         else:
+            # missing order ids stay null, the load lambda fills them in
             df = df.drop(["created_at", "last_updated"], axis=1)
-            df["sales_order_id"].fillna("None")
-            df["purchase_order_id"].fillna("None")
             return df
     except Exception as e:
         logging.error("Error processing in dataframe")
         raise e
 
 
-def standardize_timestamp(ts):
-    if "." not in ts:
-        ts += ".000"
-    return ts
+def parse_timestamps(timestamps: pd.Series) -> pd.Series:
+    if pd.api.types.is_datetime64_any_dtype(timestamps):
+        return timestamps
+    # postgres drops the fraction for whole seconds, pad it so every value
+    # matches one explicit format
+    timestamps = timestamps.astype("string").str.replace(" ", "T", n=1, regex=False)
+    has_fraction = timestamps.str.contains(".", regex=False)
+    timestamps = timestamps.where(has_fraction, timestamps + ".000")
+    return pd.to_datetime(timestamps, format="%Y-%m-%dT%H:%M:%S.%f")
 
 
 def fact_sales_order(df):
@@ -400,109 +947,672 @@ def fact_sales_order(df):
         if df.empty:
             raise ValueError("Dataframe is empty")
         else:
-
-            df["created_at"] = df["created_at"].apply(standardize_timestamp)
-            df["last_updated"] = df["last_updated"].apply(standardize_timestamp)
-            # this need to be turned into date time to use dt.time/dt.date
-            df["created_at"] = pd.to_datetime(df["created_at"])
-            df["created_date"] = pd.to_datetime(df["created_at"]).dt.date
-            df["created_time"] = pd.to_datetime(df["created_at"]).dt.time
-            df["last_updated"] = pd.to_datetime(df["last_updated"])
-            df["last_date"] = pd.to_datetime(df["last_updated"]).dt.date
-            df["last_time"] = pd.to_datetime(df["last_updated"]).dt.time
-            df = df.rename(columns={"staff_id": "sales_staff_id"})
+            created_at = parse_timestamps(df["created_at"])
+            last_updated = parse_timestamps(df["last_updated"])
             df = df.drop(["last_updated", "created_at"], axis=1)
+            df["created_date"] = created_at.dt.date
+            df["created_time"] = created_at.dt.time
+            df["last_date"] = last_updated.dt.date
+            df["last_time"] = last_updated.dt.time
+            df = df.rename(columns={"staff_id": "sales_staff_id"})
             return df
     except Exception as e:
         logging.error("Error processing in dataframe")
         raise e
 
 
-def save_parquet_to_s3(table_name: str, latest_update: str, df: pd.DataFrame):
+def save_parquet_to_s3(
+    table_name: str, latest_update: str, df: pd.DataFrame, source: str = None
+):
     if df.empty:
         raise ValueError("Dataframe is empty")
     date_str = datetime.strptime(latest_update, "%Y-%m-%d %H:%M:%S.%f")
+    # joined tables are written once per source table that changed, which can
+    # share a timestamp, so the source keeps their files apart
+    name = f"{table_name}-{date_str}" + (f"-{source}" if source else "")
     file_name = (
         f"s3://transformation-bucket-sorceress/{table_name}/"
         f"{date_str.year}-{date_str.strftime('%B')}/"
-        f"{table_name}-{date_str}.parquet"
+        f"{name}.parquet"
     )
 
+    # awswrangler takes seconds to import, only load it once there is a file
+    import awswrangler
+
     awswrangler.s3.to_parquet(
-        df=df,
+        df=apply_schema(df, table_name),
         path=file_name,
     )
-    logging.info(
-        f"File: {table_name}-{date_str}.parquet has been created successfully."
+    logging.info(f"File: {name}.parquet has been created successfully.")
+
+
+# -----CHANGE DETECTION
+
+# primary key of each dim/fact table. Rows are only written when the hash of
+# their other columns differs from the last one written for that key, so
+# updates that only touched timestamps are skipped.
+DIMENSION_KEYS = {
+    "dim_currency": "currency_id",
+    "dim_design": "design_id",
+    "dim_location": "location_id",
+    "dim_counterparty": "counterparty_id",
+    "dim_staff": "staff_id",
+    "dim_transaction": "transaction_id",
+    "facts_sales_order": "sales_order_id",
+}
+HASH_EXCLUDED_COLUMNS = [
+    "created_at",
+    "last_updated",
+    "created_date",
+    "created_time",
+    "last_date",
+    "last_time",
+]
+
+
+def get_hash_index_key(dimension: str) -> str:
+    return f"hashes/{dimension}.parquet"
+
+
+def hash_rows(dimension: str, df: pd.DataFrame) -> pd.Series:
+    key = DIMENSION_KEYS[dimension]
+    columns = sorted(
+        column
+        for column in df.columns
+        if column != key and column not in HASH_EXCLUDED_COLUMNS
+    )
+    # typed first so a value hashes the same whichever dtype it arrived as
+    hashes = pd.util.hash_pandas_object(
+        apply_schema(df, dimension)[columns], index=False
     )
+    return pd.Series(hashes.to_numpy().view("int64"), index=df.index)
 
 
-def lambda_handler(event, context):
+def load_hash_index(dimension: str, s3_client=s3_client) -> pd.Series:
     try:
-        # currency
-        for latest_update, currency_df_json in get_json_from_s3("currency"):
-            currency_df = dim_currency(currency_df_json)
-            save_parquet_to_s3("dim_currency", latest_update, currency_df)
+        body = s3_client.get_object(
+            Bucket="transformation-bucket-sorceress",
+            Key=get_hash_index_key(dimension),
+        )["Body"].read()
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return pd.Series(dtype="Int64")
+        raise
+    df = pd.read_parquet(io.BytesIO(body))
+    return pd.Series(df["hash"].to_numpy(), index=df["key"]).astype("Int64")
+
+
+def save_hash_index(dimension: str, index: pd.Series, s3_client=s3_client):
+    buffer = io.BytesIO()
+    pd.DataFrame(
+        {"key": index.index.astype("int64"), "hash": index.astype("int64")}
+    ).to_parquet(buffer, index=False)
+    s3_client.put_object(
+        Bucket="transformation-bucket-sorceress",
+        Key=get_hash_index_key(dimension),
+        Body=buffer.getvalue(),
+    )
+
+
+def save_changed_rows(
+    dimension: str,
+    latest_update: str,
+    df: pd.DataFrame,
+    s3_client=s3_client,
+    source: str = None,
+) -> int:
+    if dimension not in DIMENSION_KEYS:
+        save_parquet_to_s3(dimension, latest_update, df, source=source)
+        return len(df)
+
+    key = DIMENSION_KEYS[dimension]
+    hashes = hash_rows(dimension, df)
+    index = load_hash_index(dimension, s3_client)
+    unchanged = (df[key].map(index) == hashes).fillna(False).astype(bool)
+    changed_df = df[~unchanged]
+    logging.info(
+        f"{dimension}: {len(changed_df)} changed rows, "
+        f"{int(unchanged.sum())} unchanged rows skipped"
+    )
+    if changed_df.empty:
+        return 0
+
+    save_parquet_to_s3(dimension, latest_update, changed_df, source=source)
+    changed_hashes = pd.Series(
+        hashes[~unchanged].to_numpy(), index=changed_df[key].astype("int64")
+    ).astype("Int64")
+    changed_hashes = changed_hashes[~changed_hashes.index.duplicated(keep="last")]
+    index = pd.concat([index[~index.index.isin(changed_hashes.index)], changed_hashes])
+    save_hash_index(dimension, index, s3_client)
+    return len(changed_df)
 
-        # staff
-        for staff_department_df_json in [
-            [
-                get_json_from_s3("staff"),
-                get_json_from_s3("department"),
-            ]
-        ]:
 
-            staff_df = dim_staff(
-                staff_department_df_json[0][0][1], staff_department_df_json[1][0][1]
+# -----EVENT DRIVEN TRANSFORMATION
+
+EXTRACT_KEY_REGEX = re.compile(
+    r"-(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(?:\.\d{1,6})?)\.[a-z.]+$"
+)
+
+
+def is_s3_event(event) -> bool:
+    return isinstance(event, dict) and bool(event.get("Records"))
+
+
+def get_event_records(event: dict) -> list:
+    # [[sqs message id or None, bucket, key], ...] for S3 events sent
+    # directly or through an SQS queue
+    event_records = []
+    for record in event.get("Records", []):
+        if record.get("eventSource") == "aws:sqs":
+            body = json.loads(record["body"])
+            s3_records = body.get("Records", [])
+            message_id = record["messageId"]
+        else:
+            s3_records = [record]
+            message_id = None
+        for s3_record in s3_records:
+            if "s3" not in s3_record:
+                continue
+            event_records.append(
+                [
+                    message_id,
+                    s3_record["s3"]["bucket"]["name"],
+                    unquote_plus(s3_record["s3"]["object"]["key"]),
+                ]
             )
-            save_parquet_to_s3("dim_staff", staff_department_df_json[0][0][0], staff_df)
+    return event_records
+
+
+def get_latest_update_from_key(key: str) -> str:
+    match = EXTRACT_KEY_REGEX.search(key)
+    if not match:
+        raise ValueError(f"No extract timestamp in {key}")
+    latest_update = match.group(1)
+    if "." not in latest_update:
+        latest_update += ".000000"
+    return datetime.strptime(latest_update, "%Y-%m-%d %H:%M:%S.%f").strftime(
+        "%Y-%m-%d %H:%M:%S.%f"
+    )
 
-        # counterparty
-        for counterparty_address_df_json in [
-            [
-                get_json_from_s3("counterparty"),
-                get_json_from_s3("address"),
-            ]
-        ]:
-            counterparty_df = dim_counterparty(
-                counterparty_address_df_json[0][0][1],
-                counterparty_address_df_json[1][0][1],
+
+def load_table_snapshot(
+    table: str, s3_client=s3_client, cache: FrameCache = None
+) -> pd.DataFrame:
+    # every extract of a lookup table, newest row per primary key
+    index = read_json_object(
+        "extraction-bucket-sorceress", get_manifest_key(table), s3_client
+    )
+    # extracts from before the index existed are only found by listing
+    entries = get_listed_entries(table, s3_client)
+    if index is not None:
+        entries = merge_entries(get_index_entries(index), entries)
+    keys = [key for _, key in entries]
+    frames = fetch_extract_frames(table, keys, s3_client, cache=cache)
+    if not frames:
+        return pd.DataFrame()
+    df = apply_schema(pd.concat(frames, ignore_index=True), table)
+    return df.drop_duplicates(subset=[f"{table}_id"], keep="last")
+
+
+# -----SOURCE STATE
+
+# The current row of every source table is kept in the transformation bucket
+# as parquet partitions of STATE_PARTITION_ROWS primary keys each:
+#   state/<table>/part-<primary key // partition rows>.parquet
+# Ids only grow, so a delta mostly rewrites the newest partition and the cost
+# of an upsert follows the size of the delta rather than the table's history.
+
+
+def get_state_meta_key(table: str) -> str:
+    return f"state/{table}/_meta.json"
+
+
+def get_state_part_key(table: str, part: int) -> str:
+    return f"state/{table}/part-{part:06d}.parquet"
+
+
+def get_state_parts(meta: dict, keys) -> list:
+    parts = pd.Series(keys, dtype="int64") // meta["partition_rows"]
+    return sorted(int(part) for part in parts.unique())
+
+
+def list_state_parts(table: str, s3_client=s3_client) -> list:
+    keys = list_keys(
+        "transformation-bucket-sorceress", f"state/{table}/part-", s3_client
+    )
+    return sorted(int(key[-14:-8]) for key in keys)
+
+
+def read_state_parts(table: str, parts: list, s3_client=s3_client) -> pd.DataFrame:
+    def read_part(part):
+        try:
+            res = s3_client.get_object(
+                Bucket="transformation-bucket-sorceress",
+                Key=get_state_part_key(table, part),
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise
+        return pd.read_parquet(io.BytesIO(res["Body"].read()))
+
+    if not parts:
+        return pd.DataFrame()
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FETCHES) as executor:
+        frames = [df for df in executor.map(read_part, parts) if df is not None]
+    if not frames:
+        return pd.DataFrame()
+    return apply_schema(pd.concat(frames, ignore_index=True), table)
+
+
+def write_state_parts(
+    table: str, df: pd.DataFrame, meta: dict, parts: list, s3_client=s3_client
+):
+    row_parts = (
+        df[f"{table}_id"].astype("int64") // meta["partition_rows"]
+        if not df.empty
+        else pd.Series(dtype="int64")
+    )
+    for part in parts:
+        part_df = df[row_parts == part]
+        if part_df.empty:
+            s3_client.delete_object(
+                Bucket="transformation-bucket-sorceress",
+                Key=get_state_part_key(table, part),
             )
-            save_parquet_to_s3(
-                "dim_counterparty",
-                counterparty_address_df_json[0][0][0],
-                counterparty_df,
+            continue
+        buffer = io.BytesIO()
+        part_df.reset_index(drop=True).to_parquet(buffer, index=False)
+        s3_client.put_object(
+            Bucket="transformation-bucket-sorceress",
+            Key=get_state_part_key(table, part),
+            Body=buffer.getvalue(),
+        )
+
+
+def ensure_state(table: str, s3_client=s3_client, cache: FrameCache = None) -> dict:
+    meta = read_json_object(
+        "transformation-bucket-sorceress", get_state_meta_key(table), s3_client
+    )
+    if meta is not None:
+        return meta
+
+    # first run for this table, build the state from every extract once
+    logging.info(f"No saved state for {table}, building it from its extracts")
+    meta = {"key": f"{table}_id", "partition_rows": STATE_PARTITION_ROWS}
+    snapshot = load_table_snapshot(table, s3_client, cache)
+    if not snapshot.empty:
+        parts = get_state_parts(meta, snapshot[meta["key"]])
+        write_state_parts(table, snapshot, meta, parts, s3_client)
+    s3_client.put_object(
+        Bucket="transformation-bucket-sorceress",
+        Key=get_state_meta_key(table),
+        Body=json.dumps(meta),
+    )
+    return meta
+
+
+def upsert_rows(table: str, state: pd.DataFrame, changes: pd.DataFrame):
+    key = f"{table}_id"
+    if changes.empty:
+        return state
+    changes = changes.drop_duplicates(subset=[key], keep="last")
+    if not state.empty:
+        state = state[~state[key].isin(changes[key])]
+    if state.empty:
+        return changes.reset_index(drop=True)
+    state = pd.concat([state, changes], ignore_index=True)
+    # categories differ between frames, concat leaves those columns as object
+    return apply_schema(state, table)
+
+
+def concat_pending(pending: list) -> pd.DataFrame:
+    frames = [df for _, df in pending if not df.empty]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
+def upsert_state(
+    table: str, pending: list, s3_client=s3_client, cache: FrameCache = None
+) -> dict:
+    changes = concat_pending(sorted(pending, key=lambda p: p[0]))
+    counts = {"inserted": 0, "updated": 0, "stale": 0}
+    if changes.empty:
+        return counts
+
+    meta = ensure_state(table, s3_client, cache)
+    key = meta["key"]
+    changes = changes.drop_duplicates(subset=[key], keep="last")
+    parts = get_state_parts(meta, changes[key])
+    current = read_state_parts(table, parts, s3_client)
+
+    # a row only replaces the stored one if it is at least as recent, so
+    # extracts applied out of order never roll a row back
+    is_new = pd.Series(True, index=changes.index)
+    is_newer = pd.Series(True, index=changes.index)
+    if not current.empty:
+        is_new = ~changes[key].isin(current[key])
+        if "last_updated" in changes.columns and "last_updated" in current.columns:
+            stored_update = parse_timestamps(current.set_index(key)["last_updated"])
+            is_newer = is_new | (
+                parse_timestamps(changes["last_updated"])
+                >= changes[key].map(stored_update)
             )
 
-        # design
-        for latest_update, design_df_json in get_json_from_s3("design"):
-            design_df = dim_design(design_df_json)
-            save_parquet_to_s3("dim_design", latest_update, design_df)
-
-        # location
-        for latest_update, location_df_json in get_json_from_s3("address"):
-            location_df = dim_location(location_df_json)
-            save_parquet_to_s3("dim_location", latest_update, location_df)
-
-        # transaction
-        for latest_update, transaction_df_json in get_json_from_s3("transaction"):
-            transaction_df = dim_transaction(transaction_df_json)
-            save_parquet_to_s3("dim_transaction", latest_update, transaction_df)
-
-        # date
-        date_df = dim_date()
-        save_parquet_to_s3(
-            "dim_date", str(dim_date()["date_id"].iloc[-1]) + ".000000", date_df
+    write_state_parts(
+        table, upsert_rows(table, current, changes[is_newer]), meta, parts, s3_client
+    )
+    counts = {
+        "inserted": int(is_new.sum()),
+        "updated": int((is_newer & ~is_new).sum()),
+        "stale": int((~is_newer).sum()),
+    }
+    logging.info(f"State of {table} updated {counts}")
+    return counts
+
+
+def read_state_rows(table: str, keys, s3_client=s3_client) -> pd.DataFrame:
+    meta = ensure_state(table, s3_client)
+    keys = pd.Series(keys).dropna().astype("int64").unique()
+    df = read_state_parts(table, get_state_parts(meta, keys), s3_client)
+    if df.empty:
+        return df
+    return df[df[meta["key"]].isin(keys)].reset_index(drop=True)
+
+
+def find_state_rows(table: str, column: str, values, s3_client=s3_client):
+    # no index on other columns, so every partition is read
+    ensure_state(table, s3_client)
+    df = read_state_parts(table, list_state_parts(table, s3_client), s3_client)
+    if df.empty:
+        return df
+    return df[df[column].isin(values)].reset_index(drop=True)
+
+
+def update_source_state(table: str, sources: dict, cache: FrameCache = None):
+    # every consumer's pending files, each file once
+    pending = {
+        latest_update: df
+        for consumer_pending in sources.values()
+        for latest_update, df in consumer_pending
+    }
+    return upsert_state(table, list(pending.items()), cache=cache)
+
+
+# -----INCREMENTAL JOINS
+
+# dimensions built by joining a child table to a lookup table. Both are read
+# from the source state, so a delta of either table can be joined without the
+# other having new files.
+JOINS = {
+    "dim_staff": {
+        "child": "staff",
+        "lookup": "department",
+        "foreign_key": "department_id",
+        "build": dim_staff,
+    },
+    "dim_counterparty": {
+        "child": "counterparty",
+        "lookup": "address",
+        "foreign_key": "legal_address_id",
+        "build": dim_counterparty,
+    },
+}
+
+
+def run_incremental_join(
+    dimension: str,
+    child_pending: list,
+    lookup_pending: list,
+    s3_client=s3_client,
+    cache: FrameCache = None,
+) -> int:
+    # the pending files must already be in the source state (upsert_state)
+    join = JOINS[dimension]
+    child, lookup = join["child"], join["lookup"]
+    child_key, lookup_key = f"{child}_id", f"{lookup}_id"
+    if not child_pending and not lookup_pending:
+        logging.info(f"There is no new data for {dimension}")
+        return 0
+
+    # new or changed children, and children of a changed lookup row
+    child_changes = concat_pending(child_pending)
+    affected = pd.DataFrame()
+    if not child_changes.empty:
+        affected = read_state_rows(child, child_changes[child_key], s3_client)
+    lookup_changes = concat_pending(lookup_pending)
+    if not lookup_changes.empty:
+        children = find_state_rows(
+            child, join["foreign_key"], lookup_changes[lookup_key], s3_client
+        )
+        affected = upsert_rows(child, affected, children)
+
+    latest_update = max(lu for lu, _ in child_pending + lookup_pending)
+    if not affected.empty:
+        lookup_df = read_state_rows(lookup, affected[join["foreign_key"]], s3_client)
+        result_df = join["build"](affected, lookup_df)
+        source = "-".join(
+            table
+            for table, pending in [[child, child_pending], [lookup, lookup_pending]]
+            if pending
         )
+        save_changed_rows(dimension, latest_update, result_df, s3_client, source)
+    logging.info(f"{dimension}: {len(affected)} rows recomputed")
+
+    for table, pending in [[child, child_pending], [lookup, lookup_pending]]:
+        if pending:
+            last_update = max(lu for lu, _ in pending)
+            mark_processed(table, dimension, last_update, s3_client)
+    return len(affected)
+
+
+def transform_extract_object(key: str, s3_client=s3_client, cache: FrameCache = None):
+    table = key.split("/")[0]
+    if table not in convert or not convert[table]:
+        logging.info(f"No transformation for {key}")
+        return None
+
+    latest_update = get_latest_update_from_key(key)
+    df = fetch_extract_frames(table, [key], s3_client, cache=cache)[0]
+    upsert_state(table, [[latest_update, df]], s3_client, cache)
+
+    if table == "currency":
+        result_df = dim_currency(df)
+    elif table == "design":
+        result_df = dim_design(df)
+    elif table == "address":
+        result_df = dim_location(df)
+    elif table == "transaction":
+        result_df = dim_transaction(df)
+    elif table == "sales_order":
+        result_df = fact_sales_order(df)
+    else:
+        # staff, department and counterparty are joined against saved state
+        for dimension, join in JOINS.items():
+            if table == join["child"]:
+                run_incremental_join(
+                    dimension, [[latest_update, df]], [], s3_client, cache
+                )
+            elif table == join["lookup"]:
+                run_incremental_join(
+                    dimension, [], [[latest_update, df]], s3_client, cache
+                )
+        return convert[table]
+
+    if table == "address":
+        # address is also the lookup table of dim_counterparty
+        run_incremental_join(
+            "dim_counterparty", [], [[latest_update, df]], s3_client, cache
+        )
+
+    save_changed_rows(convert[table], latest_update, result_df, s3_client)
+    mark_processed(table, convert[table], latest_update, s3_client)
+    return convert[table]
+
+
+def handle_s3_event(event: dict, s3_client=s3_client) -> dict:
+    # lookup snapshots are decoded once for the whole batch of events
+    cache = FrameCache()
+    failed_messages = []
+    for message_id, bucket, key in get_event_records(event):
+        if bucket != "extraction-bucket-sorceress" or key.startswith(
+            ("manifests/", "backfill/")
+        ):
+            continue
+        try:
+            transform_extract_object(key, s3_client, cache)
+        except Exception as e:
+            logging.error(f"Unable to transform {key}: {e}", exc_info=True)
+            if message_id is None:
+                raise e
+            if message_id not in failed_messages:
+                failed_messages.append(message_id)
+
+    # lets SQS retry only the messages that failed
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message_id} for message_id in failed_messages
+        ]
+    }
+
+
+# -----TASK GRAPH
+
+
+def run_task_graph(tasks: dict, max_workers: int = MAX_CONCURRENT_TASKS) -> dict:
+    # tasks are {name: [dependency names, function]}, each function is called
+    # with its dependencies' results once they are all available. Tasks whose
+    # dependencies failed are not run.
+    results, timings, failed = {}, {}, {}
+    pending = dict(tasks)
+    running = {}
+
+    def timed(name, function, args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            timings[name] = round(time.perf_counter() - start, 3)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            progress = True
+            while progress:
+                progress = False
+                for name, (dependencies, function) in list(pending.items()):
+                    if any(dependency in failed for dependency in dependencies):
+                        failed[name] = "dependency failed"
+                    elif all(dependency in results for dependency in dependencies):
+                        args = [results[dependency] for dependency in dependencies]
+                        future = executor.submit(timed, name, function, args)
+                        running[future] = name
+                    else:
+                        continue
+                    del pending[name]
+                    progress = True
+
+            if not running:
+                if pending:
+                    raise ValueError(f"Unable to schedule tasks {sorted(pending)}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                    logging.info(f"Task {name} finished in {timings[name]}s")
+                except Exception as e:
+                    failed[name] = repr(e)
+                    logging.error(f"Task {name} failed: {e}", exc_info=e)
+
+    return {"results": results, "timings": timings, "failed": failed}
+
+
+def save_each_file(table: str, consumer: str, build, sources: dict) -> int:
+    for latest_update, df in sources[consumer]:
+        save_changed_rows(consumer, latest_update, build(df))
+        mark_processed(table, consumer, latest_update)
+    return len(sources[consumer])
+
+
+def build_join(
+    dimension: str, child_sources: dict, lookup_sources: dict, *state, cache=None
+) -> int:
+    # state is the result of the state tasks, they only need to have run
+    return run_incremental_join(
+        dimension,
+        child_sources[dimension],
+        lookup_sources[dimension],
+        cache=cache,
+    )
+
+
+# source tables and the dim/fact tables built from each of them
+SOURCE_CONSUMERS = {
+    "currency": ["dim_currency"],
+    "staff": ["dim_staff"],
+    "department": ["dim_staff"],
+    "counterparty": ["dim_counterparty"],
+    "address": ["dim_counterparty", "dim_location"],
+    "design": ["dim_design"],
+    "transaction": ["dim_transaction"],
+    "sales_order": ["facts_sales_order"],
+}
+
+
+def get_transformation_tasks(cache: FrameCache = None) -> dict:
+    # each source table is fetched once and shared by its consumers
+    tasks = {
+        f"source:{table}": [
+            [],
+            partial(get_source_frames, table, consumers, cache=cache),
+        ]
+        for table, consumers in SOURCE_CONSUMERS.items()
+    }
+    for table in SOURCE_CONSUMERS:
+        tasks[f"state:{table}"] = [
+            [f"source:{table}"],
+            partial(update_source_state, table, cache=cache),
+        ]
+    for table, consumer, build in [
+        ["currency", "dim_currency", dim_currency],
+        ["design", "dim_design", dim_design],
+        ["address", "dim_location", dim_location],
+        ["transaction", "dim_transaction", dim_transaction],
+        ["sales_order", "facts_sales_order", fact_sales_order],
+    ]:
+        tasks[consumer] = [
+            [f"source:{table}"],
+            partial(save_each_file, table, consumer, build),
+        ]
+    for dimension, join in JOINS.items():
+        tasks[dimension] = [
+            [
+                f"source:{join['child']}",
+                f"source:{join['lookup']}",
+                f"state:{join['child']}",
+                f"state:{join['lookup']}",
+            ],
+            partial(build_join, dimension, cache=cache),
+        ]
+    tasks["dim_date"] = [[], update_dim_date]
+    return tasks
 
-        # sales
-        for latest_update, sales_order_df_json in get_json_from_s3("sales_order"):
-            sales_order_df = fact_sales_order(sales_order_df_json)
-            save_parquet_to_s3("facts_sales_order", latest_update, sales_order_df)
+
+def lambda_handler(event, context):
+    if is_s3_event(event):
+        return handle_s3_event(event)
+
+    try:
+        cache = FrameCache()
+        res = run_task_graph(get_transformation_tasks(cache))
+        logging.info(f"Frame cache hits {cache.hits} misses {cache.misses}")
+        if res["failed"]:
+            raise RuntimeError(f"Tasks failed: {res['failed']}")
+        return {"timings": res["timings"]}
 
     except Exception as e:
         logging.error(f"Unable to convert to parquet file: {e}", exc_info=True)
         raise e
-
-
-lambda_handler(1, 2)
@@ -0,0 +1,47 @@
+import subprocess
+import sys
+import json
+import os
+import pytest
+
+# seconds a module may take to import in a fresh interpreter
+COLD_START_BUDGET = float(os.environ.get("COLD_START_BUDGET", 3))
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{
+    "seconds": time.perf_counter() - start,
+    "modules": sorted(sys.modules),
+}}))
+"""
+
+
+def import_in_subprocess(module):
+    env = dict(os.environ)
+    # any AWS call made while importing fails fast instead of reaching AWS
+    env["AWS_ENDPOINT_URL"] = "http://127.0.0.1:9"
+    env["AWS_ACCESS_KEY_ID"] = "testing"
+    env["AWS_SECRET_ACCESS_KEY"] = "testing"
+    res = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT.format(module=module)],
+        capture_output=True,
+        text=True,
+        env=env,
+        timeout=60,
+    )
+    assert res.returncode == 0, res.stderr
+    return json.loads(res.stdout.splitlines()[-1])
+
+
+@pytest.mark.parametrize("module", ["src.transformation.lambda_function", "src.main"])
+class TestColdStart:
+    def test_import_within_budget(self, module):
+        res = import_in_subprocess(module)
+        assert res["seconds"] < COLD_START_BUDGET
+
+    def test_import_has_no_aws_side_effects(self, module):
+        res = import_in_subprocess(module)
+        assert "awswrangler" not in res["modules"]
+        assert "boto3" not in res["modules"]
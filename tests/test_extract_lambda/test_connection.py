@@ -1,16 +1,27 @@
+from src.extract_lambda import connection_extract
 from src.extract_lambda.connection_extract import (
     connect_to_extract_db_cloud,
     get_secret_db,
+    get_connection,
+    close_connection,
+    is_connection_alive,
+    get_cached_secret,
+    clear_secret_cache,
+    is_auth_error,
+    acquire_connection,
+    release_connection,
+    pooled_connection,
+    close_pool,
 )
 from dotenv import load_dotenv
 import os
 from pg8000.native import Connection
-from pg8000 import InterfaceError
+from pg8000 import InterfaceError, DatabaseError
 from moto import mock_aws
 import pytest
 import boto3
 from botocore.exceptions import ClientError
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 
 @pytest.fixture(scope="function")
@@ -22,6 +33,13 @@ def aws_credentials():
     os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
 
 
+@pytest.fixture(autouse=True)
+def empty_secret_cache():
+    clear_secret_cache()
+    yield
+    clear_secret_cache()
+
+
 @pytest.fixture(scope="function")
 def ssm_client(aws_credentials):
     with mock_aws():
@@ -82,3 +100,184 @@ def test_connect_to_extract_db_cloud_interfase_error(secretsmanager_client):
     )
     with pytest.raises(ClientError):
         connect_to_extract_db_cloud(secretsmanager_client)
+
+
+class TestGetConnection:
+    @pytest.fixture(autouse=True)
+    def reset_connection(self):
+        connection_extract._connection = None
+        yield
+        connection_extract._connection = None
+
+    def test_is_connection_alive(self):
+        mock_conn = Mock()
+        assert is_connection_alive(mock_conn)
+        mock_conn.run.assert_called_once_with("select 1;")
+
+    def test_is_connection_alive_false_on_network_error(self):
+        mock_conn = Mock()
+        mock_conn.run.side_effect = InterfaceError("network error")
+        assert not is_connection_alive(mock_conn)
+
+    @patch("src.extract_lambda.connection_extract.connect_to_extract_db_cloud")
+    def test_connection_is_reused(self, mock_connect):
+        mock_connect.return_value = Mock()
+        first = get_connection()
+        second = get_connection()
+        assert first is second
+        assert mock_connect.call_count == 1
+
+    @patch("src.extract_lambda.connection_extract.connect_to_extract_db_cloud")
+    def test_stale_connection_is_replaced(self, mock_connect):
+        stale_conn = Mock()
+        fresh_conn = Mock()
+        mock_connect.side_effect = [stale_conn, fresh_conn]
+
+        assert get_connection() is stale_conn
+        stale_conn.run.side_effect = InterfaceError("network error")
+        stale_conn.close.side_effect = InterfaceError("network error")
+
+        assert get_connection() is fresh_conn
+        assert mock_connect.call_count == 2
+
+    @patch("src.extract_lambda.connection_extract.connect_to_extract_db_cloud")
+    def test_close_connection(self, mock_connect):
+        mock_conn = Mock()
+        mock_connect.return_value = mock_conn
+        get_connection()
+        close_connection()
+        mock_conn.close.assert_called_once()
+        assert connection_extract._connection is None
+
+
+class TestGetCachedSecret:
+    def test_secret_is_cached(self, secretsmanager_client):
+        making_secret(secretsmanager_client)
+        mock_client = Mock(wraps=secretsmanager_client)
+        first = get_cached_secret("totesysinfo", mock_client)
+        second = get_cached_secret("totesysinfo", mock_client)
+        assert first == second
+        assert mock_client.get_secret_value.call_count == 1
+
+    def test_expired_secret_is_fetched_again(self, secretsmanager_client):
+        making_secret(secretsmanager_client)
+        mock_client = Mock(wraps=secretsmanager_client)
+        get_cached_secret("totesysinfo", mock_client, ttl=0)
+        get_cached_secret("totesysinfo", mock_client, ttl=0)
+        assert mock_client.get_secret_value.call_count == 2
+
+    def test_secret_refreshed_in_background_before_expiry(self, secretsmanager_client):
+        making_secret(secretsmanager_client)
+        mock_client = Mock(wraps=secretsmanager_client)
+        get_cached_secret("totesysinfo", mock_client)
+        with patch(
+            "src.extract_lambda.connection_extract.refresh_secret_in_background"
+        ) as mock_refresh:
+            get_cached_secret("totesysinfo", mock_client, ttl=1000)
+            mock_refresh.assert_not_called()
+            connection_extract._secret_cache["totesysinfo"]["fetched_at"] -= 900
+            res = get_cached_secret("totesysinfo", mock_client, ttl=1000)
+            mock_refresh.assert_called_once_with("totesysinfo", mock_client)
+        assert res["password"] == "test"
+
+    def test_force_refresh_picks_up_rotated_password(self, secretsmanager_client):
+        making_secret(secretsmanager_client)
+        get_cached_secret("totesysinfo", secretsmanager_client)
+        secretsmanager_client.put_secret_value(
+            SecretId="totesysinfo",
+            SecretString='{"host":"test","port":5432,"dbname":"test","username":"test","password":"rotated"}',
+        )
+        assert (
+            get_cached_secret("totesysinfo", secretsmanager_client)["password"]
+            == "test"
+        )
+        res = get_cached_secret(
+            "totesysinfo", secretsmanager_client, force_refresh=True
+        )
+        assert res["password"] == "rotated"
+
+
+class TestAuthErrorRetry:
+    def test_is_auth_error(self):
+        assert is_auth_error(DatabaseError({"C": "28P01", "M": "password failed"}))
+        assert not is_auth_error(DatabaseError({"C": "42P01"}))
+        assert not is_auth_error(DatabaseError())
+
+    @patch("src.extract_lambda.connection_extract.open_connection")
+    def test_auth_failure_forces_secret_refresh(
+        self, mock_open_connection, secretsmanager_client
+    ):
+        making_secret(secretsmanager_client)
+        mock_conn = Mock()
+        mock_open_connection.side_effect = [
+            DatabaseError({"C": "28P01", "M": "password authentication failed"}),
+            mock_conn,
+        ]
+        mock_client = Mock(wraps=secretsmanager_client)
+        assert connect_to_extract_db_cloud(mock_client) is mock_conn
+        assert mock_client.get_secret_value.call_count == 2
+
+    @patch("src.extract_lambda.connection_extract.open_connection")
+    def test_other_database_errors_are_raised(
+        self, mock_open_connection, secretsmanager_client
+    ):
+        making_secret(secretsmanager_client)
+        mock_open_connection.side_effect = DatabaseError({"C": "3D000"})
+        with pytest.raises(DatabaseError):
+            connect_to_extract_db_cloud(secretsmanager_client)
+
+
+class TestPooledConnection:
+    @pytest.fixture(autouse=True)
+    def empty_pool(self):
+        connection_extract._idle_connections.clear()
+        yield
+        connection_extract._idle_connections.clear()
+
+    @patch("src.extract_lambda.connection_extract.connect_to_extract_db_cloud")
+    def test_released_connection_is_reused(self, mock_connect):
+        mock_connect.return_value = Mock()
+        with pooled_connection() as first:
+            pass
+        with pooled_connection() as second:
+            pass
+        assert first is second
+        assert mock_connect.call_count == 1
+
+    @patch("src.extract_lambda.connection_extract.connect_to_extract_db_cloud")
+    def test_concurrent_workers_get_their_own_connection(self, mock_connect):
+        mock_connect.side_effect = [Mock(), Mock()]
+        first = acquire_connection()
+        second = acquire_connection()
+        assert first is not second
+        release_connection(first)
+        release_connection(second)
+        assert len(connection_extract._idle_connections) == 2
+
+    @patch("src.extract_lambda.connection_extract.connect_to_extract_db_cloud")
+    def test_stale_pooled_connection_is_dropped(self, mock_connect):
+        stale_conn = Mock()
+        stale_conn.run.side_effect = InterfaceError("network error")
+        fresh_conn = Mock()
+        mock_connect.return_value = fresh_conn
+        release_connection(stale_conn)
+
+        assert acquire_connection() is fresh_conn
+        stale_conn.close.assert_called_once()
+
+    @patch("src.extract_lambda.connection_extract.connect_to_extract_db_cloud")
+    def test_network_error_discards_connection(self, mock_connect):
+        mock_conn = Mock()
+        mock_connect.return_value = mock_conn
+        with pytest.raises(InterfaceError):
+            with pooled_connection():
+                raise InterfaceError("network error")
+        assert connection_extract._idle_connections == []
+        mock_conn.close.assert_called_once()
+
+    def test_close_pool(self):
+        mock_conn = Mock()
+        release_connection(mock_conn)
+        close_pool()
+        mock_conn.close.assert_called_once()
+        assert connection_extract._idle_connections == []
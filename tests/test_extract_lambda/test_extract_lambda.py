@@ -4,17 +4,34 @@ from src.extract_lambda.extract_lambda import (
     get_table_names,
     get_latest_date_parameter,
     table_to_json,
-    update_date_parameter,
+    get_table_date_parameters,
+    update_table_date_parameters,
     save_json_to_folder,
-    get_latest_date,
+    stream_table_rows,
+    write_json_batches,
+    save_json_batches_to_folder,
+    get_object_key,
+    copy_table_to_s3,
+    extract_table,
+    stream_batches_to_s3,
+    get_output_columns,
+    extract_tables,
+    backfill_tables,
+    update_extract_index,
+    fetch_keyset_page,
+    get_backfill_checkpoint,
+    get_latest_dates,
+    has_new_data,
     lambda_handler,
 )
-from pg8000 import DatabaseError
+from pg8000 import DatabaseError, InterfaceError
 from unittest.mock import Mock, patch
 from moto import mock_aws
 from botocore.exceptions import NoCredentialsError, ClientError
 import boto3
 import datetime
+import io
+import pyarrow.parquet as pq
 import json
 import logging
 
@@ -54,10 +71,6 @@ class TestGetTableNames:
         assert res == ["1", "2", "3"]
 
 
-# class TestGetLatestDate:
-#     def test_(self, ssm_client, s3_client):
-
-
 class TestGetLatestDateParameter:
     def test_returns_parameter(self, ssm_client, s3_client):
         ssm_client.put_parameter(
@@ -80,25 +93,72 @@ class TestGetLatestDateParameter:
             get_latest_date_parameter(ssm_client=ssm_client)
 
 
-class TestUpdateDateParameter:
-    def test_update_date_parameter_from_store(self, ssm_client, s3_client):
-        old_datetime = datetime.datetime(2020, 5, 23, 15, 00, 00, 199000)
+class TestTableDateParameters:
+    def test_reads_per_table_dates(self, ssm_client):
         ssm_client.put_parameter(
-            Name="latest_date",
-            Value=str(old_datetime),
+            Name="latest_dates",
+            Value=json.dumps(
+                {
+                    "staff": "2022-11-03 14:20:51.563000",
+                    "sales_order": "2024-05-23 15:16:09.981000",
+                }
+            ),
             Type="String",
-            Overwrite=True,
+        )
+        res = get_table_date_parameters(["staff", "sales_order"], ssm_client)
+        assert res == {
+            "staff": datetime.datetime(2022, 11, 3, 14, 20, 51, 563000),
+            "sales_order": datetime.datetime(2024, 5, 23, 15, 16, 9, 981000),
+        }
+
+    def test_missing_table_falls_back_to_global_date(self, ssm_client):
+        ssm_client.put_parameter(
+            Name="latest_date", Value="2024-05-23 15:16:09.981000", Type="String"
+        )
+        ssm_client.put_parameter(
+            Name="latest_dates",
+            Value=json.dumps({"staff": "2022-11-03 14:20:51.563000"}),
+            Type="String",
+        )
+        res = get_table_date_parameters(["staff", "design"], ssm_client)
+        assert res["design"] == datetime.datetime(2024, 5, 23, 15, 16, 9, 981000)
+
+    def test_fallback_date_is_read_once(self, ssm_client):
+        ssm_client.put_parameter(
+            Name="latest_date", Value="2024-05-23 15:16:09.981000", Type="String"
+        )
+        mock_ssm_client = Mock(wraps=ssm_client)
+        res = get_table_date_parameters(
+            ["staff", "design", "sales_order"], mock_ssm_client
         )
 
-        ssm_client.get_parameter(Name="latest_date")
+        assert mock_ssm_client.get_parameter.call_count == 2
+        assert set(res.values()) == {datetime.datetime(2024, 5, 23, 15, 16, 9, 981000)}
 
-        new_datetime = datetime.datetime(2024, 5, 23, 19, 54, 58, 199000)
-        update_date_parameter(new_datetime)
+    def test_no_parameters_start_from_the_beginning(self, ssm_client):
+        res = get_table_date_parameters(["staff"], ssm_client)
+        assert res == {"staff": datetime.datetime(1990, 11, 3, 14, 20, 49, 962000)}
 
-        get_new_parameters = ssm_client.get_parameter(Name="latest_date")
+    def test_update_writes_all_tables_in_one_put(self, ssm_client):
+        mock_ssm_client = Mock(wraps=ssm_client)
+        table_dates = {
+            "staff": datetime.datetime(2022, 11, 3, 14, 20, 51, 563000),
+            "sales_order": datetime.datetime(2024, 5, 23, 15, 16, 9, 981000),
+        }
+        update_table_date_parameters(table_dates, mock_ssm_client)
 
-        updated_parameter_value = get_new_parameters["Parameter"]["Value"]
-        assert old_datetime < datetime.datetime.fromisoformat(updated_parameter_value)
+        assert mock_ssm_client.put_parameter.call_count == 1
+        assert get_table_date_parameters(table_dates, ssm_client) == table_dates
+
+    def test_update_never_moves_a_watermark_back(self, ssm_client):
+        newer = datetime.datetime(2024, 5, 24, 9, 0)
+        older = datetime.datetime(2024, 5, 23, 9, 0)
+        update_table_date_parameters({"staff": newer, "design": older}, ssm_client)
+        update_table_date_parameters({"staff": older, "design": newer}, ssm_client)
+        assert get_table_date_parameters(["staff", "design"], ssm_client) == {
+            "staff": newer,
+            "design": newer,
+        }
 
 
 class TestTableToJson:
@@ -190,59 +250,636 @@ class TestSaveJsonToFolder:
             save_json_to_folder("test", latest_update, "json", s3_client=mock_s3_client)
 
 
-class TestGetLatestDate:
-    def test_returns_datetime(self):
+class TestStreamTableRows:
+    def run_side_effect(self, batches):
+        batches = iter(batches)
+
+        def run(sql):
+            if sql.startswith("fetch"):
+                return next(batches, [])
+            return None
+
+        return run
+
+    def test_yields_rows_in_batches(self):
+        mock_conn = Mock()
+        mock_conn.run.side_effect = self.run_side_effect(
+            [[[{"staff_id": 1}], [{"staff_id": 2}]], [[{"staff_id": 3}]]]
+        )
+        where_date = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
+        res = list(stream_table_rows(mock_conn, "staff", where_date, batch_size=2))
+
+        assert res == [[{"staff_id": 1}, {"staff_id": 2}], [{"staff_id": 3}]]
+        queries = [call[0][0] for call in mock_conn.run.call_args_list]
+        assert queries[0] == "begin;"
+        assert "declare staff_extract no scroll cursor" in queries[1]
+        assert "> '2022-11-03T14:20:49.962000'" in queries[1]
+        assert queries[2] == "fetch forward 2 from staff_extract;"
+        assert queries[-1] == "rollback;"
+
+    def test_cursor_closed_on_error(self):
+        mock_conn = Mock()
+
+        def run(sql):
+            if sql.startswith("fetch"):
+                raise DatabaseError()
+
+        mock_conn.run.side_effect = run
+        with pytest.raises(DatabaseError):
+            list(stream_table_rows(mock_conn, "staff", datetime.datetime(2022, 1, 1)))
+        assert mock_conn.run.call_args_list[-1][0][0] == "rollback;"
+
+    @patch("src.extract_lambda.extract_lambda.stream_batches_to_s3")
+    def test_failed_upload_rolls_back_before_returning(
+        self, mock_stream_batches_to_s3, monkeypatch
+    ):
+        monkeypatch.setattr("src.extract_lambda.extract_lambda.EXTRACT_MODE", "stream")
+        mock_conn = Mock()
+        mock_conn.run.side_effect = self.run_side_effect(
+            [[[{"staff_id": 1}]], [[{"staff_id": 2}]]]
+        )
+
+        def upload(table, latest_update, batches, columns=None):
+            next(batches)
+            raise ClientError({"Error": {"Code": "SlowDown"}}, "UploadPart")
+
+        mock_stream_batches_to_s3.side_effect = upload
+        with pytest.raises(ClientError):
+            extract_table(
+                mock_conn,
+                "staff",
+                datetime.datetime(2022, 1, 1),
+                datetime.datetime(2022, 1, 2),
+            )
+        assert mock_conn.run.call_args_list[-1][0][0] == "rollback;"
+
+
+class TestSaveJsonBatchesToFolder:
+    def test_write_json_batches_produces_a_json_array(self):
+        f = io.StringIO()
+        row_count = write_json_batches(
+            iter([[{"staff_id": 1}, {"staff_id": 2}], [{"staff_id": 3}]]), f
+        )
+        assert row_count == 3
+        assert json.loads(f.getvalue()) == [
+            {"staff_id": 1},
+            {"staff_id": 2},
+            {"staff_id": 3},
+        ]
+
+    def test_uploads_streamed_file(self, s3_client):
+        s3_client.create_bucket(
+            Bucket="extraction-bucket-sorceress",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        latest_update = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
+        row_count = save_json_batches_to_folder(
+            "staff", latest_update, iter([[{"staff_id": 1}]]), s3_client=s3_client
+        )
+
+        assert row_count == 1
+        body = s3_client.get_object(
+            Bucket="extraction-bucket-sorceress",
+            Key=get_object_key("staff", latest_update),
+        )["Body"]
+        assert json.load(body) == [{"staff_id": 1}]
+
+    def test_nothing_uploaded_without_rows(self):
+        mock_s3_client = Mock()
+        latest_update = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
+        row_count = save_json_batches_to_folder(
+            "staff", latest_update, iter([]), s3_client=mock_s3_client
+        )
+        assert row_count == 0
+        mock_s3_client.upload_file.assert_not_called()
+
+
+class TestStreamBatchesToS3:
+    def test_streams_json_array_to_s3(self, s3_client):
+        s3_client.create_bucket(
+            Bucket="extraction-bucket-sorceress",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        latest_update = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
+        batches = iter([[{"staff_id": 1, "first_name": "Zoë"}], [{"staff_id": 2}]])
+
+        row_count = stream_batches_to_s3("staff", latest_update, batches, s3_client)
+
+        assert row_count == 2
+        obj = s3_client.get_object(
+            Bucket="extraction-bucket-sorceress",
+            Key=get_object_key("staff", latest_update),
+        )
+        assert obj["ContentType"] == "application/json"
+        assert json.load(obj["Body"]) == [
+            {"staff_id": 1, "first_name": "Zoë"},
+            {"staff_id": 2},
+        ]
+
+    def test_parquet_output_records_format(self, s3_client):
+        s3_client.create_bucket(
+            Bucket="extraction-bucket-sorceress",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        latest_update = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
+        batches = iter([[{"staff_id": 1}], [{"staff_id": 2}]])
+
+        row_count = stream_batches_to_s3(
+            "staff", latest_update, batches, s3_client, output_format="parquet"
+        )
+
+        assert row_count == 2
+        obj = s3_client.get_object(
+            Bucket="extraction-bucket-sorceress",
+            Key=get_object_key("staff", latest_update, "parquet"),
+        )
+        assert obj["Metadata"] == {"format": "parquet"}
+
+    def test_parquet_null_column_in_first_batch(self, s3_client):
+        s3_client.create_bucket(
+            Bucket="extraction-bucket-sorceress",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        latest_update = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
         mock_conn = Mock()
         mock_conn.run.return_value = [
-            [datetime.datetime(1990, 11, 3, 14, 20, 49, 962000)]
+            ["address_id", "integer"],
+            ["address_line_2", "character varying"],
+        ]
+        columns = get_output_columns(mock_conn, "address", "parquet")
+        batches = iter(
+            [
+                [{"address_id": 1, "address_line_2": None}],
+                [{"address_id": 2, "address_line_2": "Flat 1"}],
+            ]
+        )
+
+        row_count = stream_batches_to_s3(
+            "address",
+            latest_update,
+            batches,
+            s3_client,
+            output_format="parquet",
+            columns=columns,
+        )
+
+        assert row_count == 2
+        assert mock_conn.run.call_args[1] == {"table": "address"}
+        obj = s3_client.get_object(
+            Bucket="extraction-bucket-sorceress",
+            Key=get_object_key("address", latest_update, "parquet"),
+        )
+        table = pq.read_table(io.BytesIO(obj["Body"].read()))
+        assert table.column("address_line_2").to_pylist() == [None, "Flat 1"]
+
+    def test_only_parquet_queries_column_types(self):
+        mock_conn = Mock()
+        assert get_output_columns(mock_conn, "address", "jsonl") is None
+        mock_conn.run.assert_not_called()
+
+    def test_no_rows_uploads_nothing(self):
+        mock_s3_client = Mock()
+        row_count = stream_batches_to_s3(
+            "staff", datetime.datetime(2022, 1, 1), iter([]), mock_s3_client
+        )
+        assert row_count == 0
+        mock_s3_client.put_object.assert_not_called()
+
+    def test_failed_fetch_aborts_upload(self):
+        mock_s3_client = Mock()
+
+        def batches():
+            yield [{"staff_id": 1}]
+            raise DatabaseError()
+
+        with pytest.raises(DatabaseError):
+            stream_batches_to_s3(
+                "staff", datetime.datetime(2022, 1, 1), batches(), mock_s3_client
+            )
+        mock_s3_client.put_object.assert_not_called()
+
+
+class TestUpdateExtractIndex:
+    def test_index_accumulates_extract_timestamps(self, s3_client):
+        s3_client.create_bucket(
+            Bucket="extraction-bucket-sorceress",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        first = datetime.datetime(2024, 5, 23, 15, 16, 9, 981000)
+        second = datetime.datetime(2024, 5, 24, 9, 0)
+        update_extract_index("staff", first, get_object_key("staff", first), s3_client)
+        update_extract_index(
+            "staff", second, get_object_key("staff", second), s3_client
+        )
+
+        res = s3_client.get_object(
+            Bucket="extraction-bucket-sorceress", Key="manifests/staff.json"
+        )
+        assert json.load(res["Body"]) == {
+            "2024-05-23 15:16:09.981000": get_object_key("staff", first),
+            "2024-05-24 09:00:00.000000": get_object_key("staff", second),
+        }
+
+    def test_keys_sharing_a_timestamp_are_kept(self, s3_client):
+        s3_client.create_bucket(
+            Bucket="extraction-bucket-sorceress",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        latest = datetime.datetime(2024, 5, 23, 15, 16, 9, 981000)
+        update_extract_index(
+            "staff", latest, get_object_key("staff", latest), s3_client
+        )
+        update_extract_index("staff", latest, ["part-1", "part-2"], s3_client)
+        update_extract_index("staff", latest, ["part-2"], s3_client)
+
+        res = s3_client.get_object(
+            Bucket="extraction-bucket-sorceress", Key="manifests/staff.json"
+        )
+        assert json.load(res["Body"]) == {
+            "2024-05-23 15:16:09.981000": [
+                get_object_key("staff", latest),
+                "part-1",
+                "part-2",
+            ]
+        }
+
+
+class TestCopyTableToS3:
+    def mock_copy_conn(self, data, row_count):
+        mock_conn = Mock()
+
+        def run(sql, stream=None):
+            stream.write(data)
+            mock_conn.row_count = row_count
+
+        mock_conn.run.side_effect = run
+        return mock_conn
+
+    def test_copy_streams_csv_to_s3(self, s3_client):
+        s3_client.create_bucket(
+            Bucket="extraction-bucket-sorceress",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        mock_conn = self.mock_copy_conn(b"staff_id,first_name\n1,Jeremie\n", 1)
+        latest_update = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
+
+        res = copy_table_to_s3(
+            mock_conn,
+            "staff",
+            datetime.datetime(2022, 1, 1),
+            latest_update,
+            s3_client=s3_client,
+        )
+
+        assert res == 1
+        query = mock_conn.run.call_args[0][0]
+        assert query.startswith("copy (select * from staff where last_updated >")
+        assert query.endswith("to stdout (format csv, header);")
+        obj = s3_client.get_object(
+            Bucket="extraction-bucket-sorceress",
+            Key=get_object_key("staff", latest_update, "csv"),
+        )
+        assert obj["Body"].read() == b"staff_id,first_name\n1,Jeremie\n"
+
+    def test_binary_copy_kept_out_of_table_prefix(self, s3_client):
+        s3_client.create_bucket(
+            Bucket="extraction-bucket-sorceress",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        mock_conn = self.mock_copy_conn(b"PGCOPY\n", 1)
+        latest_update = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
+
+        copy_table_to_s3(
+            mock_conn,
+            "staff",
+            datetime.datetime(2022, 1, 1),
+            latest_update,
+            copy_format="binary",
+            s3_client=s3_client,
+        )
+
+        listing = s3_client.list_objects_v2(Bucket="extraction-bucket-sorceress")
+        assert [obj["Key"] for obj in listing["Contents"]] == [
+            "copy/" + get_object_key("staff", latest_update, "pgcopy")
+        ]
+
+    @patch("src.extract_lambda.extract_lambda.update_extract_index")
+    @patch("src.extract_lambda.extract_lambda.copy_table_to_s3")
+    def test_only_csv_copies_are_indexed(
+        self, mock_copy_table_to_s3, mock_update_extract_index, monkeypatch
+    ):
+        mock_copy_table_to_s3.return_value = 1
+        latest_update = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
+        monkeypatch.setattr("src.extract_lambda.extract_lambda.EXTRACT_MODE", "copy")
+
+        monkeypatch.setattr(
+            "src.extract_lambda.extract_lambda.EXTRACT_COPY_FORMAT", "binary"
+        )
+        assert extract_table(Mock(), "staff", latest_update, latest_update)
+        mock_update_extract_index.assert_not_called()
+
+        monkeypatch.setattr(
+            "src.extract_lambda.extract_lambda.EXTRACT_COPY_FORMAT", "csv"
+        )
+        assert extract_table(Mock(), "staff", latest_update, latest_update)
+        mock_update_extract_index.assert_called_once_with(
+            "staff", latest_update, get_object_key("staff", latest_update, "csv")
+        )
+
+    def test_no_rows_uploads_nothing(self):
+        mock_s3_client = Mock()
+        mock_conn = self.mock_copy_conn(b"staff_id,first_name\n", 0)
+
+        res = copy_table_to_s3(
+            mock_conn,
+            "staff",
+            datetime.datetime(2022, 1, 1),
+            datetime.datetime(2022, 1, 1),
+            s3_client=mock_s3_client,
+        )
+
+        assert res == 0
+        mock_s3_client.put_object.assert_not_called()
+
+    def test_unsupported_format(self):
+        with pytest.raises(ValueError):
+            copy_table_to_s3(
+                Mock(),
+                "staff",
+                datetime.datetime(2022, 1, 1),
+                datetime.datetime(2022, 1, 1),
+                copy_format="text",
+            )
+
+
+class TestExtractTables:
+    @patch("src.extract_lambda.extract_lambda.pooled_connection")
+    @patch("src.extract_lambda.extract_lambda.extract_table")
+    def test_parallel_extraction_reports_each_table(
+        self, mock_extract_table, mock_pooled_connection
+    ):
+        def extract(conn, table, where_date, latest_update):
+            if table == "staff":
+                raise DatabaseError()
+            return table == "design"
+
+        mock_extract_table.side_effect = extract
+        tables = ["staff", "design", "currency"]
+        dates = {table: datetime.datetime(2022, 1, 1) for table in tables}
+
+        res = extract_tables(None, tables, dates, dates, workers=3)
+
+        assert [(r["table"], r["status"]) for r in res] == [
+            ("staff", "failed"),
+            ("design", "saved"),
+            ("currency", "no_data"),
         ]
+        assert mock_pooled_connection.call_count == 3
 
-        res = get_latest_date(mock_conn, "tables")
-        assert isinstance(res, datetime.datetime)
+    @patch("src.extract_lambda.extract_lambda.close_connection")
+    @patch("src.extract_lambda.extract_lambda.db_conn")
+    @patch("src.extract_lambda.extract_lambda.extract_table")
+    def test_broken_connection_replaced_before_next_table(
+        self, mock_extract_table, mock_db_conn, mock_close_connection
+    ):
+        broken_conn, new_conn = Mock(), Mock()
+        mock_db_conn.return_value = new_conn
+
+        def extract(conn, table, where_date, latest_update):
+            if table == "staff":
+                raise InterfaceError("connection reset")
+            return conn is new_conn
+
+        mock_extract_table.side_effect = extract
+        tables = ["staff", "design", "currency"]
+        dates = {table: datetime.datetime(2022, 1, 1) for table in tables}
 
-    def test_newest_remains_unchanged(self):
+        res = extract_tables(broken_conn, tables, dates, dates, workers=1)
+
+        assert [r["status"] for r in res] == ["failed", "saved", "saved"]
+        assert all("reconnect" not in r for r in res)
+        mock_close_connection.assert_called_once()
+        mock_db_conn.assert_called_once()
+
+    @patch("src.extract_lambda.extract_lambda.close_connection")
+    @patch("src.extract_lambda.extract_lambda.extract_table")
+    def test_database_error_keeps_the_connection(
+        self, mock_extract_table, mock_close_connection
+    ):
         mock_conn = Mock()
-        old_date_list = [[datetime.datetime(1990, 11, 3, 14, 20, 49, 962000)]]
-        mock_conn.run.return_value = old_date_list
-        res = get_latest_date(mock_conn, "tables")
+        mock_extract_table.side_effect = [DatabaseError(), True]
+        dates = {table: datetime.datetime(2022, 1, 1) for table in ["a", "b"]}
 
-        assert old_date_list[0][0] == res
+        res = extract_tables(mock_conn, ["a", "b"], dates, dates, workers=1)
 
-    def test_get_latest_date_updates_newest(self):
-        mock_conn1 = Mock()
-        initial_date_list = [[datetime.datetime(1990, 11, 3, 14, 20, 49, 962000)]]
-        mock_conn1.run.return_value = initial_date_list
-        res1 = get_latest_date(mock_conn1, "tables")
+        assert [r["status"] for r in res] == ["failed", "saved"]
+        assert mock_extract_table.call_args[0][0] is mock_conn
+        mock_close_connection.assert_not_called()
 
-        mock_conn2 = Mock()
-        date_list_update = [[datetime.datetime(2024, 11, 3, 14, 20, 49, 962000)]]
-        mock_conn2.run.return_value = date_list_update
-        res2 = get_latest_date(mock_conn2, "tables")
-        assert res2 > res1
+    @patch("src.extract_lambda.extract_lambda.pooled_connection")
+    @patch("src.extract_lambda.extract_lambda.extract_table")
+    def test_sequential_extraction_shares_one_connection(
+        self, mock_extract_table, mock_pooled_connection
+    ):
+        mock_conn = Mock()
+        mock_extract_table.return_value = True
+        dates = {"staff": datetime.datetime(2022, 1, 1)}
+
+        res = extract_tables(mock_conn, ["staff"], dates, dates, workers=1)
+
+        assert res[0]["status"] == "saved"
+        assert mock_extract_table.call_args[0][0] is mock_conn
+        mock_pooled_connection.assert_not_called()
+
+
+class TestBackfillTables:
+    def fake_conn(self, rows):
+        mock_conn = Mock()
+
+        def run(sql, **params):
+            if "max(last_updated)" in sql:
+                return [["staff", datetime.datetime(2024, 5, 23, 15, 16, 9, 981000)]]
+            if "PRIMARY KEY" in sql:
+                return [["staff_id"]]
+            after = params.get("after", 0)
+            page = [row for row in rows if row["staff_id"] > after]
+            return [[row["staff_id"], row] for row in page[: params["page_size"]]]
+
+        mock_conn.run.side_effect = run
+        return mock_conn
+
+    def setup_buckets(self, s3_client):
+        s3_client.create_bucket(
+            Bucket="extraction-bucket-sorceress",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+
+    def test_keyset_page_query(self):
+        mock_conn = Mock()
+        fetch_keyset_page(mock_conn, "staff", "staff_id", 10, page_size=5)
+        sql = mock_conn.run.call_args[0][0]
+        assert "where staff_id > :after order by staff_id limit :page_size" in sql
+        assert mock_conn.run.call_args[1] == {"after": 10, "page_size": 5}
+
+    def test_writes_numbered_parts(self, s3_client, ssm_client):
+        self.setup_buckets(s3_client)
+        rows = [{"staff_id": i} for i in range(1, 6)]
+
+        res = backfill_tables(
+            self.fake_conn(rows),
+            ["staff"],
+            page_size=2,
+            s3_client=s3_client,
+            ssm_client=ssm_client,
+        )
+
+        assert res["status"] == "complete"
+        keys = [
+            obj["Key"]
+            for obj in s3_client.list_objects_v2(
+                Bucket="extraction-bucket-sorceress", Prefix="backfill/"
+            )["Contents"]
+        ]
+        assert [key.split("/")[-1] for key in keys] == [
+            "staff-part-00001.json",
+            "staff-part-00002.json",
+            "staff-part-00003.json",
+        ]
+        index = s3_client.get_object(
+            Bucket="extraction-bucket-sorceress", Key="manifests/staff.json"
+        )["Body"]
+        # just after the watermark, which the last extract may already have
+        assert json.load(index) == {"2024-05-23 15:16:09.981001": keys}
+        saved = ssm_client.get_parameter(Name="latest_dates")["Parameter"]["Value"]
+        assert json.loads(saved) == {"staff": "2024-05-23 15:16:09.981000"}
+        assert get_backfill_checkpoint(ssm_client) is None
+
+    def test_resumes_from_checkpoint_after_timeout(self, s3_client, ssm_client):
+        self.setup_buckets(s3_client)
+        rows = [{"staff_id": i} for i in range(1, 6)]
+        context = Mock()
+        context.get_remaining_time_in_millis.side_effect = [120000, 1000]
+
+        res = backfill_tables(
+            self.fake_conn(rows),
+            ["staff"],
+            context,
+            page_size=2,
+            s3_client=s3_client,
+            ssm_client=ssm_client,
+        )
+        assert res["status"] == "incomplete"
+        listing = s3_client.list_objects_v2(
+            Bucket="extraction-bucket-sorceress", Prefix="manifests/"
+        )
+        assert "Contents" not in listing
+        checkpoint = get_backfill_checkpoint(ssm_client)
+        assert checkpoint["tables"]["staff"] == {
+            "last_key": 2,
+            "part": 1,
+            "done": False,
+        }
+
+        mock_conn = self.fake_conn(rows)
+        res = backfill_tables(
+            mock_conn,
+            ["staff"],
+            page_size=2,
+            s3_client=s3_client,
+            ssm_client=ssm_client,
+        )
+        assert res["status"] == "complete"
+        assert res["tables"]["staff"]["part"] == 3
+        fetches = [
+            call[1] for call in mock_conn.run.call_args_list if "page_size" in call[1]
+        ]
+        assert [fetch["after"] for fetch in fetches] == [2, 4, 5]
+
+
+class TestGetLatestDates:
+    def test_single_query_for_all_tables(self):
+        mock_conn = Mock()
+        mock_conn.run.return_value = [
+            ["staff", datetime.datetime(2022, 11, 3, 14, 20, 51, 563000)],
+            ["sales_order", datetime.datetime(2024, 5, 23, 15, 16, 9, 981000)],
+        ]
+        res = get_latest_dates(mock_conn, ["staff", "sales_order"])
+
+        mock_conn.run.assert_called_once()
+        query = mock_conn.run.call_args[0][0]
+        assert query.count("union all") == 1
+        assert "max(last_updated) from staff" in query
+        assert res == {
+            "staff": datetime.datetime(2022, 11, 3, 14, 20, 51, 563000),
+            "sales_order": datetime.datetime(2024, 5, 23, 15, 16, 9, 981000),
+        }
+
+    def test_no_tables_skips_query(self):
+        mock_conn = Mock()
+        assert get_latest_dates(mock_conn, []) == {}
+        mock_conn.run.assert_not_called()
+
+    def test_empty_table_returns_none(self):
+        mock_conn = Mock()
+        mock_conn.run.return_value = [["payment", None]]
+        res = get_latest_dates(mock_conn, ["payment"])
+        assert res == {"payment": None}
+
+
+class TestHasNewData:
+    def test_only_tables_past_the_watermark(self):
+        where_date = datetime.datetime(2023, 1, 1)
+        latest_dates = {
+            "staff": datetime.datetime(2022, 11, 3),
+            "sales_order": datetime.datetime(2024, 5, 23),
+            "payment": None,
+        }
+        assert not has_new_data("staff", latest_dates, where_date)
+        assert has_new_data("sales_order", latest_dates, where_date)
+        assert not has_new_data("payment", latest_dates, where_date)
+        assert not has_new_data("missing", latest_dates, where_date)
 
 
 # look at this later
 class TestLambdaHandler:
+    @patch("src.extract_lambda.extract_lambda.extract_tables")
+    @patch("src.extract_lambda.extract_lambda.get_table_names")
+    @patch("src.extract_lambda.extract_lambda.get_backfill_checkpoint")
+    @patch("src.extract_lambda.extract_lambda.db_conn")
+    def test_incremental_run_waits_for_backfill(
+        self,
+        mock_db_conn,
+        mock_get_backfill_checkpoint,
+        mock_get_table_names,
+        mock_extract_tables,
+    ):
+        mock_get_backfill_checkpoint.return_value = {"run": "2024-05-23"}
+        res = lambda_handler({}, [])
+        assert res["status"] == "backfill_in_progress"
+        mock_extract_tables.assert_not_called()
+
     @pytest.fixture(scope="function")
     def secretsmanager_client(aws_credentials):
         with mock_aws():
             yield boto3.client("secretsmanager", region_name="eu-west-2")
 
+    @patch(
+        "src.extract_lambda.extract_lambda.get_backfill_checkpoint",
+        Mock(return_value=None),
+    )
     @patch("src.extract_lambda.extract_lambda.get_table_names")
-    @patch("src.extract_lambda.extract_lambda.get_latest_date")
-    @patch("src.extract_lambda.extract_lambda.get_latest_date_parameter")
+    @patch("src.extract_lambda.extract_lambda.get_table_date_parameters")
     @patch("src.extract_lambda.extract_lambda.table_to_json")
     @patch("src.extract_lambda.extract_lambda.save_json_to_folder")
-    @patch("src.extract_lambda.extract_lambda.update_date_parameter")
+    @patch("src.extract_lambda.extract_lambda.update_table_date_parameters")
     @patch("src.extract_lambda.extract_lambda.db_conn")
     def test_handler_writes_json_files_to_s3(
         self,
         mock_db_conn,
-        mock_update_date_parameter,
+        mock_update_table_date_parameters,
         mock_save_json_to_folder,
         mock_table_to_json,
-        mock_get_latest_date_parameter,
-        mock_get_latest_date,
+        mock_get_table_date_parameters,
         mock_get_table_names,
         s3_client,
         ssm_client,
@@ -257,12 +894,7 @@ class TestLambdaHandler:
             Name="latest_date", Value="1999-05-24 00:00:00.000000", Type="String"
         )
 
-        mock_get_latest_date.return_value = datetime.datetime(
-            2022, 11, 3, 14, 20, 52, 186000
-        )
-        mock_get_latest_date_parameter.return_value = datetime.datetime(
-            1999, 5, 24, 00, 00, 00, 000000
-        )
+        mock_get_table_date_parameters.return_value = {}
         mock_table_to_json.side_effect = """[[
     {
         "transaction_id": 1,
@@ -284,3 +916,55 @@ class TestLambdaHandler:
         with caplog.at_level(logging.INFO):
             lambda_handler({}, [])
             assert [] == [rec.message for rec in caplog.records]
+
+    @patch(
+        "src.extract_lambda.extract_lambda.get_backfill_checkpoint",
+        Mock(return_value=None),
+    )
+    @patch("src.extract_lambda.extract_lambda.update_extract_index")
+    @patch("src.extract_lambda.extract_lambda.get_table_names")
+    @patch("src.extract_lambda.extract_lambda.get_latest_dates")
+    @patch("src.extract_lambda.extract_lambda.get_table_date_parameters")
+    @patch("src.extract_lambda.extract_lambda.table_to_json")
+    @patch("src.extract_lambda.extract_lambda.stream_batches_to_s3")
+    @patch("src.extract_lambda.extract_lambda.update_table_date_parameters")
+    @patch("src.extract_lambda.extract_lambda.db_conn")
+    def test_failed_table_keeps_its_own_cursor(
+        self,
+        mock_db_conn,
+        mock_update_table_date_parameters,
+        mock_stream_batches_to_s3,
+        mock_table_to_json,
+        mock_get_table_date_parameters,
+        mock_get_latest_dates,
+        mock_get_table_names,
+        mock_update_extract_index,
+    ):
+        old_date = datetime.datetime(2022, 11, 3, 14, 20, 49, 962000)
+        new_date = datetime.datetime(2024, 5, 23, 15, 16, 9, 981000)
+        mock_get_table_names.return_value = ["staff", "design", "currency"]
+        mock_get_latest_dates.return_value = {
+            "staff": new_date,
+            "design": new_date,
+            "currency": old_date,
+        }
+        mock_get_table_date_parameters.return_value = {
+            "staff": old_date,
+            "design": old_date,
+            "currency": old_date,
+        }
+        mock_table_to_json.side_effect = [DatabaseError(), [{"design_id": 1}]]
+
+        with pytest.raises(RuntimeError, match="staff"):
+            lambda_handler({}, [])
+
+        assert mock_table_to_json.call_count == 2
+        mock_stream_batches_to_s3.assert_called_once_with(
+            "design", new_date, [[{"design_id": 1}]], columns=None
+        )
+        mock_update_table_date_parameters.assert_called_once_with(
+            {"staff": old_date, "design": new_date, "currency": old_date}
+        )
+        mock_update_extract_index.assert_called_once_with(
+            "design", new_date, get_object_key("design", new_date)
+        )
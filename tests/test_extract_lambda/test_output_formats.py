@@ -0,0 +1,95 @@
+from src.extract_lambda.output_formats import (
+    get_upload_args,
+    write_batches,
+    write_json_lines_batches,
+)
+import pyarrow.parquet as pq
+import pytest
+import gzip
+import io
+import json
+
+BATCHES = [
+    [
+        {"currency_id": 1, "currency_code": "GBP", "created_at": "2022-11-03"},
+        {"currency_id": 2, "currency_code": "USD", "created_at": "2022-11-03"},
+    ],
+    [{"currency_id": 3, "currency_code": "EUR", "created_at": "2022-11-03"}],
+]
+ROWS = [row for batch in BATCHES for row in batch]
+
+
+class TestWriteBatches:
+    def test_json_array(self):
+        stream = io.BytesIO()
+        assert write_batches(iter(BATCHES), stream, "json") == 3
+        assert json.loads(stream.getvalue()) == ROWS
+
+    def test_json_lines(self):
+        stream = io.BytesIO()
+        assert write_batches(iter(BATCHES), stream, "jsonl") == 3
+        lines = stream.getvalue().decode("utf-8").splitlines()
+        assert [json.loads(line) for line in lines] == ROWS
+
+    def test_gzip_json_lines(self):
+        stream = io.BytesIO()
+        assert write_batches(iter(BATCHES), stream, "jsonl.gz") == 3
+        assert not stream.closed
+        lines = gzip.decompress(stream.getvalue()).decode("utf-8").splitlines()
+        assert [json.loads(line) for line in lines] == ROWS
+
+    def test_zstd_json_lines(self):
+        zstandard = pytest.importorskip("zstandard")
+        stream = io.BytesIO()
+        assert write_batches(iter(BATCHES), stream, "jsonl.zst") == 3
+        raw = zstandard.ZstdDecompressor().decompressobj().decompress(stream.getvalue())
+        assert [json.loads(line) for line in raw.decode().splitlines()] == ROWS
+
+    def test_parquet(self):
+        stream = io.BytesIO()
+        assert write_batches(iter(BATCHES), stream, "parquet") == 3
+        table = pq.read_table(io.BytesIO(stream.getvalue()))
+        assert table.to_pylist() == ROWS
+
+    def test_parquet_column_types_come_from_source_columns(self):
+        columns = [
+            ["address_id", "integer"],
+            ["address_line_2", "character varying"],
+            ["created_at", "timestamp without time zone"],
+        ]
+        batches = [
+            [{"address_id": 1, "address_line_2": None, "created_at": "2022-11-03"}],
+            [{"address_id": 2, "address_line_2": "Flat 1", "created_at": None}],
+        ]
+        stream = io.BytesIO()
+        assert write_batches(iter(batches), stream, "parquet", columns) == 2
+        table = pq.read_table(io.BytesIO(stream.getvalue()))
+        assert [str(field.type) for field in table.schema] == [
+            "int64",
+            "string",
+            "string",
+        ]
+        assert table.column("address_line_2").to_pylist() == [None, "Flat 1"]
+
+    def test_parquet_without_rows_writes_nothing(self):
+        stream = io.BytesIO()
+        assert write_batches(iter([]), stream, "parquet") == 0
+        assert stream.getvalue() == b""
+
+    def test_unsupported_format(self):
+        with pytest.raises(ValueError):
+            write_batches(iter(BATCHES), io.BytesIO(), "xml")
+
+    def test_json_lines_counts_rows(self):
+        f = io.StringIO()
+        assert write_json_lines_batches(iter(BATCHES), f) == 3
+        assert f.getvalue().count("\n") == 3
+
+
+class TestGetUploadArgs:
+    def test_format_recorded_in_metadata(self):
+        assert get_upload_args("parquet")["Metadata"] == {"format": "parquet"}
+
+    def test_compressed_formats_set_content_encoding(self):
+        assert get_upload_args("jsonl.gz")["ContentEncoding"] == "gzip"
+        assert "ContentEncoding" not in get_upload_args("jsonl")
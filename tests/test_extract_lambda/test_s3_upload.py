@@ -0,0 +1,84 @@
+from src.extract_lambda.s3_upload import S3MultipartWriter, MIN_PART_SIZE
+from moto import mock_aws
+from unittest.mock import Mock
+import pytest
+import boto3
+import os
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3_client(aws_credentials):
+    with mock_aws():
+        client = boto3.client("s3", region_name="eu-west-2")
+        client.create_bucket(
+            Bucket="test-bucket",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield client
+
+
+class TestS3MultipartWriter:
+    def test_small_object_uses_single_put(self, s3_client):
+        mock_s3_client = Mock(wraps=s3_client)
+        with S3MultipartWriter("test-bucket", "small.csv", mock_s3_client) as writer:
+            writer.write(b"a,b\n")
+            writer.write(b"1,2\n")
+
+        mock_s3_client.create_multipart_upload.assert_not_called()
+        body = s3_client.get_object(Bucket="test-bucket", Key="small.csv")["Body"]
+        assert body.read() == b"a,b\n1,2\n"
+
+    def test_large_object_uploaded_in_parts(self, s3_client):
+        mock_s3_client = Mock(wraps=s3_client)
+        chunk = b"x" * (1024 * 1024)
+        with S3MultipartWriter(
+            "test-bucket", "large.csv", mock_s3_client, ContentType="text/csv"
+        ) as writer:
+            for _ in range(11):
+                writer.write(chunk)
+            assert len(writer.buffer) < MIN_PART_SIZE
+
+        assert mock_s3_client.upload_part.call_count == 3
+        res = s3_client.get_object(Bucket="test-bucket", Key="large.csv")
+        assert res["ContentType"] == "text/csv"
+        assert res["ContentLength"] == 11 * len(chunk)
+
+    def test_parts_upload_concurrently_in_order(self, s3_client):
+        mock_s3_client = Mock(wraps=s3_client)
+        parts = [bytes([65 + i]) * MIN_PART_SIZE for i in range(5)]
+        with S3MultipartWriter(
+            "test-bucket", "ordered.json", mock_s3_client, max_in_flight=2
+        ) as writer:
+            for part in parts:
+                writer.write(part)
+            assert len(writer.pending) <= 2
+
+        complete = mock_s3_client.complete_multipart_upload.call_args[1]
+        numbers = [p["PartNumber"] for p in complete["MultipartUpload"]["Parts"]]
+        assert numbers == [1, 2, 3, 4, 5]
+        body = s3_client.get_object(Bucket="test-bucket", Key="ordered.json")["Body"]
+        assert body.read() == b"".join(parts)
+
+    def test_error_aborts_upload(self, s3_client):
+        mock_s3_client = Mock(wraps=s3_client)
+        with pytest.raises(RuntimeError):
+            with S3MultipartWriter("test-bucket", "failed.csv", mock_s3_client) as w:
+                w.write(b"x" * (MIN_PART_SIZE + 1))
+                raise RuntimeError("copy failed")
+
+        mock_s3_client.abort_multipart_upload.assert_called_once()
+        listing = s3_client.list_objects_v2(Bucket="test-bucket")
+        assert "Contents" not in listing
+
+    def test_part_size_below_s3_minimum(self, s3_client):
+        with pytest.raises(ValueError):
+            S3MultipartWriter("test-bucket", "key", s3_client, part_size=1024)
@@ -0,0 +1,34 @@
+from scripts.import_profile import (
+    LAMBDAS,
+    profile_imports,
+    get_total_ms,
+    get_top_level_packages,
+    main,
+)
+import pytest
+
+
+@pytest.mark.parametrize("name", list(LAMBDAS))
+class TestLambdaImportGraph:
+    def test_import_within_budget(self, name):
+        module = LAMBDAS[name]["module"]
+        profile = profile_imports(module)
+        assert get_total_ms(profile, module) < LAMBDAS[name]["budget_ms"]
+
+    def test_forbidden_packages_not_imported(self, name):
+        profile = profile_imports(LAMBDAS[name]["module"])
+        packages = get_top_level_packages(profile)
+        assert not set(LAMBDAS[name]["forbidden"]) & packages
+
+
+class TestProfileImports:
+    def test_profile_rows(self):
+        profile = profile_imports("json")
+        names = [row[0] for row in profile]
+        assert "json" in names
+        assert all(row[2] >= row[1] for row in profile)
+
+    def test_over_budget_fails(self, monkeypatch, capsys):
+        monkeypatch.setitem(LAMBDAS["load"], "budget_ms", 0)
+        assert main(["load"]) == 1
+        assert "FAIL: load import took" in capsys.readouterr().out
@@ -0,0 +1,29 @@
+from src.lazy_client import LazyClient
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
+import time
+
+
+class TestLazyClient:
+    @patch("boto3.client")
+    def test_client_created_on_first_use(self, mock_client):
+        client = LazyClient("s3", region_name="eu-west-2")
+        mock_client.assert_not_called()
+        client.list_buckets()
+        mock_client.assert_called_once_with("s3", region_name="eu-west-2")
+        mock_client.return_value.list_buckets.assert_called_once()
+
+    @patch("boto3.client")
+    def test_concurrent_first_use_creates_one_client(self, mock_client):
+        def slow_client(*args, **kwargs):
+            # widen the window between the check and the assignment
+            time.sleep(0.05)
+            return Mock()
+
+        mock_client.side_effect = slow_client
+        client = LazyClient("s3")
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            methods = list(executor.map(lambda _: client.get_object, range(8)))
+
+        assert mock_client.call_count == 1
+        assert all(method is methods[0] for method in methods)
@@ -4,12 +4,39 @@ from numpy import nan
 from src.transformation.lambda_function import (
     remove_duplicates_pd,
     design_schema,
+    apply_schema,
+    json_to_frame,
+    get_extract_format,
+    read_extract_frame,
     remove_null_values,
     counterparty_schema,
     staff_schema,
+    is_valid_email,
     currency_schema,
     get_json_from_s3,
+    get_source_frames,
+    run_incremental_join,
+    save_changed_rows,
+    save_each_file,
+    load_hash_index,
+    hash_rows,
+    upsert_state,
+    read_state_rows,
+    list_state_parts,
+    FrameCache,
+    fetch_extract_frames,
+    run_task_graph,
+    get_transformation_tasks,
+    list_keys,
+    get_pending_from_manifest,
+    mark_processed,
+    get_event_records,
+    get_latest_update_from_key,
+    load_table_snapshot,
+    transform_extract_object,
+    handle_s3_event,
     dim_date,
+    update_dim_date,
     get_latest_date_parameter,
     dim_counterparty,
     dim_staff,
@@ -19,14 +46,26 @@ from src.transformation.lambda_function import (
     dim_transaction,
     save_parquet_to_s3,
     fact_sales_order,
+    parse_timestamps,
     lambda_handler,
 )
 from unittest.mock import Mock, patch
+from src.extract_lambda.extract_lambda import (
+    backfill_tables,
+    get_object_key,
+    update_extract_index,
+)
+from datetime import datetime
 import boto3
 from moto import mock_aws
 import os
 import json
 import logging
+import gzip
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 @pytest.fixture(scope="function")
@@ -176,6 +215,202 @@ class TestGetJsonFromS3:
         assert "Contents" in res
 
 
+class TestListKeys:
+    def test_lists_past_the_first_page(self, s3_client):
+        create_fake_empty_bucket_with_data(s3_client, "extraction-bucket-sorceress")
+        for i in range(1005):
+            s3_client.put_object(
+                Bucket="extraction-bucket-sorceress",
+                Key=f"currency/2024-May/currency-{i:04d}.json",
+                Body="[]",
+            )
+        s3_client.put_object(
+            Bucket="extraction-bucket-sorceress", Key="design/design.json", Body="[]"
+        )
+
+        res = list_keys("extraction-bucket-sorceress", "currency", s3_client)
+        assert len(res) == 1005
+        assert all(key.startswith("currency/") for key in res)
+
+    def test_empty_prefix_returns_empty_list(self, s3_client):
+        create_fake_empty_bucket_with_data(s3_client, "extraction-bucket-sorceress")
+        assert list_keys("extraction-bucket-sorceress", "currency", s3_client) == []
+
+
+class TestFetchExtractFrames:
+    def test_results_keep_key_order(self, s3_client):
+        create_fake_empty_bucket_with_data(s3_client, "extraction-bucket-sorceress")
+        keys = [f"currency/currency-{i}.json" for i in range(20)]
+        for i, key in enumerate(keys):
+            s3_client.put_object(
+                Bucket="extraction-bucket-sorceress",
+                Key=key,
+                Body=json.dumps([{"currency_id": i}]),
+            )
+
+        res = fetch_extract_frames("currency", keys, s3_client, max_workers=4)
+        assert [df["currency_id"].tolist() for df in res] == [[i] for i in range(20)]
+
+    def test_no_keys(self, s3_client):
+        assert fetch_extract_frames("currency", [], s3_client) == []
+
+
+class TestManifest:
+    def setup_buckets(self, s3_client):
+        create_fake_empty_bucket_with_data(s3_client, "extraction-bucket-sorceress")
+        create_fake_empty_bucket_with_data(s3_client, "transformation-bucket-sorceress")
+        index = {
+            "2024-05-21 09:28:10.208000": "currency/2024-May/currency-1.json",
+            "2024-05-22 09:29:50.068000": "currency/2024-May/currency-2.json",
+        }
+        s3_client.put_object(
+            Bucket="extraction-bucket-sorceress",
+            Key="manifests/currency.json",
+            Body=json.dumps(index),
+        )
+        for i, key in enumerate(index.values()):
+            s3_client.put_object(
+                Bucket="extraction-bucket-sorceress",
+                Key=key,
+                Body=json.dumps([{"currency_id": i, "currency_code": "GBP"}]),
+            )
+
+    def test_no_index_returns_none(self, s3_client):
+        create_fake_empty_bucket_with_data(s3_client, "extraction-bucket-sorceress")
+        create_fake_empty_bucket_with_data(s3_client, "transformation-bucket-sorceress")
+        assert get_pending_from_manifest("currency", "dim_currency", s3_client) is None
+
+    def test_everything_pending_before_first_run(self, s3_client):
+        self.setup_buckets(s3_client)
+        res = get_pending_from_manifest("currency", "dim_currency", s3_client)
+        assert [latest_update for latest_update, _ in res] == [
+            "2024-05-21 09:28:10.208000",
+            "2024-05-22 09:29:50.068000",
+        ]
+
+    def test_processed_files_are_skipped(self, s3_client):
+        self.setup_buckets(s3_client)
+        mark_processed(
+            "currency", "dim_currency", "2024-05-21 09:28:10.208000", s3_client
+        )
+
+        res = get_json_from_s3("currency", s3_client=s3_client)
+        assert len(res) == 1
+        assert res[0][0] == "2024-05-22 09:29:50.068000"
+        assert res[0][1]["currency_id"].iloc[0] == 1
+
+    def test_consumers_are_tracked_separately(self, s3_client):
+        self.setup_buckets(s3_client)
+        mark_processed(
+            "currency", "dim_currency", "2024-05-22 09:29:50.068000", s3_client
+        )
+
+        assert get_pending_from_manifest("currency", "dim_currency", s3_client) == []
+        other = get_pending_from_manifest("currency", "dim_other", s3_client)
+        assert len(other) == 2
+
+    def test_mark_processed_never_moves_backwards(self, s3_client):
+        self.setup_buckets(s3_client)
+        mark_processed(
+            "currency", "dim_currency", "2024-05-22 09:29:50.068000", s3_client
+        )
+        mark_processed(
+            "currency", "dim_currency", "2024-05-21 09:28:10.208000", s3_client
+        )
+        assert get_pending_from_manifest("currency", "dim_currency", s3_client) == []
+
+    def test_first_run_includes_extracts_from_before_the_index(self, s3_client):
+        self.setup_buckets(s3_client)
+        legacy = [
+            "currency/2024-May/currency-2024-05-01 09:00:00.000000.json",
+            "currency/2024-May/currency-2024-05-02 09:00:00.000000.json",
+        ]
+        for key in legacy:
+            s3_client.put_object(
+                Bucket="extraction-bucket-sorceress", Key=key, Body="[]"
+            )
+        # the old transform already wrote the first one
+        s3_client.put_object(
+            Bucket="transformation-bucket-sorceress",
+            Key=legacy[0]
+            .replace("currency", "dim_currency")
+            .replace("json", "parquet"),
+            Body=b"",
+        )
+
+        res = get_pending_from_manifest("currency", "dim_currency", s3_client)
+        assert [key for _, key in res] == [
+            legacy[1],
+            "currency/2024-May/currency-1.json",
+            "currency/2024-May/currency-2.json",
+        ]
+
+        mark_processed(
+            "currency", "dim_currency", "2024-05-21 09:28:10.208000", s3_client
+        )
+        res = get_pending_from_manifest("currency", "dim_currency", s3_client)
+        assert [key for _, key in res] == ["currency/2024-May/currency-2.json"]
+
+    def test_listing_fallback_follows_consumer_manifest(self, s3_client):
+        create_fake_empty_bucket_with_data(s3_client, "extraction-bucket-sorceress")
+        create_fake_empty_bucket_with_data(s3_client, "transformation-bucket-sorceress")
+        keys = [
+            "department/2024-June/department-2024-06-03 09:00:00.000000.json",
+            "department/2024-May/department-2024-05-21 09:00:00.000000.json",
+        ]
+        for key in keys:
+            s3_client.put_object(
+                Bucket="extraction-bucket-sorceress",
+                Key=key,
+                Body=json.dumps([{"department_id": 1, "department_name": "Sales"}]),
+            )
+
+        res = get_source_frames("department", ["dim_staff"], s3_client)
+        assert [latest_update for latest_update, _ in res["dim_staff"]] == [
+            "2024-05-21 09:00:00.000000",
+            "2024-06-03 09:00:00.000000",
+        ]
+
+        mark_processed(
+            "department", "dim_staff", "2024-05-21 09:00:00.000000", s3_client
+        )
+        res = get_source_frames("department", ["dim_staff"], s3_client)
+        assert [latest_update for latest_update, _ in res["dim_staff"]] == [
+            "2024-06-03 09:00:00.000000"
+        ]
+
+        mark_processed(
+            "department", "dim_staff", "2024-06-03 09:00:00.000000", s3_client
+        )
+        assert get_source_frames("department", ["dim_staff"], s3_client) == {
+            "dim_staff": []
+        }
+
+    def test_concurrent_consumers_keep_both_updates(self, s3_client):
+        self.setup_buckets(s3_client)
+        slow_client = Mock(wraps=s3_client)
+
+        def slow_get_object(**kwargs):
+            # widen the gap between reading and writing the manifest
+            res = s3_client.get_object(**kwargs)
+            time.sleep(0.1)
+            return res
+
+        slow_client.get_object.side_effect = slow_get_object
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for consumer in ["dim_currency", "dim_other"]:
+                executor.submit(
+                    mark_processed,
+                    "currency",
+                    consumer,
+                    "2024-05-22 09:29:50.068000",
+                    slow_client,
+                )
+
+        for consumer in ["dim_currency", "dim_other"]:
+            assert get_pending_from_manifest("currency", consumer, s3_client) == []
+
+
 class TestGetLatesDateParameter:
     def test_retuns_time_as_tring(self, ssm_client):
         ssm_client.put_parameter(
@@ -222,6 +457,180 @@ def create_test_dataframe_design_invalid():
     )
 
 
+class TestTableSchemas:
+    def test_json_ingestion_uses_table_dtypes(self):
+        df = json_to_frame(
+            "transaction",
+            [
+                {
+                    "transaction_id": 1,
+                    "transaction_type": "PURCHASE",
+                    "sales_order_id": None,
+                    "purchase_order_id": 2,
+                },
+                {
+                    "transaction_id": 2,
+                    "transaction_type": "SALE",
+                    "sales_order_id": 1,
+                    "purchase_order_id": None,
+                },
+            ],
+        )
+        assert df["transaction_type"].dtype == "category"
+        assert df["sales_order_id"].dtype == pd.Int64Dtype()
+        assert df["sales_order_id"].isna().tolist() == [True, False]
+
+    def test_low_cardinality_columns_are_categorical(self):
+        df = json_to_frame("currency", [{"currency_id": 1, "currency_code": "GBP"}])
+        assert df["currency_code"].dtype == "category"
+        assert df["currency_id"].dtype == "int64"
+
+    def test_unknown_tables_and_columns_unchanged(self):
+        df = pd.DataFrame({"payment_id": [1], "note": ["x"]})
+        assert apply_schema(df, "payment") is df
+        assert apply_schema(df, "dim_currency") is df
+
+    def test_design_schema_keeps_column_order_and_dtypes(self):
+        df = pd.DataFrame(
+            [
+                {
+                    "design_id": 8,
+                    "created_at": "2022-11-03T14:20:49.962",
+                    "design_name": "Wooden",
+                    "file_location": "/usr",
+                    "file_name": "wooden-20220717-npgz.json",
+                    "last_updated": "2022-11-03T14:20:49.962",
+                }
+            ]
+        )
+        res = design_schema(df)
+        assert res.columns.tolist()[:4] == [
+            "design_id",
+            "design_name",
+            "file_location",
+            "file_name",
+        ]
+        assert res["design_id"].dtype == pd.Int64Dtype()
+        assert res["design_name"].dtype == pd.StringDtype()
+
+    @patch("awswrangler.s3.to_parquet")
+    def test_parquet_written_with_table_dtypes(self, mock_to_parquet):
+        df = pd.DataFrame(
+            {
+                "currency_id": [1],
+                "currency_code": ["GBP"],
+                "currency_name": ["pound sterling"],
+            }
+        )
+        save_parquet_to_s3("dim_currency", "2024-05-21 09:28:10.208000", df)
+        written = mock_to_parquet.call_args[1]["df"]
+        assert written["currency_code"].dtype == "category"
+        assert written["currency_name"].dtype == "category"
+
+
+TRANSACTION_ROWS = [
+    {
+        "transaction_id": 1,
+        "transaction_type": "PURCHASE",
+        "sales_order_id": None,
+        "purchase_order_id": 2,
+        "created_at": "2022-11-03T14:20:52.186",
+        "last_updated": "2022-11-03T14:20:52.186",
+    },
+    {
+        "transaction_id": 2,
+        "transaction_type": "SALE",
+        "sales_order_id": 1,
+        "purchase_order_id": None,
+        "created_at": "2022-11-03T14:20:52.187",
+        "last_updated": "2022-11-03T14:20:52.187",
+    },
+]
+TRANSACTION_JSON_LINES = "".join(
+    json.dumps(row) + "\n" for row in TRANSACTION_ROWS
+).encode()
+
+
+class TestReadExtractFrame:
+    def test_format_from_metadata_or_key(self):
+        assert get_extract_format("a/b.json", {"format": "jsonl.gz"}) == "jsonl.gz"
+        assert get_extract_format("a/b-2024 09:28:10.1.jsonl.zst") == "jsonl.zst"
+        assert get_extract_format("a/b.jsonl") == "jsonl"
+        assert get_extract_format("a/b-2024 09:28:10.1.csv") == "csv"
+        with pytest.raises(ValueError):
+            get_extract_format("a/b.pgcopy")
+
+    def test_json_lines_match_json_array(self):
+        expected = read_extract_frame(
+            "transaction", json.dumps(TRANSACTION_ROWS).encode(), "json"
+        )
+        res = read_extract_frame("transaction", TRANSACTION_JSON_LINES, "jsonl")
+        pd.testing.assert_frame_equal(res, expected)
+        assert res.columns.tolist() == list(TRANSACTION_ROWS[0])
+        assert res["sales_order_id"].dtype == pd.Int64Dtype()
+
+    def test_gzip_json_lines(self):
+        res = read_extract_frame(
+            "transaction", gzip.compress(TRANSACTION_JSON_LINES), "jsonl.gz"
+        )
+        assert res["transaction_id"].tolist() == [1, 2]
+        assert res["transaction_type"].dtype == "category"
+
+    def test_parquet(self):
+        stream = io.BytesIO()
+        pd.DataFrame(TRANSACTION_ROWS).to_parquet(stream)
+        res = read_extract_frame("transaction", stream.getvalue(), "parquet")
+        assert res["purchase_order_id"].isna().tolist() == [False, True]
+        assert res["transaction_type"].dtype == "category"
+
+    def test_copy_csv(self):
+        body = (
+            b"transaction_id,transaction_type,sales_order_id,purchase_order_id,"
+            b"created_at,last_updated\n"
+            b"1,PURCHASE,,2,2022-11-03 14:20:52.186,2022-11-03 14:20:52.186\n"
+            b"2,SALE,1,,2022-11-03 14:20:52.187,2022-11-03 14:20:52.187\n"
+        )
+        res = read_extract_frame("transaction", body, "csv")
+        expected = read_extract_frame(
+            "transaction", json.dumps(TRANSACTION_ROWS).encode(), "json"
+        )
+        timestamps = ["created_at", "last_updated"]
+        pd.testing.assert_frame_equal(
+            res.drop(columns=timestamps), expected.drop(columns=timestamps)
+        )
+        assert parse_timestamps(res["last_updated"]).equals(
+            parse_timestamps(expected["last_updated"])
+        )
+
+    def test_copy_csv_keeps_quoted_empty_strings(self):
+        body = b'address_id,address_line_2,district\n1,,""\n'
+        res = read_extract_frame("address", body, "csv")
+        assert res["address_line_2"].isna().tolist() == [True]
+        assert res["district"].tolist() == [""]
+
+    def test_empty_json_lines(self):
+        assert read_extract_frame("transaction", b"", "jsonl").empty
+
+    def test_get_json_from_s3_reads_json_lines(self, s3_client):
+        create_fake_empty_bucket_with_data(s3_client, "extraction-bucket-sorceress")
+        create_fake_empty_bucket_with_data(s3_client, "transformation-bucket-sorceress")
+        key = "transaction/2024-May/transaction-2024-05-21 09:28:10.208000.jsonl"
+        s3_client.put_object(
+            Bucket="extraction-bucket-sorceress",
+            Key=key,
+            Body=TRANSACTION_JSON_LINES,
+            Metadata={"format": "jsonl"},
+        )
+        s3_client.put_object(
+            Bucket="extraction-bucket-sorceress",
+            Key="manifests/transaction.json",
+            Body=json.dumps({"2024-05-21 09:28:10.208000": key}),
+        )
+        [[latest_update, df]] = get_json_from_s3("transaction", s3_client)
+        assert latest_update == "2024-05-21 09:28:10.208000"
+        assert df["transaction_id"].tolist() == [1, 2]
+
+
 class TestDimDesign:
     def test_dim_design(self, s3_client, ssm_client):
         create_fake_bucket_with_data(s3_client, "extraction-bucket-sorceress")
@@ -812,6 +1221,55 @@ class TestDimCounterParty:
         assert list(result_df.columns.values) == expected
 
 
+class TestIsValidEmail:
+    def test_matches_per_row(self):
+        emails = pd.Series(
+            [
+                "jeremie.franey@terrifictotes.com",
+                "irving.o'keefe@terrifictotes.com",
+                None,
+                "not-an-email",
+            ]
+        )
+        assert is_valid_email(emails).tolist() == [True, False, False, False]
+
+    def test_rejected_rows_are_counted(self, caplog):
+        staff_df = pd.DataFrame(
+            [
+                {
+                    "staff_id": staff_id,
+                    "first_name": "Jeremie",
+                    "last_name": "Franey",
+                    "department_id": 1,
+                    "email_address": email,
+                    "created_at": "2022-11-03T14:20:51.563",
+                    "last_updated": "2022-11-03T14:20:51.563",
+                }
+                for staff_id, email in [
+                    [1, "jeremie.franey@terrifictotes.com"],
+                    [2, "irving.o'keefe@terrifictotes.com"],
+                    [3, "not-an-email"],
+                ]
+            ]
+        )
+        department_df = pd.DataFrame(
+            [
+                {
+                    "department_id": 1,
+                    "department_name": "Sales",
+                    "location": "Manchester",
+                    "manager": "Richard Roma",
+                    "created_at": "2022-11-03T14:20:49.962",
+                    "last_updated": "2022-11-03T14:20:49.962",
+                }
+            ]
+        )
+        with caplog.at_level(logging.WARNING):
+            res = staff_schema(staff_df, department_df)
+        assert res["staff_id"].tolist() == [1]
+        assert "Rejected 2 staff rows with an invalid email address" in caplog.text
+
+
 class TestDimStaff:
     def test_staff_has_the_right_column_names(self):
         staff_df = pd.DataFrame(
@@ -1559,8 +2017,7 @@ class TestDimCurrency:
             Body=test_currency,
         )
 
-        currency_datetime_df = get_json_from_s3(table="currency",
-                                                s3_client=s3_client)
+        currency_datetime_df = get_json_from_s3(table="currency", s3_client=s3_client)
 
         currency_df = currency_datetime_df[0][1]
         dim_currency(currency_df)
@@ -1851,6 +2308,17 @@ class TestSaveParquetToS3:
             in list_of_objects
         )
 
+    def test_source_added_to_file_name(self, s3_client):
+        create_fake_empty_bucket_with_data(s3_client, "transformation-bucket-sorceress")
+        df = staff_rows([1, "Jeremie", 1])
+        save_parquet_to_s3("staff", "2024-05-22 09:29:50.068000", df, "staff")
+        save_parquet_to_s3("staff", "2024-05-22 09:29:50.068000", df, "department")
+        keys = list_keys("transformation-bucket-sorceress", "staff/", s3_client)
+        assert sorted(keys) == [
+            "staff/2024-May/staff-2024-05-22 09:29:50.068000-department.parquet",
+            "staff/2024-May/staff-2024-05-22 09:29:50.068000-staff.parquet",
+        ]
+
     def test_given_empty_dataframe(self, s3_client):
         create_fake_empty_bucket_with_data(s3_client, "transformation-bucket-sorceress")
         latest_update = "2024-05-22 09:29:50.068000"
@@ -1918,6 +2386,85 @@ class TestDimDate:
 
         assert res == expected
 
+    def test_matches_strftime_for_every_day(self):
+        res = dim_date(datetime(2023, 12, 25), datetime(2024, 3, 5))
+        assert len(res) == 72
+        for row in res.itertuples():
+            date = row.date_id.to_pydatetime()
+            assert row.year == date.strftime("%Y")
+            assert row.month == date.strftime("%m")
+            assert row.day == date.strftime("%d")
+            assert row.day_of_week == int(date.strftime("%w")) + 1
+            assert row.day_name == date.strftime("%A")
+            assert row.month_name == date.strftime("%B")
+            assert row.quarter == (date.month - 1) // 3 + 1
+
+
+@patch("src.transformation.lambda_function.save_parquet_to_s3")
+class TestUpdateDimDate:
+    def test_creates_whole_range_first_time(self, mock_save_parquet_to_s3, s3_client):
+        create_fake_empty_bucket_with_data(s3_client, "transformation-bucket-sorceress")
+        res = update_dim_date(s3_client)
+        assert len(res) == 1000
+        table_name, latest_update, _ = mock_save_parquet_to_s3.call_args[0]
+        assert table_name == "dim_date"
+        assert latest_update == "2025-07-27 00:00:00.000000"
+
+    def test_skips_when_range_already_generated(
+        self, mock_save_parquet_to_s3, s3_client
+    ):
+        create_fake_empty_bucket_with_data(s3_client, "transformation-bucket-sorceress")
+        s3_client.put_object(
+            Bucket="transformation-bucket-sorceress",
+            Key="dim_date/2025-July/dim_date-2025-07-27 00:00:00.parquet",
+            Body=b"",
+        )
+        assert update_dim_date(s3_client) is None
+        mock_save_parquet_to_s3.assert_not_called()
+
+    def test_only_new_days_added_when_range_grows(
+        self, mock_save_parquet_to_s3, s3_client, monkeypatch
+    ):
+        create_fake_empty_bucket_with_data(s3_client, "transformation-bucket-sorceress")
+        s3_client.put_object(
+            Bucket="transformation-bucket-sorceress",
+            Key="dim_date/2025-July/dim_date-2025-07-27 00:00:00.parquet",
+            Body=b"",
+        )
+        monkeypatch.setattr(
+            "src.transformation.lambda_function.DIM_DATE_END", "2025-08-05"
+        )
+        res = update_dim_date(s3_client)
+        assert res["date_id"].iloc[0] == pd.Timestamp("2025-07-28")
+        assert len(res) == 9
+        assert mock_save_parquet_to_s3.call_args[0][1] == "2025-08-05 00:00:00.000000"
+
+
+class TestParseTimestamps:
+    def test_mixed_precision_and_separators(self):
+        res = parse_timestamps(
+            pd.Series(
+                [
+                    "2022-11-03T14:20:52.186",
+                    "2022-11-03T14:20:52",
+                    "2022-11-03 14:20:52.186000",
+                ]
+            )
+        )
+        assert res.tolist() == [
+            pd.Timestamp("2022-11-03 14:20:52.186"),
+            pd.Timestamp("2022-11-03 14:20:52"),
+            pd.Timestamp("2022-11-03 14:20:52.186"),
+        ]
+
+    def test_datetimes_returned_unchanged(self):
+        timestamps = pd.Series(pd.to_datetime(["2022-11-03 14:20:52"]))
+        assert parse_timestamps(timestamps) is timestamps
+
+    def test_unexpected_format_raises(self):
+        with pytest.raises(ValueError):
+            parse_timestamps(pd.Series(["03/11/2022 14:20"]))
+
 
 class TestFactSalesOrder:
     def test_resturn_df(self):
@@ -1940,6 +2487,12 @@ class TestFactSalesOrder:
         assert res["created_date"].iloc[0] == pd.to_datetime("2022-11-03").date()
         assert res["created_time"].iloc[0] == pd.to_datetime("14:20:52.186").time()
 
+    def test_input_df_not_modified(self):
+        df = sales_order_df()
+        fact_sales_order(df)
+        assert "created_at" in df.columns
+        assert "created_date" not in df.columns
+
     def test_split_timestamp_last_updated_colum_into_date_time_colunms(self):
         res = fact_sales_order(sales_order_df())
         assert "last_date" in res.columns
@@ -2021,7 +2574,7 @@ class TestFactSalesOrder:
 class TestHandler:
     @pytest.mark.skip
     @pytest.mark.it("parquet files written to transformation-bucket-sorceress")
-    @patch("src.transformation.lambda_function.get_json_from_s3")
+    @patch("src.transformation.lambda_function.get_source_frames")
     @patch("src.transformation.lambda_function.save_parquet_to_s3")
     @patch("src.transformation.lambda_function.get_latest_date_parameter")
     @patch("src.transformation.lambda_function.dim_currency")
@@ -2044,7 +2597,7 @@ class TestHandler:
         mock_dim_currency,
         mock_get_latest_date_parameter,
         mock_save_parquet_to_s3,
-        mock_get_json_from_s3,
+        mock_get_source_frames,
         s3_client,
         ssm_client,
         caplog,
@@ -2060,14 +2613,14 @@ class TestHandler:
 
         mock_get_latest_date_parameter.return_value = "2025-05-24 00:00:00.000000"
 
-        mock_get_json_from_s3.return_value = {}
+        mock_get_source_frames.return_value = {}
 
         with caplog.at_level(logging.INFO):
             lambda_handler({}, [])
             assert "saved as parquet file" in caplog.text
 
     @pytest.mark.it("Test Handler raises Exception")
-    @patch("src.transformation.lambda_function.get_json_from_s3")
+    @patch("src.transformation.lambda_function.get_source_frames")
     @patch("src.transformation.lambda_function.save_parquet_to_s3")
     @patch("src.transformation.lambda_function.get_latest_date_parameter")
     @patch("src.transformation.lambda_function.dim_currency")
@@ -2090,7 +2643,7 @@ class TestHandler:
         mock_dim_currency,
         mock_get_latest_date_parameter,
         mock_save_parquet_to_s3,
-        mock_get_json_from_s3,
+        mock_get_source_frames,
         s3_client,
         ssm_client,
         caplog,
@@ -2106,10 +2659,757 @@ class TestHandler:
 
         mock_get_latest_date_parameter.return_value = "2025-05-24 00:00:00.000000"
 
-        mock_get_json_from_s3.return_value = {}
+        mock_get_source_frames.side_effect = lambda table, consumers, cache: {
+            consumer: [] for consumer in consumers
+        }
         mock_save_parquet_to_s3.side_effect = ValueError()
 
         with pytest.raises(Exception):
             lambda_handler({}, [])
 
         assert "Unable to convert to parquet file" in caplog.text
+
+
+def s3_record(key, bucket="extraction-bucket-sorceress"):
+    return {
+        "eventSource": "aws:s3",
+        "eventName": "ObjectCreated:Put",
+        "s3": {"bucket": {"name": bucket}, "object": {"key": key}},
+    }
+
+
+class TestEventDrivenTransformation:
+    def test_s3_event_keys_are_decoded(self):
+        event = {
+            "Records": [
+                s3_record(
+                    "currency/2024-May/currency-2024-05-21+09%3A28%3A10.208000.json"
+                )
+            ]
+        }
+        assert get_event_records(event) == [
+            [
+                None,
+                "extraction-bucket-sorceress",
+                "currency/2024-May/currency-2024-05-21 09:28:10.208000.json",
+            ]
+        ]
+
+    def test_sqs_batch_of_s3_events(self):
+        event = {
+            "Records": [
+                {
+                    "eventSource": "aws:sqs",
+                    "messageId": "message-1",
+                    "body": json.dumps(
+                        {
+                            "Records": [
+                                s3_record("design/a.json"),
+                                s3_record("staff/b.json"),
+                            ]
+                        }
+                    ),
+                },
+                {
+                    "eventSource": "aws:sqs",
+                    "messageId": "message-2",
+                    "body": json.dumps({"Event": "s3:TestEvent"}),
+                },
+            ]
+        }
+        res = get_event_records(event)
+        assert [[r[0], r[2]] for r in res] == [
+            ["message-1", "design/a.json"],
+            ["message-1", "staff/b.json"],
+        ]
+
+    def test_latest_update_from_key(self):
+        assert (
+            get_latest_update_from_key(
+                "design/2024-May/design-2024-05-21 09:28:10.2.json"
+            )
+            == "2024-05-21 09:28:10.200000"
+        )
+        assert (
+            get_latest_update_from_key(
+                "design/2024-May/design-2024-05-21 09:28:10.jsonl.gz"
+            )
+            == "2024-05-21 09:28:10.000000"
+        )
+        with pytest.raises(ValueError):
+            get_latest_update_from_key("design/design.json")
+
+    @patch("src.transformation.lambda_function.mark_processed")
+    @patch("src.transformation.lambda_function.save_parquet_to_s3")
+    def test_object_routed_to_its_dimension(
+        self, mock_save_parquet_to_s3, mock_mark_processed, s3_client
+    ):
+        create_fake_empty_bucket_with_data(s3_client, "extraction-bucket-sorceress")
+        create_fake_empty_bucket_with_data(s3_client, "transformation-bucket-sorceress")
+        key = "design/2024-May/design-2024-05-21 09:28:10.208000.json"
+        s3_client.put_object(
+            Bucket="extraction-bucket-sorceress",
+            Key=key,
+            Body=json.dumps(
+                [
+                    {
+                        "design_id": 8,
+                        "created_at": "2022-11-03T14:20:49.962",
+                        "design_name": "Wooden",
+                        "file_location": "/usr",
+                        "file_name": "wooden-20220717-npgz.json",
+                        "last_updated": "2022-11-03T14:20:49.962",
+                    }
+                ]
+            ),
+        )
+
+        assert transform_extract_object(key, s3_client) == "dim_design"
+        table_name, latest_update, df = mock_save_parquet_to_s3.call_args[0]
+        assert table_name == "dim_design"
+        assert latest_update == "2024-05-21 09:28:10.208000"
+        assert df["design_id"].tolist() == [8]
+        mock_mark_processed.assert_called_once_with(
+            "design", "dim_design", "2024-05-21 09:28:10.208000", s3_client
+        )
+
+    def test_load_table_snapshot_keeps_newest_row(self, s3_client):
+        create_fake_empty_bucket_with_data(s3_client, "extraction-bucket-sorceress")
+        s3_client.put_object(
+            Bucket="extraction-bucket-sorceress",
+            Key="department/2024-May/department-2024-05-20 09:00:00.000000.json",
+            Body=json.dumps(
+                [
+                    {"department_id": 1, "department_name": "Sales"},
+                    {"department_id": 2, "department_name": "Finance"},
+                ]
+            ),
+        )
+        s3_client.put_object(
+            Bucket="extraction-bucket-sorceress",
+            Key="department/2024-May/department-2024-05-21 09:00:00.000000.json",
+            Body=json.dumps([{"department_id": 1, "department_name": "Sales EU"}]),
+        )
+
+        res = load_table_snapshot("department", s3_client)
+        assert sorted(res["department_name"]) == ["Finance", "Sales EU"]
+
+    def test_load_table_snapshot_includes_extracts_before_the_index(self, s3_client):
+        create_fake_empty_bucket_with_data(s3_client, "extraction-bucket-sorceress")
+        old_key = "department/2024-May/department-2024-05-20 09:00:00.000000.json"
+        new_key = "department/2024-May/department-2024-05-21 09:00:00.000000.json"
+        s3_client.put_object(
+            Bucket="extraction-bucket-sorceress",
+            Key=old_key,
+            Body=json.dumps(
+                [
+                    {"department_id": 1, "department_name": "Sales"},
+                    {"department_id": 2, "department_name": "Finance"},
+                ]
+            ),
+        )
+        s3_client.put_object(
+            Bucket="extraction-bucket-sorceress",
+            Key=new_key,
+            Body=json.dumps([{"department_id": 1, "department_name": "Sales EU"}]),
+        )
+        s3_client.put_object(
+            Bucket="extraction-bucket-sorceress",
+            Key="manifests/department.json",
+            Body=json.dumps({"2024-05-21 09:00:00.000000": new_key}),
+        )
+
+        res = load_table_snapshot("department", s3_client)
+        assert sorted(res["department_name"]) == ["Finance", "Sales EU"]
+
+    def test_load_table_snapshot_orders_listed_keys_by_date(self, s3_client):
+        create_fake_empty_bucket_with_data(s3_client, "extraction-bucket-sorceress")
+        for key, name in [
+            ["department/2024-June/department-2024-06-03 09:00:00.000000.json", "New"],
+            ["department/2024-May/department-2024-05-21 09:00:00.000000.json", "Old"],
+        ]:
+            s3_client.put_object(
+                Bucket="extraction-bucket-sorceress",
+                Key=key,
+                Body=json.dumps([{"department_id": 1, "department_name": name}]),
+            )
+
+        res = load_table_snapshot("department", s3_client)
+        assert res["department_name"].tolist() == ["New"]
+
+    @patch("src.transformation.lambda_function.transform_extract_object")
+    def test_sqs_failures_reported_per_message(self, mock_transform):
+        mock_transform.side_effect = [ValueError("bad file"), "dim_staff"]
+        event = {
+            "Records": [
+                {
+                    "eventSource": "aws:sqs",
+                    "messageId": "message-1",
+                    "body": json.dumps({"Records": [s3_record("design/a.json")]}),
+                },
+                {
+                    "eventSource": "aws:sqs",
+                    "messageId": "message-2",
+                    "body": json.dumps({"Records": [s3_record("staff/b.json")]}),
+                },
+            ]
+        }
+        res = handle_s3_event(event)
+        assert res == {"batchItemFailures": [{"itemIdentifier": "message-1"}]}
+
+    @patch("src.transformation.lambda_function.transform_extract_object")
+    def test_manifests_and_other_buckets_are_ignored(self, mock_transform):
+        event = {
+            "Records": [
+                s3_record("manifests/design.json"),
+                s3_record("dim_design/x.parquet", "transformation-bucket-sorceress"),
+            ]
+        }
+        handle_s3_event(event)
+        mock_transform.assert_not_called()
+
+    @patch("src.transformation.lambda_function.transform_extract_object")
+    def test_direct_s3_failure_raises(self, mock_transform):
+        mock_transform.side_effect = ValueError("bad file")
+        with pytest.raises(ValueError):
+            lambda_handler({"Records": [s3_record("design/a.json")]}, None)
+
+
+class TestRunTaskGraph:
+    def test_dependencies_run_first_and_results_are_shared(self):
+        calls = []
+
+        def source():
+            calls.append("source")
+            return 2
+
+        tasks = {
+            "double": [["source"], lambda value: value * 2],
+            "square": [["source"], lambda value: value**2],
+            "sum": [["double", "square"], lambda a, b: a + b],
+            "source": [[], source],
+        }
+        res = run_task_graph(tasks)
+        assert res["results"] == {"source": 2, "double": 4, "square": 4, "sum": 8}
+        assert calls == ["source"]
+        assert set(res["timings"]) == set(tasks)
+        assert res["failed"] == {}
+
+    def test_independent_tasks_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+        tasks = {"a": [[], barrier.wait], "b": [[], barrier.wait]}
+        res = run_task_graph(tasks, max_workers=2)
+        assert res["failed"] == {}
+
+    def test_dependants_of_failed_tasks_are_skipped(self, caplog):
+        def broken():
+            raise ValueError("no data")
+
+        tasks = {
+            "source": [[], broken],
+            "dim": [["source"], Mock()],
+            "other": [[], lambda: 1],
+        }
+        res = run_task_graph(tasks)
+        tasks["dim"][1].assert_not_called()
+        assert res["results"] == {"other": 1}
+        assert res["failed"]["dim"] == "dependency failed"
+        assert "no data" in res["failed"]["source"]
+        assert "Task source failed" in caplog.text
+
+    def test_last_running_task_fails(self):
+        def broken():
+            raise ValueError("no data")
+
+        tasks = {
+            "other": [[], lambda: 1],
+            "source": [[], broken],
+            "dim": [["source"], Mock()],
+            "fact": [["dim"], Mock()],
+        }
+        res = run_task_graph(tasks, max_workers=1)
+        assert res["results"] == {"other": 1}
+        assert res["failed"]["dim"] == "dependency failed"
+        assert res["failed"]["fact"] == "dependency failed"
+        assert "no data" in res["failed"]["source"]
+        assert set(res["timings"]) == {"other", "source"}
+
+    def test_missing_dependency_raises(self):
+        with pytest.raises(ValueError):
+            run_task_graph({"dim": [["source"], Mock()]})
+
+    def test_transformation_tasks_fetch_each_source_once(self):
+        tasks = get_transformation_tasks()
+        sources = [name for name in tasks if name.startswith("source:")]
+        assert len(sources) == len(set(sources))
+        dependants = [name for name in tasks if "source:address" in tasks[name][0]]
+        assert sorted(dependants) == [
+            "dim_counterparty",
+            "dim_location",
+            "state:address",
+        ]
+
+
+class TestGetSourceFrames:
+    def test_file_shared_between_consumers_fetched_once(self, s3_client):
+        create_fake_empty_bucket_with_data(s3_client, "extraction-bucket-sorceress")
+        create_fake_empty_bucket_with_data(s3_client, "transformation-bucket-sorceress")
+        keys = {
+            "2024-05-21 09:28:10.208000": "address/2024-May/address-1.json",
+            "2024-05-22 09:28:10.208000": "address/2024-May/address-2.json",
+        }
+        for key in keys.values():
+            s3_client.put_object(
+                Bucket="extraction-bucket-sorceress",
+                Key=key,
+                Body=json.dumps([{"address_id": 1, "country": "Turkey"}]),
+            )
+        s3_client.put_object(
+            Bucket="extraction-bucket-sorceress",
+            Key="manifests/address.json",
+            Body=json.dumps(keys),
+        )
+        s3_client.put_object(
+            Bucket="transformation-bucket-sorceress",
+            Key="manifests/address.json",
+            Body=json.dumps({"dim_location": "2024-05-21 09:28:10.208000"}),
+        )
+        mock_s3_client = Mock(wraps=s3_client)
+
+        res = get_source_frames(
+            "address", ["dim_counterparty", "dim_location"], mock_s3_client
+        )
+        assert [p[0] for p in res["dim_counterparty"]] == list(keys)
+        assert [p[0] for p in res["dim_location"]] == ["2024-05-22 09:28:10.208000"]
+        assert res["dim_location"][0][1] is res["dim_counterparty"][1][1]
+        fetched = [
+            c[1]["Key"]
+            for c in mock_s3_client.get_object.call_args_list
+            if not c[1]["Key"].startswith("manifests/")
+        ]
+        assert sorted(fetched) == sorted(keys.values())
+
+
+def address_frame(rows):
+    return json_to_frame(
+        "address",
+        [
+            {"address_id": i, "country": "Turkey", "city": "x" * 100}
+            for i in range(rows)
+        ],
+    )
+
+
+class TestFrameCache:
+    def test_hit_returns_same_frame(self):
+        cache = FrameCache(spill_dir=None)
+        df = address_frame(2)
+        cache.put("address", "address/a.json", df)
+        assert cache.get("address", "address/a.json") is df
+        assert cache.get("address", "address/b.json") is None
+        assert [cache.hits, cache.misses] == [1, 1]
+
+    def test_least_recently_used_evicted_over_budget(self):
+        df = address_frame(10)
+        size = int(df.memory_usage(deep=True).sum())
+        cache = FrameCache(max_bytes=size * 2, spill_dir=None)
+        cache.put("address", "a", df)
+        cache.put("address", "b", address_frame(10))
+        cache.get("address", "a")
+        cache.put("address", "c", address_frame(10))
+        assert cache.get("address", "b") is None
+        assert cache.get("address", "a") is df
+        assert cache.size <= cache.max_bytes
+
+    def test_frames_spill_to_feather(self, tmp_path):
+        df = address_frame(3)
+        FrameCache(spill_dir=str(tmp_path)).put("address", "address/a.json", df)
+        res = FrameCache(spill_dir=str(tmp_path)).get("address", "address/a.json")
+        pd.testing.assert_frame_equal(res, df)
+        assert res["country"].dtype == "category"
+
+    def test_spilled_files_evicted_over_budget(self, tmp_path):
+        df = address_frame(10)
+        cache = FrameCache(spill_dir=str(tmp_path), spill_max_bytes=10**9)
+        cache.put("address", "a", df)
+        size = os.path.getsize(cache.get_spill_path("address", "a"))
+        for key, mtime in [["a", 1], ["b", 2], ["c", 3]]:
+            cache.put("address", key, df)
+            os.utime(cache.get_spill_path("address", key), (mtime, mtime))
+
+        cache = FrameCache(spill_dir=str(tmp_path), spill_max_bytes=size * 2)
+        assert cache.get("address", "a") is not None
+        cache.put("address", "d", df)
+        spilled = sorted(path.name for path in (tmp_path / "address").iterdir())
+        assert spilled == sorted(
+            os.path.basename(cache.get_spill_path("address", key)) for key in ["a", "d"]
+        )
+
+    def test_fetch_reads_through_cache(self, s3_client):
+        create_fake_empty_bucket_with_data(s3_client, "extraction-bucket-sorceress")
+        s3_client.put_object(
+            Bucket="extraction-bucket-sorceress",
+            Key="address/a.json",
+            Body=json.dumps([{"address_id": 1, "country": "Turkey"}]),
+        )
+        mock_s3_client = Mock(wraps=s3_client)
+        cache = FrameCache(spill_dir=None)
+        [first] = fetch_extract_frames(
+            "address", ["address/a.json"], mock_s3_client, cache=cache
+        )
+        [second] = fetch_extract_frames(
+            "address", ["address/a.json"], mock_s3_client, cache=cache
+        )
+        assert first is second
+        assert mock_s3_client.get_object.call_count == 1
+
+
+def staff_rows(*rows):
+    return json_to_frame(
+        "staff",
+        [
+            {
+                "staff_id": staff_id,
+                "first_name": first_name,
+                "last_name": "Franey",
+                "department_id": department_id,
+                "email_address": f"{first_name.lower()}@terrifictotes.com",
+                "created_at": "2022-11-03T14:20:51.563",
+                "last_updated": "2022-11-03T14:20:51.563",
+            }
+            for staff_id, first_name, department_id in rows
+        ],
+    )
+
+
+def department_rows(*rows):
+    return json_to_frame(
+        "department",
+        [
+            {
+                "department_id": department_id,
+                "department_name": department_name,
+                "location": "Manchester",
+                "manager": "Richard Roma",
+                "created_at": "2022-11-03T14:20:49.962",
+                "last_updated": "2022-11-03T14:20:49.962",
+            }
+            for department_id, department_name in rows
+        ],
+    )
+
+
+@pytest.fixture(scope="function")
+def join_buckets(s3_client):
+    create_fake_empty_bucket_with_data(s3_client, "extraction-bucket-sorceress")
+    create_fake_empty_bucket_with_data(s3_client, "transformation-bucket-sorceress")
+    return s3_client
+
+
+def save_state(s3_client, table, df):
+    upsert_state(table, [["2024-05-20 00:00:00.000000", df]], s3_client)
+
+
+class TestSourceState:
+    def test_state_built_from_extracts_when_missing(self, join_buckets):
+        join_buckets.put_object(
+            Bucket="extraction-bucket-sorceress",
+            Key="department/2024-May/department-2024-05-20 09:00:00.000000.json",
+            Body=department_rows([1, "Sales"], [2, "Finance"]).to_json(
+                orient="records"
+            ),
+        )
+        res = read_state_rows("department", [2], join_buckets)
+        assert res["department_name"].tolist() == ["Finance"]
+
+    def test_rows_partitioned_by_primary_key(self, join_buckets, monkeypatch):
+        monkeypatch.setattr(
+            "src.transformation.lambda_function.STATE_PARTITION_ROWS", 10
+        )
+        save_state(join_buckets, "staff", staff_rows([1, "Ana", 1], [12, "Stan", 1]))
+        assert list_state_parts("staff", join_buckets) == [0, 1]
+
+        mock_s3_client = Mock(wraps=join_buckets)
+        counts = upsert_state(
+            "staff",
+            [["2024-05-21 00:00:00.000000", staff_rows([13, "Tom", 1])]],
+            mock_s3_client,
+        )
+        assert counts == {"inserted": 1, "updated": 0, "stale": 0}
+        written = [c[1]["Key"] for c in mock_s3_client.put_object.call_args_list]
+        assert written == ["state/staff/part-000001.parquet"]
+        res = read_state_rows("staff", [1, 12, 13], join_buckets)
+        assert sorted(res["first_name"]) == ["Ana", "Stan", "Tom"]
+
+    def test_older_rows_do_not_replace_newer(self, join_buckets):
+        newer = staff_rows([1, "Jerry", 1])
+        newer["last_updated"] = "2024-01-01T10:00:00"
+        save_state(join_buckets, "staff", newer)
+
+        older = staff_rows([1, "Jeremie", 1], [2, "Ana", 1])
+        counts = upsert_state(
+            "staff", [["2024-05-21 00:00:00.000000", older]], join_buckets
+        )
+        assert counts == {"inserted": 1, "updated": 0, "stale": 1}
+        res = read_state_rows("staff", [1, 2], join_buckets)
+        assert sorted(res["first_name"]) == ["Ana", "Jerry"]
+
+
+@patch("src.transformation.lambda_function.save_parquet_to_s3")
+class TestIncrementalJoin:
+    def test_child_delta_joined_against_lookup_state(
+        self, mock_save_parquet_to_s3, join_buckets
+    ):
+        save_state(join_buckets, "department", department_rows([1, "Sales"]))
+        pending = [["2024-05-21 09:28:10.208000", staff_rows([1, "Jeremie", 1])]]
+        upsert_state("staff", pending, join_buckets)
+
+        assert run_incremental_join("dim_staff", pending, [], join_buckets) == 1
+        table_name, latest_update, df = mock_save_parquet_to_s3.call_args[0]
+        assert table_name == "dim_staff"
+        assert df["department_name"].tolist() == ["Sales"]
+        manifest = join_buckets.get_object(
+            Bucket="transformation-bucket-sorceress", Key="manifests/staff.json"
+        )
+        assert json.load(manifest["Body"]) == {
+            "dim_staff": "2024-05-21 09:28:10.208000"
+        }
+
+    def test_every_pending_file_is_joined(self, mock_save_parquet_to_s3, join_buckets):
+        save_state(join_buckets, "department", department_rows([1, "Sales"]))
+        save_state(join_buckets, "staff", staff_rows([9, "Stan", 1]))
+        pending = [
+            ["2024-05-21 09:28:10.208000", staff_rows([1, "Jeremie", 1])],
+            ["2024-05-22 09:28:10.208000", staff_rows([1, "Jerry", 1], [2, "Ana", 1])],
+        ]
+        upsert_state("staff", pending, join_buckets)
+
+        run_incremental_join("dim_staff", pending, [], join_buckets)
+        _, latest_update, df = mock_save_parquet_to_s3.call_args[0]
+        assert latest_update == "2024-05-22 09:28:10.208000"
+        assert sorted(df["first_name"]) == ["Ana", "Jerry"]
+
+    def test_lookup_change_recomputes_only_affected_rows(
+        self, mock_save_parquet_to_s3, join_buckets
+    ):
+        save_state(
+            join_buckets, "department", department_rows([1, "Sales"], [2, "Finance"])
+        )
+        save_state(
+            join_buckets,
+            "staff",
+            staff_rows([1, "Jeremie", 1], [2, "Ana", 2], [3, "Stan", 2]),
+        )
+        pending = [["2024-05-21 09:28:10.208000", department_rows([2, "Accounts"])]]
+        upsert_state("department", pending, join_buckets)
+
+        assert run_incremental_join("dim_staff", [], pending, join_buckets) == 2
+        _, _, df = mock_save_parquet_to_s3.call_args[0]
+        assert sorted(df["staff_id"]) == [2, 3]
+        assert set(df["department_name"]) == {"Accounts"}
+
+    def test_same_timestamp_from_each_source_written_apart(
+        self, mock_save_parquet_to_s3, join_buckets
+    ):
+        save_state(join_buckets, "department", department_rows([1, "Sales"]))
+        save_state(join_buckets, "staff", staff_rows([1, "Jeremie", 1]))
+        latest_update = "2024-05-21 09:28:10.208000"
+        staff_df = staff_rows([1, "Jeremy", 1])
+        upsert_state("staff", [[latest_update, staff_df]], join_buckets)
+        run_incremental_join("dim_staff", [[latest_update, staff_df]], [], join_buckets)
+        department_df = department_rows([1, "Sales EU"])
+        upsert_state("department", [[latest_update, department_df]], join_buckets)
+        run_incremental_join(
+            "dim_staff", [], [[latest_update, department_df]], join_buckets
+        )
+        sources = [
+            call.kwargs["source"] for call in mock_save_parquet_to_s3.call_args_list
+        ]
+        assert sources == ["staff", "department"]
+
+    def test_nothing_pending(self, mock_save_parquet_to_s3, join_buckets):
+        assert run_incremental_join("dim_staff", [], [], join_buckets) == 0
+        mock_save_parquet_to_s3.assert_not_called()
+
+    def test_department_event_updates_dim_staff(
+        self, mock_save_parquet_to_s3, join_buckets
+    ):
+        save_state(join_buckets, "department", department_rows([1, "Sales"]))
+        save_state(join_buckets, "staff", staff_rows([1, "Jeremie", 1]))
+        key = "department/2024-May/department-2024-05-21 09:28:10.208000.json"
+        department_df = department_rows([1, "Sales EU"])
+        department_df["last_updated"] = "2024-05-21T09:28:10.208"
+        join_buckets.put_object(
+            Bucket="extraction-bucket-sorceress",
+            Key=key,
+            Body=department_df.to_json(orient="records"),
+        )
+        assert transform_extract_object(key, join_buckets) == "dim_staff"
+        _, _, df = mock_save_parquet_to_s3.call_args[0]
+        assert df["department_name"].tolist() == ["Sales EU"]
+
+
+def currency_rows(*rows):
+    return pd.DataFrame(
+        [
+            {
+                "currency_id": currency_id,
+                "currency_code": code,
+                "currency_name": name,
+                "last_updated": "2024-05-20T00:00:00.000",
+            }
+            for currency_id, code, name in rows
+        ]
+    )
+
+
+@patch("src.transformation.lambda_function.save_parquet_to_s3")
+class TestSaveChangedRows:
+    def test_first_write_saves_every_row_and_index(
+        self, mock_save_parquet_to_s3, join_buckets
+    ):
+        df = currency_rows([1, "GBP", "British pound"], [2, "USD", "US dollar"])
+        assert save_changed_rows("dim_currency", "2024", df, join_buckets) == 2
+        assert len(mock_save_parquet_to_s3.call_args[0][2]) == 2
+        index = load_hash_index("dim_currency", join_buckets)
+        assert sorted(index.index) == [1, 2]
+        assert index.tolist() == hash_rows("dim_currency", df).tolist()
+
+    def test_only_timestamp_changed_is_skipped(
+        self, mock_save_parquet_to_s3, join_buckets
+    ):
+        df = currency_rows([1, "GBP", "British pound"])
+        save_changed_rows("dim_currency", "2024", df, join_buckets)
+        df["last_updated"] = "2024-05-21T00:00:00.000"
+        assert save_changed_rows("dim_currency", "2025", df, join_buckets) == 0
+        assert mock_save_parquet_to_s3.call_count == 1
+
+    def test_changed_and_new_rows_are_saved(
+        self, mock_save_parquet_to_s3, join_buckets
+    ):
+        save_changed_rows(
+            "dim_currency",
+            "2024",
+            currency_rows([1, "GBP", "British pound"], [2, "USD", "US dollar"]),
+            join_buckets,
+        )
+        df = currency_rows(
+            [1, "GBP", "British pound"],
+            [2, "USD", "United States dollar"],
+            [3, "EUR", "Euro"],
+        )
+        assert save_changed_rows("dim_currency", "2025", df, join_buckets) == 2
+        saved = mock_save_parquet_to_s3.call_args[0][2]
+        assert saved["currency_id"].tolist() == [2, 3]
+        index = load_hash_index("dim_currency", join_buckets)
+        assert sorted(index.index) == [1, 2, 3]
+        assert index[2] == hash_rows("dim_currency", df).iloc[1]
+
+    def test_dtype_does_not_change_hash(self, mock_save_parquet_to_s3, join_buckets):
+        df = currency_rows([1, "GBP", "British pound"])
+        typed = apply_schema(df, "dim_currency")
+        assert hash_rows("dim_currency", df).equals(hash_rows("dim_currency", typed))
+
+    def test_dimension_without_key_is_saved_unchanged(
+        self, mock_save_parquet_to_s3, join_buckets
+    ):
+        df = dim_date("2024-01-01", "2024-01-03")
+        assert save_changed_rows("dim_date", "2024", df, join_buckets) == 3
+        mock_save_parquet_to_s3.assert_called_once_with(
+            "dim_date", "2024", df, source=None
+        )
+        listing = join_buckets.list_objects_v2(
+            Bucket="transformation-bucket-sorceress", Prefix="hashes/"
+        )
+        assert "Contents" not in listing
+
+
+class TestBackfillConsumption:
+    def fake_conn(self, rows):
+        mock_conn = Mock()
+
+        def run(sql, **params):
+            if "max(last_updated)" in sql:
+                return [["currency", datetime(2024, 5, 23, 15, 16, 9, 981000)]]
+            if "PRIMARY KEY" in sql:
+                return [["currency_id"]]
+            after = params.get("after", 0)
+            page = [row for row in rows if row["currency_id"] > after]
+            return [[row["currency_id"], row] for row in page[: params["page_size"]]]
+
+        mock_conn.run.side_effect = run
+        return mock_conn
+
+    def currency_rows(self):
+        return [
+            {
+                "currency_id": currency_id,
+                "currency_code": code,
+                "created_at": "2022-11-03T14:20:49.962",
+                "last_updated": "2022-11-03T14:20:49.962",
+            }
+            for currency_id, code in [[1, "GBP"], [2, "USD"], [3, "EUR"]]
+        ]
+
+    @patch("src.transformation.lambda_function.save_parquet_to_s3")
+    def test_reload_of_an_unchanged_table_is_not_skipped(
+        self, mock_save_parquet_to_s3, join_buckets, ssm_client
+    ):
+        # the last incremental extract is at the watermark and processed
+        watermark = datetime(2024, 5, 23, 15, 16, 9, 981000)
+        key = get_object_key("currency", watermark)
+        join_buckets.put_object(
+            Bucket="extraction-bucket-sorceress",
+            Key=key,
+            Body=json.dumps(self.currency_rows()[:1]),
+        )
+        update_extract_index("currency", watermark, key, join_buckets)
+        mark_processed(
+            "currency", "dim_currency", "2024-05-23 15:16:09.981000", join_buckets
+        )
+
+        backfill_tables(
+            self.fake_conn(self.currency_rows()),
+            ["currency"],
+            page_size=2,
+            s3_client=join_buckets,
+            ssm_client=ssm_client,
+        )
+
+        sources = get_source_frames("currency", ["dim_currency"], join_buckets)
+        [[latest_update, df]] = sources["dim_currency"]
+        assert latest_update == "2024-05-23 15:16:09.981001"
+        assert df["currency_id"].tolist() == [1, 2, 3]
+
+    @patch("src.transformation.lambda_function.save_parquet_to_s3")
+    def test_backfill_parts_reach_the_dimension(
+        self, mock_save_parquet_to_s3, join_buckets, ssm_client
+    ):
+        rows = [
+            {
+                "currency_id": currency_id,
+                "currency_code": code,
+                "created_at": "2022-11-03T14:20:49.962",
+                "last_updated": "2022-11-03T14:20:49.962",
+            }
+            for currency_id, code in [[1, "GBP"], [2, "USD"], [3, "EUR"]]
+        ]
+        res = backfill_tables(
+            self.fake_conn(rows),
+            ["currency"],
+            page_size=2,
+            s3_client=join_buckets,
+            ssm_client=ssm_client,
+        )
+        assert res["status"] == "complete"
+
+        sources = get_source_frames("currency", ["dim_currency"], join_buckets)
+        assert save_each_file("currency", "dim_currency", dim_currency, sources) == 1
+        consumer, latest_update, df = mock_save_parquet_to_s3.call_args[0]
+        assert consumer == "dim_currency"
+        assert latest_update == "2024-05-23 15:16:09.981001"
+        assert df["currency_code"].tolist() == ["GBP", "USD", "EUR"]
+
+        # processed once, the next run only looks at newer extracts
+        sources = get_source_frames("currency", ["dim_currency"], join_buckets)
+        assert sources == {"dim_currency": []}